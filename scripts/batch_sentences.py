@@ -1,17 +1,27 @@
 """
 Process sentences for GenFact in a batch.
+
+Batches run one after another, with a Genparse restart between them. Sentences within a batch are requested
+concurrently and each batch's HTML is written as results arrive. We shrink the batches when the server times out.
 """
 
 from argparse import ArgumentParser
+from contextlib import closing
 import json
 import logging
 import math
-import os
 from pathlib import Path
 import string
-import requests
-from requests.auth import HTTPBasicAuth
+import threading
 import time
+from typing import Optional
+
+import requests
+
+from scripts.utils.concurrency import ordered_map
+from scripts.utils.http_client import genfact_endpoint, get_session, request_timeout
+from scripts.utils.restarts import request_restart, wait_until_ready
+from scripts.utils.server_pool import ServerPool
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +32,10 @@ RESOURCES_ROOT = REPO_ROOT / 'resources'
 PROMPT_TEMPLATE_PATH = RESOURCES_ROOT / 'templates' / 'json_prompt_template.txt'
 GRAMMAR_PATH = RESOURCES_ROOT / 'json_grammar.lark'
 DEFAULT_BATCH_SIZE = 20
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_GROW_AFTER = 3
+# How many batches in a row may time out without finishing a single sentence before we give up.
+MAX_STALLED_BATCHES = 3
 
 HTML_TEMPLATE = string.Template(
     """<!DOCTYPE html>
@@ -54,62 +68,50 @@ $rows
 # IP and connection related
 HTTP_TIMEOUT_CODE = 504  # https://developer.mozilla.org/en-US/docs/Web/HTTP/Status/504
 DEFAULT_GENFACT_SERVER_IP = '34.44.35.203'
-GENFACT_ENDPOINT_FORMAT = string.Template('http://$ip:8888/sentence-to-doctor-data')
 
 DEFAULT_GENPARSE_SERVER_IP = '34.122.30.137'
-ALTERNATE_SERVER_IP = '34.70.201.1'
-
-connect_timeout_seconds = 3.05
 
-inference_endpoint_format = string.Template('http://$ip:8888/infer')
 inference_timeout_seconds = 120
-post_restart_inference_timeout_seconds = 300
-WAIT_FOR_GENPARSE_REBOOT = 60
 WAIT_FOR_GENPARSE_REBOOT_LONG = 30
 
-restart_endpoint_format = string.Template('http://$ip:9999/restart')
 restart_timeout_seconds = 30
 
 
-def get_restart_user():
-    return os.getenv('GENPARSE_USER')
-
-
-def get_restart_password():
-    return os.getenv('GENPARSE_PASSWORD')
+def restart_server(ip: str):
+    "Restart the Genparse server at the given IP and wait until it's ready again."
+    request_restart(ip, timeout_seconds=restart_timeout_seconds)
+    wait_until_ready(ip)
 
 
-def request_timeout(timeout):
-    return (connect_timeout_seconds, timeout)
-
-
-def restart_server(ip: str):
-    "Restart the Genparse server at the given IP."
-    url = restart_endpoint_format.substitute(ip=ip)
-    basic = HTTPBasicAuth(get_restart_user(), get_restart_password())
-    result = requests.post(url, auth=basic, timeout=request_timeout(restart_timeout_seconds))
-    assert result.status_code == 200
-    logger.debug('Sleeping for %d waiting for genparse to reboot', WAIT_FOR_GENPARSE_REBOOT)
-    time.sleep(WAIT_FOR_GENPARSE_REBOOT)
-    return result
+def restart_servers(ips: list[str]):
+    "Restart the Genparse servers at the given IPs in parallel and wait until they're all ready again."
+    for _ in ordered_map(restart_server, ips, max_in_flight=len(ips)):
+        pass
 
 
 def run_inference_genfact_server(sentence: str, *, ip: str = DEFAULT_GENFACT_SERVER_IP):
     """
     Run inference using the Genfact server.
     """
-    url = GENFACT_ENDPOINT_FORMAT.substitute(ip=ip)
+    url = genfact_endpoint(ip)
     params = {'sentence': sentence}
     headers = {
         'Content-type': 'application/json',
         'Accept': 'application/json',
     }
-    response = requests.post(url, json=params, headers=headers)
+    session = get_session()
+    timeout = request_timeout(inference_timeout_seconds)
+    response = session.post(url, json=params, headers=headers, timeout=timeout)
+    if response.status_code == HTTP_TIMEOUT_CODE:
+        # The batch driver handles timeouts by restarting Genparse, so there's no point waiting here.
+        return response
     try:
         if 'posterior' not in response.json():
-            logger.debug("Got bad response from server: %s, sleeping for %d", response.json(), WAIT_FOR_GENPARSE_REBOOT_LONG)
+            logger.debug(
+                "Got bad response from server: %s, sleeping for %d", response.json(), WAIT_FOR_GENPARSE_REBOOT_LONG
+            )
             time.sleep(WAIT_FOR_GENPARSE_REBOOT_LONG)
-            response = requests.post(url, json=params, headers=headers)
+            response = session.post(url, json=params, headers=headers, timeout=timeout)
     except json.JSONDecodeError:
         raise
     return response
@@ -144,6 +146,111 @@ def format_as_html_table(response, *, sentence: str):
     return result
 
 
+class BatchSizer:
+    """
+    Adapts the number of sentences we send between Genparse restarts.
+
+    A timeout means the server's cache filled up before the batch finished, so we halve the batch size. After
+    `grow_after` batches in a row finish without a timeout, we grow the batch size by a quarter again, up to
+    `max_batch_size`.
+    """
+
+    def __init__(self, max_batch_size: int, *, grow_after: int):
+        self.batch_size = max_batch_size
+        self.max_batch_size = max_batch_size
+        self.grow_after = grow_after
+        self._n_clean_batches = 0
+
+    def on_timeout(self) -> None:
+        self._n_clean_batches = 0
+        if self.batch_size > 1:
+            self.batch_size //= 2
+            logger.info('Shrinking batch size to %d', self.batch_size)
+
+    def on_success(self) -> None:
+        self._n_clean_batches += 1
+        if self._n_clean_batches >= self.grow_after and self.batch_size < self.max_batch_size:
+            self._n_clean_batches = 0
+            self.batch_size = min(self.max_batch_size, self.batch_size + max(1, self.batch_size // 4))
+            logger.info('Growing batch size to %d', self.batch_size)
+
+
+def _request_sentence(sentence: str, *, genfact_pool: ServerPool) -> Optional[requests.Response]:
+    "Request inference for one sentence, returning None if the request timed out."
+    try:
+        response = genfact_pool.call(lambda ip: run_inference_genfact_server(sentence, ip=ip))
+    except requests.Timeout:
+        return None
+    if response.status_code == HTTP_TIMEOUT_CODE:
+        return None
+    return response
+
+
+def run_batch(
+    batch: list[str],
+    *,
+    start_index: int,
+    genfact_pool: ServerPool,
+    max_in_flight: int,
+    write_sections_to: Path,
+    finished: dict[int, requests.Response],
+) -> int:
+    """
+    Request a batch of sentences concurrently, appending each HTML section to a file as soon as it's ready.
+
+    Sections are written in sentence order, up to the first sentence that times out, and we return how many sentences
+    were done before it. Once a sentence times out we send no new requests, but the responses to requests already in
+    flight are kept in `finished`, keyed by sentence index (the first sentence of the batch being `start_index`), so
+    that later batches use them rather than request those sentences again.
+    """
+    already_finished = {
+        offset: finished.pop(start_index + offset) for offset in range(len(batch)) if start_index + offset in finished
+    }
+    timed_out = threading.Event()
+
+    def request(offset: int) -> Optional[requests.Response]:
+        if offset in already_finished:
+            return already_finished[offset]
+        if timed_out.is_set():
+            return None
+        response = _request_sentence(batch[offset], genfact_pool=genfact_pool)
+        if response is None:
+            timed_out.set()
+        return response
+
+    n_done = 0
+    with write_sections_to.open(mode='w', encoding='utf-8') as sections_out, closing(
+        ordered_map(request, range(len(batch)), max_in_flight=max_in_flight)
+    ) as responses:
+        for offset, (sentence, response) in enumerate(zip(batch, responses)):
+            if n_done < offset:
+                # We're past the timeout, so this request was either skipped or already in flight.
+                if response is not None:
+                    finished[start_index + offset] = response
+                continue
+            if response is None:
+                logger.debug('TIMEOUT on sentence %d of %d', n_done + 1, len(batch))
+                continue
+            html_table = format_as_html_table(response, sentence=sentence)
+            if n_done > 0:
+                sections_out.write('\n')
+            sections_out.write(
+                f"""<h2>{sentence}</h2>
+{html_table}"""
+            )
+            sections_out.flush()
+            n_done += 1
+    return n_done
+
+
+def write_batch_html(sections_path: Path, html_path: Path, *, batch_no: int, start_sent: int, end_sent: int):
+    "Wrap the streamed sections of a finished batch into its HTML page."
+    tables = sections_path.read_text(encoding='utf-8')
+    html = HTML_TEMPLATE.substitute(batch_no=batch_no, start_sent=start_sent, end_sent=end_sent, tables=tables)
+    html_path.write_text(html, encoding='utf-8')
+    sections_path.unlink()
+
+
 def main():
     parser = ArgumentParser(description=__doc__)
     parser.add_argument(
@@ -155,20 +262,37 @@ def main():
     parser.add_argument(
         '--genfact-ip',
         type=str,
-        default=DEFAULT_GENFACT_SERVER_IP,
-        help='GenFact server IP to use.',
+        nargs='+',
+        default=[DEFAULT_GENFACT_SERVER_IP],
+        help='GenFact server IPs to use. Requests go to whichever server has the fewest outstanding.',
     )
     parser.add_argument(
         '--genparse-ip',
         type=str,
-        default=DEFAULT_GENPARSE_SERVER_IP,
-        help='Genparse server IP to restart.',
+        nargs='+',
+        default=[DEFAULT_GENPARSE_SERVER_IP],
+        help='Genparse server IPs to restart between batches.',
     )
     parser.add_argument(
         '--batch-size',
         type=int,
         default=DEFAULT_BATCH_SIZE,
-        help='Number of sentences to process in one batch.',
+        help=(
+            'Number of sentences to process in one batch, between Genparse restarts. We halve this when a batch '
+            'times out, and grow it back up to this size after batches finish without timeouts.'
+        ),
+    )
+    parser.add_argument(
+        '--grow-after',
+        type=int,
+        default=DEFAULT_GROW_AFTER,
+        help='How many batches in a row must finish without timeouts before we grow the batch size again.',
+    )
+    parser.add_argument(
+        '--max-in-flight',
+        type=int,
+        default=DEFAULT_MAX_IN_FLIGHT,
+        help='Maximum number of concurrent requests to the GenFact servers within a batch.',
     )
     parser.add_argument(
         '--logging-level',
@@ -186,62 +310,70 @@ def main():
 
     sentences_path: Path = args.sentences_path
     save_outputs_to: Path = args.save_outputs_to
-    genfact_ip: str = args.genfact_ip
-    genparse_ip: str = args.genparse_ip
+    genfact_ips: list[str] = args.genfact_ip
+    genparse_ips: list[str] = args.genparse_ip
     batch_size: int = args.batch_size
+    grow_after: int = args.grow_after
+    max_in_flight: int = args.max_in_flight
+
+    assert batch_size > 0
+    assert grow_after > 0
+    assert max_in_flight > 0
 
     save_outputs_to.mkdir(parents=True, exist_ok=True)
 
-    # restart it BAE just in case previous queries have filled the cache
-    logger.info('Restarting Genparse server at %s', genparse_ip)
-    restart_server(genparse_ip)
+    genfact_pool = ServerPool(genfact_ips)
+
+    # restart them BAE just in case previous queries have filled the cache
+    logger.info('Restarting Genparse servers at %s', ', '.join(genparse_ips))
+    restart_servers(genparse_ips)
 
     sentences = sentences_path.read_text(encoding='utf-8').splitlines()
-    batch = []
+    sizer = BatchSizer(batch_size, grow_after=grow_after)
     start_sent = 1
     batch_no = 1
-    expected_batch_total = math.ceil(len(sentences) / batch_size)
-    while sentences or batch:
-        if not batch:
-            logger.info('Starting batch %d', batch_no)
-            batch = sentences[:batch_size]
-            sentences = sentences[batch_size:]
-            end_sent = start_sent + len(batch)
-        else:
-            logger.info('Rerunning batch %d', batch_no)
-
-        sections = []
-        timing_out = False
-        for sent_no, sentence in enumerate(batch, start=1):
-            logger.debug('Requesting sentence %d of %d in batch %d', sent_no, len(batch), batch_no)
-            response = run_inference_genfact_server(sentence, ip=genfact_ip)
-            if response.status_code == HTTP_TIMEOUT_CODE:
-                logger.debug('TIMEOUT on sentence %d of %d in batch %d', sent_no, len(batch), batch_no)
-                timing_out = True
-                break
-            html_table = format_as_html_table(response, sentence=sentence)
-            section = f"""<h2>{sentence}</h2>
-{html_table}"""
-            sections.append(section)
-
-        if timing_out:
-            logger.debug('TIMEOUT on batch %d with batch size %d', batch_no, batch_size)
-            raise ValueError('oops, we broke the server :(')
-            batch_size = batch_size // 2
-            continue
-        html = HTML_TEMPLATE.substitute(batch_no=batch_no, start_sent=start_sent, end_sent=end_sent, tables='\n'.join(sections))
-        html_path = save_outputs_to / f'genfact_batch{batch_no}_of_expected_{expected_batch_total}.html'
-        html_path.write_text(html)
-        logger.info('Wrote results for batch %d to %s', batch_no, html_path)
-
-        logger.info('Restarting Genparse server at %s', genparse_ip)
-        restart_server(genparse_ip)
-
-        start_sent += len(batch)
-        batch = []
-        batch_no += 1
+    n_stalled = 0
+    # Responses that came in after a timeout, by sentence index, to use in later batches.
+    finished: dict[int, requests.Response] = {}
+    while start_sent <= len(sentences):
+        batch = sentences[start_sent - 1:start_sent - 1 + sizer.batch_size]
+        expected_batch_total = batch_no - 1 + math.ceil((len(sentences) - start_sent + 1) / sizer.batch_size)
+        logger.info('Starting batch %d with %d sentences', batch_no, len(batch))
+        sections_path = save_outputs_to / f'genfact_batch{batch_no}.partial.html'
+        n_done = run_batch(
+            batch,
+            start_index=start_sent - 1,
+            genfact_pool=genfact_pool,
+            max_in_flight=max_in_flight,
+            write_sections_to=sections_path,
+            finished=finished,
+        )
 
+        if n_done < len(batch):
+            logger.info('TIMEOUT on batch %d after %d of %d sentences', batch_no, n_done, len(batch))
+            sizer.on_timeout()
+            n_stalled = n_stalled + 1 if n_done == 0 else 0
+            if n_stalled >= MAX_STALLED_BATCHES:
+                raise RuntimeError(
+                    f'Sentence {start_sent} timed out in {n_stalled} batches in a row, even after restarting Genparse'
+                )
+        else:
+            sizer.on_success()
+            n_stalled = 0
+
+        if n_done > 0:
+            end_sent = start_sent + n_done
+            html_path = save_outputs_to / f'genfact_batch{batch_no}_of_expected_{expected_batch_total}.html'
+            write_batch_html(sections_path, html_path, batch_no=batch_no, start_sent=start_sent, end_sent=end_sent)
+            logger.info('Wrote results for batch %d to %s', batch_no, html_path)
+            start_sent = end_sent
+            batch_no += 1
+        else:
+            sections_path.unlink()
 
+        if start_sent <= len(sentences):
+            logger.info('Restarting Genparse servers at %s', ', '.join(genparse_ips))
+            restart_servers(genparse_ips)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,209 @@
+"""
+Benchmark JSONL reading and writing with each available JSON backend and compression setting.
+
+By default this benchmarks synthetic records shaped like our Genparse inference dumps (long prompts plus a posterior
+over raw generations). Pass `--data-path` to benchmark on a real JSONL file instead. Results are compared against the
+original implementation (stdlib `json`, text mode, one write call per line piece).
+"""
+from argparse import ArgumentParser
+import json
+import logging
+from pathlib import Path
+import random
+import string
+import tempfile
+from typing import Any, Callable, Iterator, Optional, Sequence
+
+from scripts.utils.jsonl import DEFAULT_JSON_BACKEND, JSON_BACKENDS, read_jsonl, set_json_backend, write_jsonl, zstandard
+from scripts.utils.timing import time_best_of
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_N_RECORDS = 10_000
+DEFAULT_N_TRIALS = 3
+DEFAULT_SEED = 42
+BYTES_PER_MIB = 1024 ** 2
+
+
+def make_synthetic_records(n_records: int, *, seed: int) -> list[dict[str, Any]]:
+    """
+    Make records shaped roughly like the output of `infer_genfact.py`.
+    """
+    rng = random.Random(seed)
+
+    def text(length: int) -> str:
+        return "".join(rng.choices(string.ascii_letters + " ", k=length))
+
+    prompt = text(2000)
+    result = []
+    for _ in range(n_records):
+        sentence = text(rng.randint(60, 200))
+        result.append({
+            "sentence": sentence,
+            "prompt": prompt,
+            "generation_features": {"Provider Last Name": text(8), "City/Town": text(10)},
+            "raw_genparse_output": {
+                f"<|start_header_id|>assistant<|end_header_id|>{{\"first\": \"{text(6)}\", \"last\": \"{text(8)}\"}}":
+                    rng.random()
+                for _ in range(15)
+            },
+            "extracted_info": {"names": [text(12)], "cities": [text(10)]},
+            "genparse_prompt": prompt + sentence,
+        })
+    return result
+
+
+def _baseline_read_jsonl(jsonl_path: Path) -> Iterator[dict[str, Any]]:
+    """The original `read_jsonl` implementation."""
+    with jsonl_path.open(mode="r", encoding="utf-8") as jsonl_in:
+        for line in jsonl_in:
+            yield json.loads(line.strip())
+
+
+def _baseline_write_jsonl(data: Sequence[dict[str, Any]], write_to_path: Path) -> int:
+    """The original `write_jsonl` implementation."""
+    result = 0
+    with write_to_path.open(mode="w", encoding="utf-8") as jsonl_out:
+        for datum in data:
+            jsonl_out.write(json.dumps(datum))
+            jsonl_out.write("\n")
+            result += 1
+    return result
+
+
+def benchmark(
+    records: Sequence[dict[str, Any]],
+    *,
+    read: Callable[[Path], Iterator[dict[str, Any]]],
+    write: Callable[[Sequence[dict[str, Any]], Path], int],
+    path: Path,
+    n_trials: int,
+) -> dict[str, float]:
+    """
+    Time writing the records to the path and reading them back.
+    """
+    write_s = time_best_of(lambda: write(records, path), n_trials)
+    read_s = time_best_of(lambda: sum(1 for _ in read(path)), n_trials)
+    return {"write_s": write_s, "read_s": read_s, "size_mib": path.stat().st_size / BYTES_PER_MIB}
+
+
+def format_markdown_table(results: list[dict[str, Any]]) -> str:
+    """
+    Format benchmark results as a GitHub Flavored Markdown table.
+    """
+    baseline = results[0]
+    headers = ["Backend", "Compression", "File size (MiB)", "Write (s)", "Read (s)", "Write speedup", "Read speedup"]
+    lines = ["| " + " | ".join(headers) + " |", "| " + " | ".join("-" * len(header) for header in headers) + " |"]
+    for result in results:
+        row = [
+            result["backend"],
+            result["compression"],
+            f"{result['size_mib']:.1f}",
+            f"{result['write_s']:.3f}",
+            f"{result['read_s']:.3f}",
+            f"{baseline['write_s'] / result['write_s']:.2f}x",
+            f"{baseline['read_s'] / result['read_s']:.2f}x",
+        ]
+        lines.append("| " + " | ".join(row) + " |")
+    return "\n".join(lines)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--data-path",
+        type=Path,
+        default=None,
+        help="JSONL file to benchmark on. If none, use synthetic inference-like records.",
+    )
+    parser.add_argument(
+        "--n-records",
+        type=int,
+        default=DEFAULT_N_RECORDS,
+        help="Number of synthetic records to benchmark on.",
+    )
+    parser.add_argument(
+        "--n-trials",
+        type=int,
+        default=DEFAULT_N_TRIALS,
+        help="Number of times to repeat each measurement. We report the fastest.",
+    )
+    parser.add_argument(
+        "--random-seed",
+        type=int,
+        default=DEFAULT_SEED,
+        help="Seed for generating synthetic records.",
+    )
+    parser.add_argument(
+        "--logging-level",
+        type=str,
+        default="INFO",
+        help="Logging level to use.",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=getattr(logging, args.logging_level),
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+    data_path: Optional[Path] = args.data_path
+    n_records: int = args.n_records
+    n_trials: int = args.n_trials
+    random_seed: int = args.random_seed
+
+    assert n_records > 0
+    assert n_trials > 0
+
+    if data_path is not None:
+        records = list(_baseline_read_jsonl(data_path))
+        logger.info("Loaded %d records from `%s`", len(records), data_path)
+    else:
+        records = make_synthetic_records(n_records, seed=random_seed)
+        logger.info("Generated %d synthetic records", len(records))
+
+    suffixes = {"none": ".jsonl", "gzip": ".jsonl.gz"}
+    if zstandard is not None:
+        suffixes["zstd"] = ".jsonl.zst"
+
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_path = Path(temp_dir)
+        logger.info("Benchmarking baseline implementation")
+        results.append({
+            "backend": "baseline (json)",
+            "compression": "none",
+            **benchmark(
+                records,
+                read=_baseline_read_jsonl,
+                write=_baseline_write_jsonl,
+                path=temp_path / "baseline.jsonl",
+                n_trials=n_trials,
+            ),
+        })
+        for backend in JSON_BACKENDS:
+            set_json_backend(backend)
+            for compression, suffix in suffixes.items():
+                logger.info("Benchmarking backend %s with compression %s", backend, compression)
+                results.append({
+                    "backend": backend,
+                    "compression": compression,
+                    **benchmark(
+                        records,
+                        read=read_jsonl,
+                        write=write_jsonl,
+                        path=temp_path / f"{backend}{suffix}",
+                        n_trials=n_trials,
+                    ),
+                })
+        set_json_backend(DEFAULT_JSON_BACKEND)
+
+    print(format_markdown_table(results))
+    logger.info("Done.")
+
+
+if __name__ == "__main__":
+    main()
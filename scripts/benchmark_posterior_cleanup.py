@@ -0,0 +1,246 @@
+"""
+Benchmark cleaning up Genparse posteriors with the single-pass and two-pass implementations.
+
+Pass `--data-path` to benchmark on the `raw_genparse_output` posteriors in an output file of `infer_genfact.py`.
+Otherwise we benchmark synthetic posteriors with each of the `--n-particles` sizes. Synthetic inferences are drawn from
+a small set of names, with varying whitespace and key order and some malformed outputs, like real Genparse output.
+"""
+from argparse import ArgumentParser
+import json
+import logging
+from pathlib import Path
+import random
+import string
+from typing import Any, Optional, Sequence
+
+from scripts.utils.genparse_output import (
+    ASSISTANT_HEADER,
+    cleanup_genparse_output,
+    normalize_json_object,
+    sort_posterior,
+)
+from scripts.utils.jsonl import read_jsonl
+from scripts.utils.timing import time_best_of
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_N_PARTICLES = (15, 100, 500)
+DEFAULT_N_POSTERIORS = 200
+DEFAULT_N_TRIALS = 3
+DEFAULT_SEED = 42
+N_DISTINCT_NAMES = 5
+MALFORMED_FRACTION = 0.1
+
+
+# Translated from GenFact server code, src/genparse/extract_entities.jl.
+# Current as of 8895efe5f5e51d5bfdd0300d8d4ffd7e0568f2aa
+def _aggregate_identical_json(posterior: dict[str, float]) -> dict[str, float]:
+    """Convert a raw-JSON posterior into a normalized-JSON posterior.
+
+    The posterior should be a dict-like object mapping strings-like objects (unparsed JSON) to float-likes.
+    This returns a value in the same format.
+    """
+    result = {}
+    for inference, likelihood in posterior.items():
+        normalized = normalize_json_object(inference)
+        result.setdefault(normalized, 0.0)
+        result[normalized] += likelihood
+    return sort_posterior(result)
+
+
+
+class NotCodeError(Exception):
+    pass
+
+
+
+# Translated from GenFact server code, src/genparse/extract_entities.jl,
+# the function extract_code_from_response(text::String)::String.
+# Current as of 8895efe5f5e51d5bfdd0300d8d4ffd7e0568f2aa
+def _extract_code_from_inference(text: str) -> str:
+    """Extract code from the code block in a chatty Genparse generation."""
+    result = text.strip().removeprefix(ASSISTANT_HEADER)
+    try:
+        json.loads(result)
+    except json.decoder.JSONDecodeError as e:
+	    raise NotCodeError("Not formatted properly -- expected chat turn prefix followed by JSON.") from e
+    return result
+
+
+# Translated from GenFact server code, src/genparse/extract_entities.jl.
+# Current as of 8895efe5f5e51d5bfdd0300d8d4ffd7e0568f2aa
+def _get_aggregate_likelihoods(posterior: dict[str, float]) -> dict[str, float]:
+    """Convert a raw-text posterior into a code-only posterior.
+
+    This extracts the code block from each inference and aggregates the likelihoods from identical code blocks.
+
+    The posterior should be a dict-like object mapping strings-like objects to float-likes.
+    This returns a value in the same format.
+    """
+    result = {}
+    n_nocode = 0
+    nocode_likelihood = 0.0
+    for inference, likelihood in posterior.items():
+        try:
+            code_only = _extract_code_from_inference(inference)
+        except NotCodeError as e:
+            logger.debug("Inference is not code: `%s`", inference)
+            n_nocode += 1
+            nocode_likelihood += likelihood
+        else:
+            result.setdefault(code_only, 0.0)
+            result[code_only] += likelihood
+
+    for inference in result.keys():
+        result[inference] += nocode_likelihood / max(n_nocode, 1)
+
+    assert result
+
+    return sort_posterior(result)
+
+
+
+def cleanup_genparse_output_two_pass(posterior: dict[str, float]) -> dict[str, float]:
+    """
+    Clean up Genparse output the same way as `cleanup_genparse_output`, but step by step like the GenFact server.
+
+    This parses each inference twice and sorts twice, which is what the single-pass version avoids.
+
+    This attempts to imitate what the GenFact server does to clean up the Genparse output as of 2024-09-10.
+    It does not attempt to perform PClean-related cleanup, because for evaluation purposes we don't need that for our
+    pure information extraction evaluation. This therefore only filters for actual JSON respones and aggregates
+    likelihoods over functionally identical outputs.
+    """
+    return _aggregate_identical_json(_get_aggregate_likelihoods(posterior))
+
+
+def make_synthetic_posterior(n_particles: int, *, rng: random.Random) -> dict[str, float]:
+    """
+    Make a posterior shaped like raw Genparse output with (up to) `n_particles` distinct inferences.
+    """
+    names = ["".join(rng.choices(string.ascii_lowercase, k=8)).title() for _ in range(N_DISTINCT_NAMES)]
+    result = {}
+    for _ in range(n_particles):
+        if rng.random() < MALFORMED_FRACTION:
+            inference = ASSISTANT_HEADER + '{"last": "' + rng.choice(names)
+        else:
+            fields = [f'"last": "{rng.choice(names)}"', f'"city_name": "{rng.choice(names)}"']
+            rng.shuffle(fields)
+            separator = "," + " " * rng.randint(0, 2)
+            inference = ASSISTANT_HEADER + "{" + separator.join(fields) + "}" + " " * rng.randint(0, 3)
+        result[inference] = result.get(inference, 0.0) + 1 / n_particles
+    return result
+
+
+def benchmark(label: str, posteriors: Sequence[dict[str, float]], *, n_trials: int) -> dict[str, Any]:
+    """
+    Time both implementations on the posteriors, checking that they agree.
+    """
+    for posterior in posteriors:
+        if cleanup_genparse_output(posterior) != cleanup_genparse_output_two_pass(posterior):
+            raise AssertionError(f"Implementations disagree on posterior: {posterior}")
+    two_pass_s = time_best_of(lambda: [cleanup_genparse_output_two_pass(p) for p in posteriors], n_trials)
+    single_pass_s = time_best_of(lambda: [cleanup_genparse_output(p) for p in posteriors], n_trials)
+    return {
+        "label": label,
+        "mean_inferences": sum(len(posterior) for posterior in posteriors) / len(posteriors),
+        "two_pass_ms": 1000 * two_pass_s / len(posteriors),
+        "single_pass_ms": 1000 * single_pass_s / len(posteriors),
+    }
+
+
+def format_markdown_table(results: list[dict[str, Any]]) -> str:
+    """
+    Format benchmark results as a GitHub Flavored Markdown table.
+    """
+    headers = ["Data", "Mean inferences", "Two-pass (ms/posterior)", "Single-pass (ms/posterior)", "Speedup"]
+    lines = ["| " + " | ".join(headers) + " |", "| " + " | ".join("-" * len(header) for header in headers) + " |"]
+    for result in results:
+        row = [
+            result["label"],
+            f"{result['mean_inferences']:.1f}",
+            f"{result['two_pass_ms']:.4f}",
+            f"{result['single_pass_ms']:.4f}",
+            f"{result['two_pass_ms'] / result['single_pass_ms']:.2f}x",
+        ]
+        lines.append("| " + " | ".join(row) + " |")
+    return "\n".join(lines)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--data-path",
+        type=Path,
+        default=None,
+        help="Output JSONL from `infer_genfact.py` to benchmark on. If none, use synthetic posteriors.",
+    )
+    parser.add_argument(
+        "--n-particles",
+        type=int,
+        nargs="+",
+        default=list(DEFAULT_N_PARTICLES),
+        help="Sizes of synthetic posteriors to benchmark.",
+    )
+    parser.add_argument(
+        "--n-posteriors",
+        type=int,
+        default=DEFAULT_N_POSTERIORS,
+        help="Number of synthetic posteriors of each size.",
+    )
+    parser.add_argument(
+        "--n-trials",
+        type=int,
+        default=DEFAULT_N_TRIALS,
+        help="Number of times to repeat each measurement. We report the fastest.",
+    )
+    parser.add_argument(
+        "--random-seed",
+        type=int,
+        default=DEFAULT_SEED,
+        help="Seed for generating synthetic posteriors.",
+    )
+    parser.add_argument(
+        "--logging-level",
+        type=str,
+        default="INFO",
+        help="Logging level to use.",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=getattr(logging, args.logging_level),
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+    data_path: Optional[Path] = args.data_path
+    n_particles: list[int] = args.n_particles
+    n_posteriors: int = args.n_posteriors
+    n_trials: int = args.n_trials
+    random_seed: int = args.random_seed
+
+    assert all(n > 0 for n in n_particles)
+    assert n_posteriors > 0
+    assert n_trials > 0
+
+    results = []
+    if data_path is not None:
+        posteriors = [datum["raw_genparse_output"] for datum in read_jsonl(data_path)]
+        logger.info("Loaded %d posteriors from `%s`", len(posteriors), data_path)
+        results.append(benchmark(data_path.name, posteriors, n_trials=n_trials))
+    else:
+        rng = random.Random(random_seed)
+        for n in n_particles:
+            logger.info("Benchmarking %d synthetic posteriors with %d particles", n_posteriors, n)
+            posteriors = [make_synthetic_posterior(n, rng=rng) for _ in range(n_posteriors)]
+            results.append(benchmark(f"synthetic, {n} particles", posteriors, n_trials=n_trials))
+
+    print(format_markdown_table(results))
+    logger.info("Done.")
+
+
+if __name__ == "__main__":
+    main()
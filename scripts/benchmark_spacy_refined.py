@@ -1,18 +1,27 @@
 """
 A script for benchmarking spaCy and ReFinED speed and memory usage.
 
+Each dataset in the benchmark config may list `batch_sizes` and `n_processes` to sweep over. We write one row per
+configuration, plus a summary of the throughput-optimal and latency-optimal configuration for each system.
+
+Model memory is measured by loading each model in fresh subprocesses and recording the growth in tracemalloc, RSS and
+USS side by side, both what stays allocated after loading and the peak while loading, which is what a container must
+provision for. tracemalloc alone misses the native allocations made by torch and thinc, and runs in a subprocess of
+its own so that its bookkeeping doesn't inflate RSS and USS.
+
 https://linear.app/chi-fro/issue/FACT-57/benchmark-spacy-and-refined
 """
 from argparse import ArgumentParser
 import csv
 from dataclasses import dataclass
+from functools import partial
+import itertools
 from pathlib import Path
 import json
 import logging
-import math
-import timeit
+import time
 import tracemalloc
-from typing import Any
+from typing import Any, Callable, Iterator, Optional, Sequence
 
 import numpy as np
 from refined.inference.processor import Refined
@@ -20,18 +29,26 @@ import spacy
 import torch
 
 from scripts.utils.jsonl import read_jsonl
+from scripts.utils.memory_probes import DEFAULT_PROBES, PROBES, MemoryMeasurement, measure_in_subprocess
 
 
 logger = logging.getLogger(__name__)
 
 
 BYTES_PER_MIB = 1024 ** 2
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_N_WARMUP_BATCHES = 2
+DEFAULT_N_TRIALS = 5
+DEFAULT_N_PROCESS = 1
 
 
 @dataclass
 class DatasetConfig:
     path: Path
     claim_key: str
+    # Batch sizes and spaCy process counts to sweep over. If not given, we use the command line values.
+    batch_sizes: Optional[list[int]] = None
+    n_processes: Optional[list[int]] = None
 
 
 @dataclass
@@ -39,9 +56,41 @@ class BenchmarkConfig:
     datasets: dict[str, DatasetConfig]
 
 
+@dataclass
+class SystemUnderTest:
+    """A configured system (spaCy or ReFinED on some device) that we can time."""
+
+    system: str
+    model: str
+    used_gpu: bool
+    # Memory measured by loading the model on CPU in a subprocess.
+    model_memory: MemoryMeasurement
+    # Picklable functions to load the model on CPU and to make a batch processing function from the loaded model, used
+    # to measure memory in a subprocess.
+    load_model: Callable[[], Any]
+    make_process_batches: Callable[[Any], Callable[[Sequence[list[str]], int], Iterator[Any]]]
+    # Takes a list of batches and a number of processes, and yields one output per batch in order. If given an
+    # `on_submit` callback, calls it with each batch's index when the system takes that batch's first claim.
+    process_batches: Callable[[Sequence[list[str]], int], Iterator[Any]]
+    supports_multiprocessing: bool = False
+
+
 @dataclass
 class BenchmarkResult:
+    """Timing and memory measurements for one system on one dataset."""
+
     dataset_name: str
+    batch_size: int
+    n_process: int
+    # Each timed batch's time between coming out of the system and the one before it, divided by its size. This is the
+    # amortized cost per claim, which falls as throughput rises, not the latency any one claim sees.
+    per_claim_times_s: list[float]
+    # Each timed batch's time from the system taking its first claim to its output coming out.
+    batch_latencies_s: list[float]
+    trial_claims_per_second: list[float]
+    # Time from starting each trial to its first output, which includes starting worker processes and loading models.
+    trial_startup_times_s: list[float]
+    per_claim_peaks_bytes: list[float]
 
 
 DATASET_COLUMN = "Dataset"
@@ -49,10 +98,21 @@ SYSTEM_COLUMN = "System (spaCy/ReFinED)"
 MODEL_COLUMN = "Model"
 GPU_COLUMN = "GPUs"
 BATCH_SIZE_COLUMN = "Claim processing batch size"
+N_PROCESS_COLUMN = "# processes"
+
+N_TRIALS_COLUMN = "# timed trials"
+N_WARMUP_BATCHES_COLUMN = "# warm-up batches"
 
 AVG_RUNTIME_PER_CLAIM_COLUMN = "Avg. running time per claim (ms)"
 MAX_RUNTIME_PER_CLAIM_COLUMN = "Max running time per claim (ms)"
-MODEL_MEMORY_COLUMN = "Model memory usage (MiB)"
+P50_RUNTIME_PER_CLAIM_COLUMN = "p50 running time per claim (ms)"
+P95_RUNTIME_PER_CLAIM_COLUMN = "p95 running time per claim (ms)"
+P99_RUNTIME_PER_CLAIM_COLUMN = "p99 running time per claim (ms)"
+CLAIMS_PER_SECOND_COLUMN = "Throughput (claims/s)"
+P50_BATCH_LATENCY_COLUMN = "p50 batch completion latency (ms)"
+P95_BATCH_LATENCY_COLUMN = "p95 batch completion latency (ms)"
+P99_BATCH_LATENCY_COLUMN = "p99 batch completion latency (ms)"
+STARTUP_TIME_COLUMN = "Time to first batch incl. worker startup (ms)"
 PEAK_PROCESSING_MEMORY_COLUMN = "Peak processing memory usage (bytes) @ this batch size"
 
 N_DATASET_CLAIMS_COLUMN = "# dataset claims"
@@ -71,11 +131,21 @@ BENCHMARK_COLUMNS = (
     MODEL_COLUMN,
     GPU_COLUMN,
     BATCH_SIZE_COLUMN,
+    N_PROCESS_COLUMN,
+    N_TRIALS_COLUMN,
+    N_WARMUP_BATCHES_COLUMN,
 
     # Performance measures
     AVG_RUNTIME_PER_CLAIM_COLUMN,
     MAX_RUNTIME_PER_CLAIM_COLUMN,
-    MODEL_MEMORY_COLUMN,
+    P50_RUNTIME_PER_CLAIM_COLUMN,
+    P95_RUNTIME_PER_CLAIM_COLUMN,
+    P99_RUNTIME_PER_CLAIM_COLUMN,
+    CLAIMS_PER_SECOND_COLUMN,
+    P50_BATCH_LATENCY_COLUMN,
+    P95_BATCH_LATENCY_COLUMN,
+    P99_BATCH_LATENCY_COLUMN,
+    STARTUP_TIME_COLUMN,
     PEAK_PROCESSING_MEMORY_COLUMN,
 
     # Dataset info
@@ -90,6 +160,49 @@ BENCHMARK_COLUMNS = (
 )
 
 
+def model_memory_column(probe_name: str) -> str:
+    """Get the column name for model memory usage as measured by the given probe."""
+    return f"Model memory usage, {probe_name} (MiB)"
+
+
+def model_peak_memory_column(probe_name: str) -> str:
+    """Get the column name for peak memory usage while loading the model as measured by the given probe."""
+    return f"Peak model loading memory usage, {probe_name} (MiB)"
+
+
+def processing_memory_column(probe_name: str) -> str:
+    """Get the column name for isolated peak processing memory usage as measured by the given probe."""
+    return f"Peak processing memory usage, {probe_name} (MiB) @ this batch size"
+
+
+def benchmark_columns(probe_names: Sequence[str], *, probe_processing_memory: bool) -> list[str]:
+    """
+    Get the results CSV columns, including memory columns for each probe we use.
+    """
+    memory_columns = [model_memory_column(name) for name in probe_names]
+    memory_columns.extend(model_peak_memory_column(name) for name in probe_names)
+    if probe_processing_memory:
+        memory_columns.extend(processing_memory_column(name) for name in probe_names)
+    insert_at = BENCHMARK_COLUMNS.index(PEAK_PROCESSING_MEMORY_COLUMN)
+    return [*BENCHMARK_COLUMNS[:insert_at], *memory_columns, *BENCHMARK_COLUMNS[insert_at:]]
+
+
+OBJECTIVE_COLUMN = "Objective"
+THROUGHPUT_OBJECTIVE = "Max throughput"
+LATENCY_OBJECTIVE = "Min p95 batch latency"
+SUMMARY_COLUMNS = (
+    DATASET_COLUMN,
+    SYSTEM_COLUMN,
+    MODEL_COLUMN,
+    GPU_COLUMN,
+    OBJECTIVE_COLUMN,
+    BATCH_SIZE_COLUMN,
+    N_PROCESS_COLUMN,
+    CLAIMS_PER_SECOND_COLUMN,
+    P95_BATCH_LATENCY_COLUMN,
+)
+
+
 def resolve_relative_to(maybe_relative: Path, root: Path) -> Path:
     return (maybe_relative if maybe_relative.is_absolute() else root / maybe_relative).resolve()
 
@@ -104,7 +217,12 @@ def load_benchmark_config(benchmark_config_path: Path) -> BenchmarkConfig:
     resolve_relative_to_ = benchmark_config_path.resolve().parent
     result = BenchmarkConfig(
         datasets={
-            dataset_name: DatasetConfig(path=resolve_relative_to(Path(dataset_config["path"]), resolve_relative_to_), claim_key=dataset_config["claim_key"])
+            dataset_name: DatasetConfig(
+                path=resolve_relative_to(Path(dataset_config["path"]), resolve_relative_to_),
+                claim_key=dataset_config["claim_key"],
+                batch_sizes=dataset_config.get("batch_sizes"),
+                n_processes=dataset_config.get("n_processes"),
+            )
             for dataset_name, dataset_config in raw["datasets"].items()
         }
     )
@@ -121,6 +239,253 @@ def load_json(path: Path) -> list[dict[str, Any]]:
     return result
 
 
+def make_batches(claims: Sequence[str], batch_size: int) -> list[list[str]]:
+    """
+    Split the claims into consecutive batches of `batch_size` (the last batch may be smaller).
+    """
+    return [list(claims[start:start + batch_size]) for start in range(0, len(claims), batch_size)]
+
+
+def spacy_process_batches(nlp: spacy.Language) -> Callable[[Sequence[list[str]], int], Iterator[Any]]:
+    """
+    Make a batch processing function for the given spaCy pipeline.
+
+    We stream all the batches through a single `nlp.pipe` call so that worker processes are started once rather than
+    once per batch. `nlp.pipe` is lazy, so we consume each batch's docs before yielding, otherwise we'd be timing the
+    creation of a generator.
+    """
+    def process_batches(
+        batches: Sequence[list[str]],
+        n_process: int,
+        on_submit: Optional[Callable[[int], None]] = None,
+    ) -> Iterator[Any]:
+        def claims() -> Iterator[str]:
+            for batch_no, batch in enumerate(batches):
+                if on_submit is not None:
+                    on_submit(batch_no)
+                yield from batch
+
+        docs = nlp.pipe(
+            claims(),
+            batch_size=max(len(batch) for batch in batches),
+            n_process=n_process,
+        )
+        for batch in batches:
+            yield list(itertools.islice(docs, len(batch)))
+
+    return process_batches
+
+
+def load_spacy(spacy_model: str) -> spacy.Language:
+    """
+    Load a spaCy model on CPU.
+    """
+    spacy.require_cpu()
+    return spacy.load(spacy_model)
+
+
+def load_refined(refined_model: str, refined_entity_set: str, device: str = "cpu") -> Refined:
+    """
+    Load a ReFinED model on the given device.
+    """
+    return Refined.from_pretrained(model_name=refined_model, entity_set=refined_entity_set, device=device)
+
+
+def consume_batches(
+    model: Any,
+    *,
+    make_process_batches: Callable[[Any], Callable[[Sequence[list[str]], int], Iterator[Any]]],
+    batches: Sequence[list[str]],
+) -> None:
+    """
+    Process all the batches with the given model in a single process, discarding the outputs.
+    """
+    for _ in make_process_batches(model)(batches, 1):
+        pass
+
+
+def refined_process_batches(refined: Refined) -> Callable[[Sequence[list[str]], int], Iterator[Any]]:
+    """
+    Make a batch processing function for the given ReFinED model.
+
+    ReFinED doesn't support multiprocessing, so this ignores the process count.
+    """
+    def process_batches(
+        batches: Sequence[list[str]],
+        _n_process: int,
+        on_submit: Optional[Callable[[int], None]] = None,
+    ) -> Iterator[Any]:
+        for batch_no, batch in enumerate(batches):
+            if on_submit is not None:
+                on_submit(batch_no)
+            yield refined.process_text_batch(batch)
+
+    return process_batches
+
+
+def benchmark_system(
+    system: SystemUnderTest,
+    batches: Sequence[list[str]],
+    *,
+    dataset_name: str,
+    n_process: int,
+    n_warmup_batches: int,
+    n_trials: int,
+) -> BenchmarkResult:
+    """
+    Time the given system on the batches, then separately measure its peak processing memory.
+
+    We run `n_trials` passes over all the batches. Each pass is a single call to the system, which first processes
+    `n_warmup_batches` untimed batches, so that for multiprocess runs the warm-up goes through the same worker
+    processes as the timed batches. Worker startup and model loading thus land in the warm-up, and we report the time
+    to the first batch separately.
+
+    For each timed batch we record two things. Its completion latency is the time from the system taking its first
+    claim to its output coming out, which includes any time spent queued behind other batches in worker processes.
+    Its time per claim is the time between it and the previous batch coming out, divided by its size, which is the
+    amortized cost behind throughput rather than a latency.
+
+    Memory is measured in a final untimed pass since tracing allocations slows everything down.
+    """
+    all_batches = [*batches[:n_warmup_batches], *batches]
+    n_claims = sum(len(batch) for batch in batches)
+    per_claim_times_s = []
+    batch_latencies_s = []
+    trial_claims_per_second = []
+    trial_startup_times_s = []
+    for trial_no in range(1, n_trials + 1):
+        logger.info(
+            "Timing %s (GPU: %s, batch size %d, %d processes), trial %d / %d",
+            system.system, system.used_gpu, len(batches[0]), n_process, trial_no, n_trials,
+        )
+        submit_times = {}
+
+        def on_submit(batch_no: int) -> None:
+            submit_times[batch_no] = time.perf_counter()
+
+        outputs = system.process_batches(all_batches, n_process, on_submit)
+        start = time.perf_counter()
+        timed_start = last = start
+        for batch_no, (batch, _output) in enumerate(zip(all_batches, outputs)):
+            now = time.perf_counter()
+            if batch_no == 0:
+                trial_startup_times_s.append(now - start)
+            if batch_no < n_warmup_batches:
+                timed_start = now
+            else:
+                per_claim_times_s.append((now - last) / len(batch))
+                batch_latencies_s.append(now - submit_times[batch_no])
+            last = now
+        trial_claims_per_second.append(n_claims / (last - timed_start))
+
+    per_claim_peaks_bytes = []
+    for batch in batches:
+        max_claim_length = max(len(claim) for claim in batch)
+        tracemalloc.start()
+        for _ in system.process_batches([batch], 1):
+            pass
+        _size, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        per_claim_peaks_bytes.append(peak_bytes / (len(batch) * max_claim_length))
+
+    return BenchmarkResult(
+        dataset_name=dataset_name,
+        batch_size=len(batches[0]),
+        n_process=n_process,
+        per_claim_times_s=per_claim_times_s,
+        batch_latencies_s=batch_latencies_s,
+        trial_claims_per_second=trial_claims_per_second,
+        trial_startup_times_s=trial_startup_times_s,
+        per_claim_peaks_bytes=per_claim_peaks_bytes,
+    )
+
+
+def make_result_row(
+    system: SystemUnderTest,
+    result: BenchmarkResult,
+    *,
+    n_warmup_batches: int,
+    n_trials: int,
+    dataset_stats: dict[str, Any],
+    processing_memory: Optional[MemoryMeasurement] = None,
+) -> dict[str, Any]:
+    """
+    Format a benchmark result as a row for the results CSV.
+    """
+    per_claim_times_ms = np.array(result.per_claim_times_s) * 1000.
+    p50, p95, p99 = np.percentile(per_claim_times_ms, [50, 95, 99])
+    latency_p50, latency_p95, latency_p99 = np.percentile(np.array(result.batch_latencies_s) * 1000., [50, 95, 99])
+    return {
+        DATASET_COLUMN: result.dataset_name,
+        SYSTEM_COLUMN: system.system,
+        MODEL_COLUMN: system.model,
+        GPU_COLUMN: system.used_gpu,
+        BATCH_SIZE_COLUMN: result.batch_size,
+        N_PROCESS_COLUMN: result.n_process,
+        N_TRIALS_COLUMN: n_trials,
+        N_WARMUP_BATCHES_COLUMN: n_warmup_batches,
+        AVG_RUNTIME_PER_CLAIM_COLUMN: np.mean(per_claim_times_ms),
+        MAX_RUNTIME_PER_CLAIM_COLUMN: np.max(per_claim_times_ms),
+        P50_RUNTIME_PER_CLAIM_COLUMN: p50,
+        P95_RUNTIME_PER_CLAIM_COLUMN: p95,
+        P99_RUNTIME_PER_CLAIM_COLUMN: p99,
+        CLAIMS_PER_SECOND_COLUMN: np.median(result.trial_claims_per_second),
+        P50_BATCH_LATENCY_COLUMN: latency_p50,
+        P95_BATCH_LATENCY_COLUMN: latency_p95,
+        P99_BATCH_LATENCY_COLUMN: latency_p99,
+        STARTUP_TIME_COLUMN: np.median(result.trial_startup_times_s) * 1000.,
+        **{
+            model_memory_column(name): n_bytes / BYTES_PER_MIB
+            for name, n_bytes in system.model_memory.load_bytes.items()
+        },
+        **{
+            model_peak_memory_column(name): n_bytes / BYTES_PER_MIB
+            for name, n_bytes in system.model_memory.load_peak_bytes.items()
+        },
+        **{
+            processing_memory_column(name): n_bytes / BYTES_PER_MIB
+            for name, n_bytes in (processing_memory.work_peak_bytes if processing_memory else {}).items()
+        },
+        PEAK_PROCESSING_MEMORY_COLUMN: np.mean(result.per_claim_peaks_bytes),
+        **dataset_stats,
+    }
+
+
+def summarize_results(rows: Sequence[dict[str, Any]]) -> list[dict[str, Any]]:
+    """
+    Pick out the throughput-optimal and latency-optimal configurations for each dataset and system.
+
+    Throughput-optimal means the most claims per second. Latency-optimal means the lowest p95 batch completion latency,
+    since the time per claim is amortized over the batch and so just falls as throughput rises.
+    """
+    by_system = {}
+    for row in rows:
+        key = (row[DATASET_COLUMN], row[SYSTEM_COLUMN], row[MODEL_COLUMN], row[GPU_COLUMN])
+        by_system.setdefault(key, []).append(row)
+
+    result = []
+    for system_rows in by_system.values():
+        for objective, best in [
+            (THROUGHPUT_OBJECTIVE, max(system_rows, key=lambda row: row[CLAIMS_PER_SECOND_COLUMN])),
+            (LATENCY_OBJECTIVE, min(system_rows, key=lambda row: row[P95_BATCH_LATENCY_COLUMN])),
+        ]:
+            result.append({
+                **{column: best[column] for column in SUMMARY_COLUMNS if column in best},
+                OBJECTIVE_COLUMN: objective,
+            })
+    return result
+
+
+def write_csv(rows: Sequence[dict[str, Any]], path: Path, *, fieldnames: Sequence[str]) -> None:
+    """
+    Write the rows to the given path as CSV.
+    """
+    with path.open(mode="w", encoding="utf-8", newline="") as csv_out:
+        writer = csv.DictWriter(csv_out, fieldnames=fieldnames, dialect=csv.excel)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
 def main():
     parser = ArgumentParser(description=__doc__)
     parser.add_argument(
@@ -135,10 +500,50 @@ def main():
     )
     parser.add_argument(
         "--batch-size",
-        default=64,
+        default=DEFAULT_BATCH_SIZE,
         type=int,
         help="Number of claims to process in one batch. For fair comparison spaCy and ReFinED use the same batch "
-        "size.",
+        "size. Datasets can override this with a `batch_sizes` list to sweep over.",
+    )
+    parser.add_argument(
+        "--n-process",
+        default=DEFAULT_N_PROCESS,
+        type=int,
+        help="Number of processes for spaCy to use. Datasets can override this with an `n_processes` list to sweep "
+        "over. ReFinED and GPU runs always use one process.",
+    )
+    parser.add_argument(
+        "--memory-probes",
+        nargs="+",
+        choices=sorted(PROBES),
+        default=list(DEFAULT_PROBES),
+        help="Which memory measures to record for each model.",
+    )
+    parser.add_argument(
+        "--probe-processing-memory",
+        action="store_true",
+        help="Also measure peak processing memory for each dataset, system and batch size in a fresh subprocess. "
+        "This reloads the model for every configuration, so it is slow.",
+    )
+    parser.add_argument(
+        "--save-summary-to",
+        type=Path,
+        default=None,
+        help="Where to save the CSV summary of the best configuration per system. Defaults to the results path with "
+        "a `_summary` suffix.",
+    )
+    parser.add_argument(
+        "--n-warmup-batches",
+        default=DEFAULT_N_WARMUP_BATCHES,
+        type=int,
+        help="Number of untimed batches to run at the start of each timed pass, through the same worker processes as "
+        "the timed batches. With none, worker startup lands in the first timed batch.",
+    )
+    parser.add_argument(
+        "--n-trials",
+        default=DEFAULT_N_TRIALS,
+        type=int,
+        help="Number of timed passes over each dataset per system.",
     )
     parser.add_argument(
         "--spacy-model",
@@ -166,6 +571,14 @@ def main():
     benchmark_config_path: Path = args.benchmark_config_path
     save_results_to: Path = args.save_results_to
     batch_size: int = args.batch_size
+    n_warmup_batches: int = args.n_warmup_batches
+    n_trials: int = args.n_trials
+    n_process: int = args.n_process
+    memory_probes: list[str] = args.memory_probes
+    probe_processing_memory: bool = args.probe_processing_memory
+    save_summary_to: Path = (
+        args.save_summary_to or save_results_to.with_name(f"{save_results_to.stem}_summary{save_results_to.suffix}")
+    )
     spacy_model: str = args.spacy_model
     refined_model: str = args.refined_model
     refined_entity_set: str = args.refined_entity_set
@@ -176,15 +589,22 @@ def main():
         datefmt="%Y-%m-%d %H:%M:%S",
     )
 
+    assert batch_size > 0
+    assert n_warmup_batches >= 0
+    assert n_trials > 0
+    assert n_process > 0
+
     # Load spaCy
-    tracemalloc.start()
-    base_size, _spacy_peak = tracemalloc.get_traced_memory()
-    spacy.require_cpu()
-    nlp = spacy.load(spacy_model)
-    spacy_size, _spacy_peak = tracemalloc.get_traced_memory()
-    tracemalloc.reset_peak()
-    spacy_size = spacy_size - base_size
-    logger.info("Loaded spaCy model `%s` occupying %d bytes", spacy_model, spacy_size)
+    load_spacy_ = partial(load_spacy, spacy_model)
+    spacy_memory = measure_in_subprocess(load_spacy_, probe_names=memory_probes)
+    logger.info(
+        "spaCy model `%s` occupies %s bytes, peaking at %s bytes while loading",
+        spacy_model,
+        spacy_memory.load_bytes,
+        spacy_memory.load_peak_bytes,
+    )
+    nlp = load_spacy_()
+    logger.info("Loaded spaCy model `%s`", spacy_model)
 
     spacy_on_gpu = False
     if torch.cuda.is_available():
@@ -199,36 +619,67 @@ def main():
             spacy_on_gpu = True
 
     # Load ReFinED
-    refined = Refined.from_pretrained(
-        model_name=refined_model,
-        entity_set=refined_entity_set,
-        device="cpu",
-    )
-    refined_size, _refined_peak = tracemalloc.get_traced_memory()
-    tracemalloc.stop()
-    refined_size = refined_size - base_size
+    load_refined_ = partial(load_refined, refined_model, refined_entity_set)
+    refined_memory = measure_in_subprocess(load_refined_, probe_names=memory_probes)
     logger.info(
-        "Loaded ReFinED model `%s` with entity set `%s`, size %d", refined_model, refined_entity_set, refined_size
+        "ReFinED model `%s` with entity set `%s` occupies %s bytes, peaking at %s bytes while loading",
+        refined_model,
+        refined_entity_set,
+        refined_memory.load_bytes,
+        refined_memory.load_peak_bytes,
     )
+    refined = load_refined_()
+    logger.info("Loaded ReFinED model `%s` with entity set `%s`", refined_model, refined_entity_set)
 
     refined_on_gpu = False
     if torch.cuda.is_available():
-        gpu_refined = Refined.from_pretrained(
-            model_name=refined_model,
-            entity_set=refined_entity_set,
-            device="cuda",
-        )
+        gpu_refined = load_refined(refined_model, refined_entity_set, device="cuda")
         logger.info("Loaded ReFinED copy on GPU")
         refined_on_gpu = True
 
+    spacy_info = {
+        "system": "spacy",
+        "model": spacy_model,
+        "model_memory": spacy_memory,
+        "load_model": load_spacy_,
+        "make_process_batches": spacy_process_batches,
+    }
+    refined_info = {
+        "system": "refined",
+        "model": refined_model,
+        "model_memory": refined_memory,
+        "load_model": load_refined_,
+        "make_process_batches": refined_process_batches,
+    }
+    systems = [
+        SystemUnderTest(
+            **spacy_info,
+            used_gpu=False,
+            process_batches=spacy_process_batches(nlp),
+            supports_multiprocessing=True,
+        ),
+    ]
+    if spacy_on_gpu:
+        systems.append(SystemUnderTest(**spacy_info, used_gpu=True, process_batches=spacy_process_batches(gpu_nlp)))
+    systems.append(SystemUnderTest(**refined_info, used_gpu=False, process_batches=refined_process_batches(refined)))
+    if refined_on_gpu:
+        systems.append(
+            SystemUnderTest(**refined_info, used_gpu=True, process_batches=refined_process_batches(gpu_refined))
+        )
+
     benchmark_config = load_benchmark_config(benchmark_config_path)
     logger.info("Loaded benchmark config from %s", benchmark_config_path)
 
     with save_results_to.open(mode="w", encoding="utf-8", newline="") as save_to_file:
         logger.info("Writing to `%s`", save_results_to)
-        writer = csv.DictWriter(save_to_file, fieldnames=BENCHMARK_COLUMNS, dialect=csv.excel)
+        writer = csv.DictWriter(
+            save_to_file,
+            fieldnames=benchmark_columns(memory_probes, probe_processing_memory=probe_processing_memory),
+            dialect=csv.excel,
+        )
         writer.writeheader()
 
+        rows = []
         for dataset_name, dataset_config in benchmark_config.datasets.items():
             claims: list[str] = [
                 row[dataset_config.claim_key] for row in (
@@ -258,131 +709,56 @@ def main():
             }
             logger.info("Getting results for dataset `%s` with %d claims", dataset_name, dataset_stats[N_DATASET_CLAIMS_COLUMN])
 
-            spacy_per_claim_times_s = []
-            refined_per_claim_times_s = []
-            gpu_spacy_per_claim_times_s = []
-            gpu_refined_per_claim_times_s = []
-            spacy_per_claim_peaks_bytes = []
-            refined_per_claim_peaks_bytes = []
-            gpu_spacy_per_claim_peaks_bytes = []
-            gpu_refined_per_claim_peaks_bytes = []
-            for i in range(0, math.ceil(len(claims) / batch_size)):
-                logger.info("Processing batch %d / %d", i + 1, math.ceil(len(claims) / batch_size))
-                batch = claims[i:i * batch_size + batch_size]
-                max_claim_length = max(len(claim) for claim in batch)
-
-                spacy_per_claim_times_s.append(timeit.Timer(lambda: nlp.pipe(batch)).timeit(number=1) / len(batch))
-                refined_per_claim_times_s.append(timeit.Timer(lambda: refined.process_text_batch(batch)).timeit(number=1) / len(batch))
-                if spacy_on_gpu:
-                    gpu_spacy_per_claim_times_s.append(timeit.Timer(lambda: gpu_nlp.pipe(batch)).timeit(number=1) / len(batch))
-                if refined_on_gpu:
-                    gpu_refined_per_claim_times_s.append(timeit.Timer(lambda: gpu_refined.process_text_batch(batch)).timeit(number=1) / len(batch))
-
-                tracemalloc.start()
-                _spacy_docs = nlp.pipe(batch)
-                _spacy_size, spacy_peak_bytes = tracemalloc.get_traced_memory()
-                tracemalloc.stop()
-                spacy_per_claim_peaks_bytes.append(spacy_peak_bytes / (batch_size * max_claim_length))
-
-                tracemalloc.start()
-                _refined_docs = refined.process_text_batch(batch)
-                _refined_size, refined_peak_bytes = tracemalloc.get_traced_memory()
-                tracemalloc.stop()
-                refined_per_claim_peaks_bytes.append(refined_peak_bytes / (batch_size * max_claim_length))
-
-                if spacy_on_gpu:
-                    tracemalloc.start()
-                    _gpu_spacy_docs = gpu_nlp.pipe(batch)
-                    _gpu_spacy_size, gpu_spacy_peak_bytes = tracemalloc.get_traced_memory()
-                    tracemalloc.stop()
-                    gpu_spacy_per_claim_peaks_bytes.append(gpu_spacy_peak_bytes / (batch_size * max_claim_length))
-
-                if refined_on_gpu:
-                    tracemalloc.start()
-                    _gpu_refined_docs = gpu_refined.process_text_batch(batch)
-                    _gpu_refined_size, gpu_refined_peak_bytes = tracemalloc.get_traced_memory()
-                    tracemalloc.stop()
-                    gpu_refined_per_claim_peaks_bytes.append(gpu_refined_peak_bytes / (batch_size * max_claim_length))
-
-            system = "spacy"
-            model = spacy_model
-            used_gpu = False
-            avg_runtime_per_claim_ms = np.mean(spacy_per_claim_times_s) * 1000.
-            max_runtime_per_claim_ms = max(spacy_per_claim_times_s) * 1000.
-            model_memory = spacy_size / BYTES_PER_MIB
-            peak_processing_memory = np.mean(spacy_per_claim_peaks_bytes)
-            writer.writerow({
-                DATASET_COLUMN: dataset_name,
-                SYSTEM_COLUMN: system,
-                MODEL_COLUMN: model,
-                GPU_COLUMN: used_gpu,
-                BATCH_SIZE_COLUMN: batch_size,
-                AVG_RUNTIME_PER_CLAIM_COLUMN: avg_runtime_per_claim_ms,
-                MAX_RUNTIME_PER_CLAIM_COLUMN: max_runtime_per_claim_ms,
-                MODEL_MEMORY_COLUMN: model_memory,
-                PEAK_PROCESSING_MEMORY_COLUMN: peak_processing_memory,
-                **dataset_stats,
-            })
-            if spacy_on_gpu:
-                system = "spacy"
-                model = spacy_model
-                used_gpu = True
-                avg_runtime_per_claim_ms = np.mean(gpu_spacy_per_claim_times_s) * 1000.
-                max_runtime_per_claim_ms = max(gpu_spacy_per_claim_times_s) * 1000.
-                model_memory = spacy_size / BYTES_PER_MIB
-                peak_processing_memory = np.mean(gpu_spacy_per_claim_peaks_bytes)
-                writer.writerow({
-                    DATASET_COLUMN: dataset_name,
-                    SYSTEM_COLUMN: system,
-                    MODEL_COLUMN: model,
-                    GPU_COLUMN: used_gpu,
-                    BATCH_SIZE_COLUMN: batch_size,
-                    AVG_RUNTIME_PER_CLAIM_COLUMN: avg_runtime_per_claim_ms,
-                    MAX_RUNTIME_PER_CLAIM_COLUMN: max_runtime_per_claim_ms,
-                    MODEL_MEMORY_COLUMN: model_memory,
-                    PEAK_PROCESSING_MEMORY_COLUMN: peak_processing_memory,
-                    **dataset_stats,
-                })
-
-            system = "refined"
-            model = refined_model
-            used_gpu = False
-            avg_runtime_per_claim_ms = np.mean(refined_per_claim_times_s) * 1000.
-            max_runtime_per_claim_ms = max(refined_per_claim_times_s) * 1000.
-            model_memory = refined_size / BYTES_PER_MIB
-            peak_processing_memory = np.mean(refined_per_claim_peaks_bytes)
-            writer.writerow({
-                DATASET_COLUMN: dataset_name,
-                SYSTEM_COLUMN: system,
-                MODEL_COLUMN: model,
-                GPU_COLUMN: used_gpu,
-                BATCH_SIZE_COLUMN: batch_size,
-                AVG_RUNTIME_PER_CLAIM_COLUMN: avg_runtime_per_claim_ms,
-                MAX_RUNTIME_PER_CLAIM_COLUMN: max_runtime_per_claim_ms,
-                MODEL_MEMORY_COLUMN: model_memory,
-                PEAK_PROCESSING_MEMORY_COLUMN: peak_processing_memory,
-                **dataset_stats,
-            })
-            if refined_on_gpu:
-                system = "refined"
-                model = refined_model
-                used_gpu = True
-                avg_runtime_per_claim_ms = np.mean(gpu_refined_per_claim_times_s) * 1000.
-                max_runtime_per_claim_ms = max(gpu_refined_per_claim_times_s) * 1000.
-                model_memory = refined_size / BYTES_PER_MIB
-                peak_processing_memory = np.mean(gpu_refined_per_claim_peaks_bytes)
-                writer.writerow({
-                    DATASET_COLUMN: dataset_name,
-                    SYSTEM_COLUMN: system,
-                    MODEL_COLUMN: model,
-                    GPU_COLUMN: used_gpu,
-                    BATCH_SIZE_COLUMN: batch_size,
-                    AVG_RUNTIME_PER_CLAIM_COLUMN: avg_runtime_per_claim_ms,
-                    MAX_RUNTIME_PER_CLAIM_COLUMN: max_runtime_per_claim_ms,
-                    MODEL_MEMORY_COLUMN: model_memory,
-                    PEAK_PROCESSING_MEMORY_COLUMN: peak_processing_memory,
-                    **dataset_stats,
-                })
+            for batch_size_ in dataset_config.batch_sizes or [batch_size]:
+                batches = make_batches(claims, batch_size_)
+                for system in systems:
+                    processing_memory = None
+                    if probe_processing_memory and not system.used_gpu:
+                        logger.info("Measuring %s processing memory at batch size %d", system.system, batch_size_)
+                        processing_memory = measure_in_subprocess(
+                            system.load_model,
+                            partial(
+                                consume_batches, make_process_batches=system.make_process_batches, batches=batches
+                            ),
+                            probe_names=memory_probes,
+                        )
+                    n_processes = (dataset_config.n_processes or [n_process]) if system.supports_multiprocessing else [1]
+                    for n_process_ in n_processes:
+                        result = benchmark_system(
+                            system,
+                            batches,
+                            dataset_name=dataset_name,
+                            n_process=n_process_,
+                            n_warmup_batches=n_warmup_batches,
+                            n_trials=n_trials,
+                        )
+                        row = make_result_row(
+                            system,
+                            result,
+                            n_warmup_batches=n_warmup_batches,
+                            n_trials=n_trials,
+                            dataset_stats=dataset_stats,
+                            processing_memory=processing_memory,
+                        )
+                        writer.writerow(row)
+                        save_to_file.flush()
+                        rows.append(row)
+
+    summary = summarize_results(rows)
+    write_csv(summary, save_summary_to, fieldnames=SUMMARY_COLUMNS)
+    logger.info("Wrote summary of best configurations to `%s`", save_summary_to)
+    for summary_row in summary:
+        logger.info(
+            "%s / %s (GPU: %s) %s: batch size %d, %d processes (%.1f claims/s, p95 %.2f ms/claim)",
+            summary_row[DATASET_COLUMN],
+            summary_row[SYSTEM_COLUMN],
+            summary_row[GPU_COLUMN],
+            summary_row[OBJECTIVE_COLUMN],
+            summary_row[BATCH_SIZE_COLUMN],
+            summary_row[N_PROCESS_COLUMN],
+            summary_row[CLAIMS_PER_SECOND_COLUMN],
+            summary_row[P95_RUNTIME_PER_CLAIM_COLUMN],
+        )
 
     logger.info("Done.")
 
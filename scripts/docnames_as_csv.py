@@ -4,9 +4,8 @@ Script to convert DocNames JSONL data to CSV for easier reading.
 from argparse import ArgumentParser
 import csv
 from pathlib import Path
-import json
 import logging
-from typing import Any, Iterator
+from typing import Any
 
 from scripts.utils.medicare_data import (
     firstname_feature,
@@ -17,7 +16,8 @@ from scripts.utils.medicare_data import (
     zip_feature,
     addr_feature,
 )
-from scripts.utils.docnames_data import PromptedSentence
+from scripts.utils.docnames_data import recover_nochat_prompt
+from scripts.utils.jsonl import read_jsonl
 
 
 logger = logging.getLogger(__name__)
@@ -63,54 +63,85 @@ CSV_COLUMNS = (
 )
 
 
-def load_jsonl(jsonl_path: Path) -> Iterator[dict[str, Any]]:
-    """
-    Load JSON objects from the given JSONL file.
-    """
-    with jsonl_path.open(mode="r", encoding="utf-8") as jsonl_in:
-        for line in jsonl_in:
-            yield json.loads(line.strip())
+FEATURE_COLUMNS = (
+    (doctor_first_col, firstname_feature),
+    (doctor_last_col, lastname_feature),
+    (doctor_spec_col, specialty_feature),
+    (legal_name_col, legalname_feature),
+    (city_col, city_feature),
+    (zip_col, zip_feature),
+    (address_col, addr_feature),
+)
 
 
-def _prompted_sentence_from_json(json_: dict[str, Any]) -> PromptedSentence:
+class CsvSentence:
     """
-    Workaround to produce `nochat_prompt` for compatibility with old DocNames data.
+    The fields of a DocNames sentence that the CSV needs, and nothing else.
     """
-    if "nochat_prompt" not in json_:
-        json_ = json_.copy()
-        json_["nochat_prompt"] = json_[
-            "prompt"
-        ].removeprefix("<bos><start_of_turn>user\n\n").strip().removesuffix("<end_of_turn>").strip()
-    return PromptedSentence(**json_)
-
 
-def prompted_sentence_to_human_readable(prompted_sentence: PromptedSentence) -> dict[str, Any]:
+    __slots__ = ("sentence", "raw_generation", "prompt", "nochat_prompt", "feature_values", "generated_using")
+
+    def __init__(
+        self,
+        sentence: str,
+        raw_generation: str,
+        prompt: str,
+        nochat_prompt: str,
+        feature_values: tuple[Any, ...],
+        generated_using: tuple[bool, ...],
+    ):
+        self.sentence = sentence
+        self.raw_generation = raw_generation
+        self.prompt = prompt
+        self.nochat_prompt = nochat_prompt
+        self.feature_values = feature_values
+        self.generated_using = generated_using
+
+    @classmethod
+    def from_json(cls, json_: dict[str, Any]) -> "CsvSentence":
+        """
+        Project the fields we need out of a DocNames JSON record.
+
+        Old DocNames data has no `nochat_prompt`, so we recover it from the chat-formatted prompt.
+        """
+        prompt = json_["prompt"]
+        nochat_prompt = json_["nochat_prompt"] if "nochat_prompt" in json_ else recover_nochat_prompt(prompt)
+        full_features = json_["full_features"]
+        generation_features = json_["generation_features"]
+        return cls(
+            sentence=json_["sentence"],
+            raw_generation=json_["raw_generation"],
+            prompt=prompt,
+            nochat_prompt=nochat_prompt,
+            feature_values=tuple(full_features[feature] for _, feature in FEATURE_COLUMNS),
+            generated_using=tuple(feature in generation_features for _, feature in FEATURE_COLUMNS),
+        )
+
+    def to_csv_row(self) -> list[Any]:
+        """
+        Render the sentence as a human-readable CSV row with the columns in `CSV_COLUMNS` order.
+        """
+        result = [self.sentence, self.raw_generation, "", self.nochat_prompt, self.prompt]
+        for value, used in zip(self.feature_values, self.generated_using):
+            result.append(value)
+            result.append("Y" if used else "N")
+        return result
+
+
+def convert_to_csv(docnames_path: Path, csv_path: Path) -> int:
     """
-    Convert a prompted sentence to a dict that can be rendered as human-readable CSV.
+    Convert the DocNames JSONL file to human-readable CSV one record at a time, returning the number of rows written.
     """
-    result = {
-        sentence_col: prompted_sentence.sentence,
-        raw_gen_col: prompted_sentence.raw_generation,
-        comment_col: "",
-        prompt_col: prompted_sentence.nochat_prompt,
-        chatty_prompt_col: prompted_sentence.prompt,
-    }
-    for (col, feature) in [
-        (doctor_first_col, firstname_feature),
-        (doctor_last_col, lastname_feature),
-        (doctor_spec_col, specialty_feature),
-        (legal_name_col, legalname_feature),
-        (city_col, city_feature),
-        (zip_col, zip_feature),
-        (address_col, addr_feature),
-    ]:
-        result[col] = prompted_sentence.full_features[feature]
-        result[included_col(col)] = "Y" if feature in prompted_sentence.generation_features else "N"
-    assert set(CSV_COLUMNS).issubset(result.keys())
+    result = 0
+    with csv_path.open(mode="w", encoding="utf-8", newline="") as csv_out:
+        writer = csv.writer(csv_out, dialect=csv.excel)
+        writer.writerow(CSV_COLUMNS)
+        for datum in read_jsonl(docnames_path):
+            writer.writerow(CsvSentence.from_json(datum).to_csv_row())
+            result += 1
     return result
 
 
-
 def main():
     parser = ArgumentParser(description=__doc__)
     parser.add_argument("docnames_path", type=Path, help="Path to the DocNames JSONL file.")
@@ -132,13 +163,8 @@ def main():
         datefmt="%Y-%m-%d %H:%M:%S",
     )
 
-    docnames_sentences = (_prompted_sentence_from_json(**datum) for datum in load_jsonl(docnames_path))
-    csv_rows = (prompted_sentence_to_human_readable(sentence) for sentence in docnames_sentences)
-
-    with csv_path.open(mode="w", encoding="utf-8", newline="") as csv_out:
-        writer = csv.DictWriter(csv_out, fieldnames=CSV_COLUMNS, dialect=csv.excel)
-        writer.writeheader()
-        writer.writerows(csv_rows)
+    n_rows = convert_to_csv(docnames_path, csv_path)
+    logger.info("Wrote %d sentences to %s", n_rows, csv_path)
 
 
 if __name__ == "__main__":
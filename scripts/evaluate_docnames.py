@@ -8,12 +8,14 @@ It scores the extracted person names and city names separately on precision and
 """
 from argparse import ArgumentParser
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import csv
 import logging
+import os
 from pathlib import Path
 from typing import Any, Iterable, Optional
 
-from scripts.utils.jsonl import read_jsonl
+from scripts.utils.docnames_data import Inference, read_inferences
 
 
 logger = logging.getLogger(__name__)
@@ -40,25 +42,30 @@ def get_recall(correct: int, total: int) -> float:
     return correct / total if total > 0 else 1.0
 
 
-def calculate_metrics(inferences: Iterable[dict[str, Any]]) -> dict[str, float]:
+def calculate_metrics(inferences: Iterable[Inference]) -> dict[str, float]:
     """
     Calculate metrics for the given list of inferences.
 
-    Currently this means precision and recall for names and cities.
+    Currently this means precision and recall for names and cities, plus the number of sentences. This makes a single
+    pass over the inferences, so it works on streams.
     """
     metrics = defaultdict(lambda: {"correct": 0, "total": 0, "extracted": 0})
+    n_sentences = 0
 
     for inference in inferences:
+        n_sentences += 1
+        generation_features = inference.prompted_sentence.generation_features
+        extracted_info = inference.extracted_info
         for entity_type, true_value, extracted_values in [
-            ("name", join_medicare_names(inference["generation_features"]), [v.upper() for v in inference["extracted_info"]["names"]]),
-            ("city", inference["generation_features"].get("City/Town"), [v.upper() for v in inference["extracted_info"]["cities"]]),
+            ("name", join_medicare_names(generation_features), [v.upper() for v in extracted_info.names]),
+            ("city", generation_features.get("City/Town"), [v.upper() for v in extracted_info.cities]),
         ]:
             if true_value is not None:
                 metrics[entity_type]["total"] += 1
                 metrics[entity_type]["correct"] += extracted_values.count(true_value.upper())
             metrics[entity_type]["extracted"] += len(extracted_values)
 
-    results = {}
+    results = {"# of sentences": n_sentences}
     for entity_type, counts in metrics.items():
         results[f"{entity_type.capitalize()} Extracted Count"] = counts["extracted"]
         results[f"# Sentences With {entity_type.capitalize()}"] = counts["total"]
@@ -70,13 +77,23 @@ def calculate_metrics(inferences: Iterable[dict[str, Any]]) -> dict[str, float]:
 
 def process_inference_file(inference_path: Path) -> dict[str, Any]:
     """Process a single inference file and return metrics."""
-    metrics = calculate_metrics(read_jsonl(inference_path))
+    metrics = calculate_metrics(read_inferences(inference_path))
     metrics["Run"] = inference_path.stem
     metrics["(Debug) Full Path"] = str(inference_path.resolve())
-    metrics["# of sentences"] = sum(1 for _ in read_jsonl(inference_path))
     return metrics
 
 
+def process_inference_files(inference_paths: list[Path], *, n_workers: int) -> list[dict[str, Any]]:
+    """
+    Process the inference files in parallel across `n_workers` processes, returning metrics in input order.
+    """
+    if n_workers == 1 or len(inference_paths) <= 1:
+        return [process_inference_file(inference_path) for inference_path in inference_paths]
+
+    with ProcessPoolExecutor(max_workers=min(n_workers, len(inference_paths))) as executor:
+        return list(executor.map(process_inference_file, inference_paths))
+
+
 def write_csv_output(results: list[dict[str, Any]], output_path: Path) -> None:
     """Write results to a CSV file."""
     fieldnames = [
@@ -124,6 +141,8 @@ def main() -> None:
                         help="Paths to inference files to evaluate")
     parser.add_argument("--write-scores-to", type=Path,
                         help="Path to write CSV output")
+    parser.add_argument("--n-workers", type=int, default=os.cpu_count(),
+                        help="Number of processes to use for evaluating files in parallel")
     parser.add_argument("--logging-level", default="INFO",
                         choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
                         help="Set the logging level")
@@ -134,6 +153,9 @@ def main() -> None:
 
     inference_paths: list[Path] = args.inferences_path
     output_path: Optional[Path] = args.write_scores_to
+    n_workers: int = args.n_workers
+
+    assert n_workers > 0
 
     for path in inference_paths:
         if not path.is_file():
@@ -146,11 +168,8 @@ def main() -> None:
     if output_path:
         output_path.parent.mkdir(exist_ok=True, parents=True)
 
-    results = []
-    for inference_path in inference_paths:
-        logger.info("Processing inference file: %s", inference_path)
-        result = process_inference_file(inference_path)
-        results.append(result)
+    logger.info("Processing %d inference files with %d workers", len(inference_paths), n_workers)
+    results = process_inference_files(inference_paths, n_workers=n_workers)
 
     if output_path:
         logger.info("Writing CSV output to: %s", output_path)
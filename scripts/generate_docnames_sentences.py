@@ -3,13 +3,14 @@ Script to generate DocNames sentences from a Medicare record data sample.
 """
 from argparse import ArgumentParser
 import csv
-from dataclasses import asdict, dataclass
-import json
+from dataclasses import dataclass, field
+import hashlib
 import logging
 from math import ceil
 from pathlib import Path
 import random
 import string
+import time
 from typing import Any, Iterator, Optional, Sequence, TypedDict
 
 import torch
@@ -25,7 +26,11 @@ from scripts.utils.medicare_data import (
     zip_feature,
     addr_feature,
 )
+from scripts.utils.bucketing import PaddingStats, map_length_bucketed
 from scripts.utils.docnames_data import PromptedSentence
+from scripts.utils.jsonl import write_jsonl
+from scripts.utils.medicare_store import MedicareStore, is_store
+from scripts.utils.sharding import Shard
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +39,8 @@ DEFAULT_SEED = 42
 DEFAULT_N_SENTENCES = 1
 DEFAULT_PERCENT_WITH_TYPOS = 25
 DEFAULT_TEMPERATURE = 1.5
+DEFAULT_BATCH_SIZE = 1
+MAX_NEW_TOKENS = 128
 
 PROMPT_TEMPLATE = string.Template(
     """Write a tweet from a patient's perspective about a doctor including all of the following information:
@@ -56,8 +63,13 @@ GLOSS_ORDER = ("Doctor", "Specialty", "Business Name", "Business City", "Busines
 
 
 def load_rows(rows_path: Path) -> Sequence[dict[str, Any]]:
-    with rows_path.open(mode="r", encoding="utf-8") as rows_in:
-        result = list(csv.DictReader(rows_in))
+    """Load sample rows from a CSV file or from a Medicare store directory."""
+    if is_store(rows_path):
+        store = MedicareStore(rows_path)
+        result = list(store.rows(range(store.n_rows)))
+    else:
+        with rows_path.open(mode="r", encoding="utf-8") as rows_in:
+            result = list(csv.DictReader(rows_in))
 
     for row in result:
         assert lastname_feature in row
@@ -108,8 +120,8 @@ def subset_features(features: dict[str, Any], *, rng: random.Random) -> dict[str
     sample_from = features.copy()
     sample_from.pop(lastname_feature)
 
-    sample_size = random.randint(0, len(sample_from))
-    sampled_features = random.sample(list(sample_from.items()), k=sample_size)
+    sample_size = rng.randint(0, len(sample_from))
+    sampled_features = rng.sample(list(sample_from.items()), k=sample_size)
     result = {**result, **dict(sampled_features)}
 
     return result
@@ -146,15 +158,146 @@ def make_prompt(features: dict[str, Any], *, should_typo: bool, tokenizer: PreTr
     return result
 
 
+def row_seed(random_seed: int, row_no: int) -> int:
+    """Derive the seed for the given row from the run's seed, so that any subset of rows can be generated alone."""
+    digest = hashlib.sha256(f"{random_seed}:{row_no}".encode("utf-8")).digest()
+    # Keep it within 32 bits, which NumPy requires of seeds.
+    return int.from_bytes(digest[:4], "big")
+
+
+def shard_settings(*, batch_size: int, bucket_window: int) -> str:
+    """Name the settings that shards must share for their merged output to match an unsharded run."""
+    return f"batch{batch_size}-window{bucket_window}"
+
+
+def choose_rows_to_typo(n_rows: int, percent_to_typo: int, *, random_seed: int) -> set[int]:
+    """Choose which rows we should generate typos for. Every shard of a run makes the same choice."""
+    n_to_typo = ceil(n_rows * percent_to_typo / 100)
+    return set(random.Random(random_seed).sample(range(n_rows), k=n_to_typo))
+
+
+@dataclass(frozen=True)
+class RowPrompt:
+    """The prompt for one row, along with what went into it."""
+
+    row_no: int
+    features: dict[str, Any]
+    nochat_prompt: str
+    prompt: str
+    n_tokens: int
+
+
+def make_row_prompt(
+    rows: Sequence[dict[str, Any]],
+    row_no: int,
+    *,
+    tokenizer: PreTrainedTokenizer,
+    to_typo: set[int],
+    random_seed: int,
+) -> RowPrompt:
+    """Choose the features for the given row using its own seed, and make the prompt for them."""
+    features = subset_features(rows[row_no], rng=random.Random(row_seed(random_seed, row_no)))
+    nochat_prompt = make_prompt(features, should_typo=row_no in to_typo, tokenizer=tokenizer)
+    prompt = (
+        tokenizer.apply_chat_template([{"role": "user", "content": nochat_prompt}], tokenize=False)
+        if tokenizer.chat_template
+        else nochat_prompt
+    )
+    n_tokens = len(tokenizer.encode(prompt, add_special_tokens=False))
+    return RowPrompt(row_no=row_no, features=features, nochat_prompt=nochat_prompt, prompt=prompt, n_tokens=n_tokens)
+
+
+@dataclass
+class GenerationStats:
+    """Padding and throughput of sentence generation so far."""
+
+    padding: PaddingStats = field(default_factory=PaddingStats)
+    n_generated_tokens: int = 0
+    seconds: float = 0.0
+
+    def log(self) -> None:
+        logger.info(
+            "Padding was %.1f%% of prompt token slots. Generated %d tokens in %.1f seconds (%.1f tokens/s).",
+            100 * self.padding.padding_ratio,
+            self.n_generated_tokens,
+            self.seconds,
+            self.n_generated_tokens / self.seconds if self.seconds else 0.0,
+        )
+
+
+def generate_sentences(
+    rows: Sequence[dict[str, Any]],
+    row_nos: Sequence[int],
+    *,
+    pipeline_: Any,
+    tokenizer: PreTrainedTokenizer,
+    to_typo: set[int],
+    random_seed: int,
+    sentences_per_row: int,
+    batch_size: int,
+    bucket_window: int,
+    temperature: float,
+    stats: Optional[GenerationStats] = None,
+) -> Iterator[PromptedSentence]:
+    """
+    Generate sentences for the given rows, in order.
+
+    Rows are batched by prompt length within each window of `bucket_window` rows, to cut down on padding. Each row's
+    features are chosen using the row's own seed, so they never depend on the other rows. Sampling, however, happens a
+    batch at a time, seeded with the seed of the batch's first row, since the pipeline samples a whole batch from one
+    random generator. So a row's sentences depend on its batch-mates, and runs produce identical sentences only if
+    they use the same `batch_size` and `bucket_window`. Given those, the sentences for a row don't depend on which
+    other windows we generate in the same run.
+    """
+    stats = stats if stats is not None else GenerationStats()
+
+    def generate_batch(batch: list[RowPrompt]) -> list[tuple[RowPrompt, list[dict[str, Any]]]]:
+        # Batches keep their rows in order, so the first row has the lowest number.
+        set_seed(row_seed(random_seed, batch[0].row_no))
+        start = time.perf_counter()
+        batch_responses = pipeline_(
+            [row_prompt.prompt for row_prompt in batch],
+            num_return_sequences=sentences_per_row,
+            do_sample=True,
+            return_full_text=False,
+            batch_size=len(batch),
+            temperature=temperature,
+        )
+        stats.seconds += time.perf_counter() - start
+        stats.n_generated_tokens += sum(
+            len(tokenizer.encode(response["generated_text"], add_special_tokens=False))
+            for responses in batch_responses
+            for response in responses
+        )
+        return list(zip(batch, batch_responses))
+
+    row_prompts = (
+        make_row_prompt(rows, row_no, tokenizer=tokenizer, to_typo=to_typo, random_seed=random_seed)
+        for row_no in row_nos
+    )
+    for row_prompt, responses in map_length_bucketed(
+        generate_batch,
+        row_prompts,
+        length=lambda row_prompt: row_prompt.n_tokens,
+        batch_size=batch_size,
+        window=bucket_window,
+        padding_stats=stats.padding,
+    ):
+        for response in responses:
+            yield PromptedSentence(
+                sentence=get_clean_text(response["generated_text"]),
+                raw_generation=response["generated_text"],
+                prompt=row_prompt.prompt,
+                nochat_prompt=row_prompt.nochat_prompt,
+                generation_features=row_prompt.features,
+                full_features=rows[row_prompt.row_no],
+                attempted_to_typo=row_prompt.row_no in to_typo,
+            )
+
+
 def write_sentences(prompted_sentences: Iterator[PromptedSentence], sentences_path: Path) -> int:
     """Write the list of sentences to the path as JSONL, returning the number written."""
-    result = 0
-    with sentences_path.open(mode="w", encoding="utf-8") as jsonl_out:
-        for prompted_sentence in prompted_sentences:
-            result += 1
-            jsonl_out.write(json.dumps(asdict(prompted_sentence)))
-            jsonl_out.write("\n")
-    return result
+    return write_jsonl((prompted_sentence.to_json() for prompted_sentence in prompted_sentences), sentences_path)
 
 
 def main():
@@ -162,7 +305,7 @@ def main():
     parser.add_argument(
         "sample_path",
         type=Path,
-        help="Path to the sample rows file to load.",
+        help="Path to the sample rows file (or Medicare store directory) to load.",
     )
     parser.add_argument(
         "sentences_path",
@@ -195,7 +338,11 @@ def main():
     parser.add_argument(
         "--batch-size",
         type=int,
-        help="The batch size to use when sampling sentences.",
+        help=(
+            "The batch size to use when sampling sentences. Runs produce the same sentences only if they use the same "
+            "batch size."
+        ),
+        default=DEFAULT_BATCH_SIZE,
     )
     parser.add_argument(
         "--temperature",
@@ -203,6 +350,27 @@ def main():
         help="The temperature to use to sample sentences.",
         default=DEFAULT_TEMPERATURE,
     )
+    parser.add_argument(
+        "--bucket-window",
+        type=int,
+        help=(
+            "Sort each window of this many rows by prompt length before batching, so batches need less padding. "
+            "Defaults to the batch size, which batches rows in order. Runs produce the same sentences only if they use "
+            "the same window."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--shard",
+        type=Shard.parse,
+        help=(
+            "Generate only shard `i/N` of the rows (counting from 0), writing it next to `sentences_path`. Merge the "
+            "shards afterwards with `merge_docnames_shards.py` to get the same file an unsharded run would write. All "
+            "shards (and the unsharded run to compare with) must use the same --batch-size and --bucket-window, since "
+            "sampling is seeded per batch. These go in the shard file names, and merging refuses mismatched shards."
+        ),
+        default=None,
+    )
     parser.add_argument(
         "--logging-level",
         type=str,
@@ -225,59 +393,53 @@ def main():
     percent_to_typo = args.percent_to_typo
     batch_size = args.batch_size
     temperature = args.temperature
+    shard: Optional[Shard] = args.shard
+    bucket_window: int = args.bucket_window or batch_size
+
+    assert batch_size > 0
+    assert bucket_window >= batch_size
 
     tokenizer = AutoTokenizer.from_pretrained(model)
-    pipeline_ = pipeline(task="text-generation", model=model, tokenizer=tokenizer, max_new_tokens=128, device_map="auto")
+    pipeline_ = pipeline(
+        task="text-generation", model=model, tokenizer=tokenizer, max_new_tokens=MAX_NEW_TOKENS, device_map="auto"
+    )
     logger.info("Successfully loaded tokenizer and model (model on device %s).", pipeline_.device)
 
-    set_seed(random_seed)
-    rng = random.Random(random_seed)
-
     rows = load_rows(sample_path)
     logger.info("Loaded %d rows from %s", len(rows), sample_path)
-    n_to_typo = ceil(len(rows) * percent_to_typo / 100)
-    to_typo = set(random.sample(range(len(rows)), k=n_to_typo))
+    to_typo = choose_rows_to_typo(len(rows), percent_to_typo, random_seed=random_seed)
     logger.info(
         "Planning to typo outputs for %d rows (%d sentences) of %d rows (%d sentences) total.",
         len(to_typo),
-        len(rows),
         len(to_typo) * sentences_per_row,
+        len(rows),
         len(rows) * sentences_per_row,
     )
-    feature_subsets = [subset_features(row, rng=rng) for row in rows]
-    should_typos = [i in to_typo for i in range(len(feature_subsets))]
-    nochat_prompts = [
-        make_prompt(feature_subset, should_typo=should_typo, tokenizer=tokenizer)
-        for feature_subset, should_typo in zip(feature_subsets, should_typos)
-    ]
-    prompts = [
-        tokenizer.apply_chat_template([{"role": "user", "content": prompt}], tokenize=False)
-        for raw_prompt in nochat_prompts
-    ] if tokenizer.chat_template else nochat_prompts.copy()
-    docnames_sentences = (
-        PromptedSentence(
-            sentence=get_clean_text(response["generated_text"]),
-            raw_generation=response["generated_text"],
-            prompt=prompt,
-            nochat_prompt=nochat_prompt,
-            generation_features=features,
-            full_features=full_features,
-            attempted_to_typo=i in to_typo,
+    row_nos = range(len(rows))
+    if shard is not None:
+        row_nos = shard.row_range(len(rows), align_to=bucket_window)
+        sentences_path = shard.output_path(
+            sentences_path, settings=shard_settings(batch_size=batch_size, bucket_window=bucket_window)
         )
-        for i, (nochat_prompt, prompt, full_features, features, responses) in enumerate(zip(nochat_prompts, prompts, rows, feature_subsets, pipeline_(
-            prompts,
-            num_return_sequences=sentences_per_row,
-            do_sample=True,
-            return_full_text=False,
-            batch_size=batch_size,
-            temperature=temperature,
-        )))
-        for response in responses
+        logger.info("Generating shard %d/%d: rows %d to %d", shard.index, shard.count, row_nos.start, row_nos.stop)
+
+    stats = GenerationStats()
+    docnames_sentences = generate_sentences(
+        rows,
+        row_nos,
+        pipeline_=pipeline_,
+        tokenizer=tokenizer,
+        to_typo=to_typo,
+        random_seed=random_seed,
+        sentences_per_row=sentences_per_row,
+        batch_size=batch_size,
+        bucket_window=bucket_window,
+        temperature=temperature,
+        stats=stats,
     )
-
     n_sentences = write_sentences(docnames_sentences, sentences_path)
     logger.info("Wrote %s sentences to %s", n_sentences, sentences_path)
-
+    stats.log()
 
 
 if __name__ == "__main__":
@@ -5,20 +5,32 @@ The input and output are both JSONL.
 """
 from argparse import ArgumentParser
 from copy import deepcopy
+from dataclasses import dataclass
+from functools import cache, partial
 import json
 import logging
-import os
 from pathlib import Path
 import string
-import time
-from typing import Any, Iterable, Iterator, Optional, Sequence
+from typing import Any, Callable, Iterable, Iterator, Optional, Sequence, TypeVar
 
 import genparse
 import requests
-from requests.auth import HTTPBasicAuth
 from transformers import AutoTokenizer, PreTrainedTokenizer
 
-from scripts.utils.jsonl import read_jsonl, write_jsonl
+from scripts.utils.concurrency import call_with_retries, chunked, ordered_map
+from scripts.utils.genparse_output import cleanup_genparse_output, get_map_output, map_margin, posterior_entropy_bits
+from scripts.utils.http_client import batch_inference_endpoint, configure_session, get_session, inference_endpoint
+from scripts.utils.jsonl import read_jsonl, skip_completed, write_jsonl
+from scripts.utils.posterior_cache import BYTES_PER_MIB, DEFAULT_MAX_CACHE_MIB, PosteriorCache, make_cache_key
+from scripts.utils.prompts import SplitPrompt, load_split_prompt, render_chat_prompt
+from scripts.utils.restarts import (
+    DEFAULT_LATENCY_FACTOR,
+    DEFAULT_MAX_CONSECUTIVE_ERRORS,
+    DEFAULT_MAX_MEMORY_FRACTION,
+    RestartManager,
+    RestartPolicy,
+)
+from scripts.utils.server_pool import ServerPool
 
 
 logger = logging.getLogger(__name__)
@@ -32,18 +44,24 @@ JSON_PROMPT_TEMPLATE = string.Template(
         "{{{:sentence}}}", "$sentence"
     )
 )
+SENTENCE_FIELD = "sentence"
 
 PROPOSAL_NAME = "character"
 SAMPLING_METHOD = "smc-standard"
 DEFAULT_BATCH_SIZE = 8
-DEFAULT_RESTART_SERVER_EVERY = 120
-CONNECT_TIMEOUT_SECONDS = 3.05
-DEFAULT_RESTART_REQUEST_TIMEOUT_SECONDS = 30
-DEFAULT_RESTART_REQUEST_WAIT_TIME_SECONDS = 90
+DEFAULT_MAX_IN_FLIGHT = 1
+DEFAULT_MAX_RETRIES = 2
+DEFAULT_CHECKPOINT_EVERY = 10
 DEFAULT_N_PARTICLES = 15
+DEFAULT_MIN_MAP_MARGIN = 0.5
+DEFAULT_MAX_ENTROPY_BITS = 1.0
 MAX_TOKENS = 128
 DEFAULT_TEMPERATURE = 1.0
-WAIT_FOR_GENPARSE_REBOOT = 60
+
+T = TypeVar("T")
+# Makes a request with `fn(server)` on some server, like `ServerPool.call`. `work` is the number of particles times
+# prompts, by which the server's restart manager judges its latency.
+CallServer = Callable[..., Any]
 
 
 def _join_names(genparse_output: dict[str, Any]) -> Optional[str]:
@@ -62,136 +80,51 @@ def _join_names(genparse_output: dict[str, Any]) -> Optional[str]:
     return result
 
 
-def make_prompt(sentence_datum: dict[str, Any], *, tokenizer: PreTrainedTokenizer) -> str:
-    """
-    Given a sentence datum and tokenizer, format the prompt appropriately to prompt the model.
-    """
-    result = tokenizer.apply_chat_template(
-        [{"role": "user", "content": JSON_PROMPT_TEMPLATE.substitute(sentence=sentence_datum["sentence"])}], tokenize=False
-    )
+@cache
+def _load_tokenizer(model: str) -> PreTrainedTokenizer:
+    logger.info("Loading tokenizer for model `%s`", model)
+    result = AutoTokenizer.from_pretrained(model)
+    logger.info("Successfully loaded tokenizer for model `%s`", model)
     return result
 
 
-# Translated from GenFact server code, src/genparse/extract_entities.jl.
-# Current as of 8895efe5f5e51d5bfdd0300d8d4ffd7e0568f2aa
-def _normalize_json_object(json_string: str) -> str:
+def load_sentence_split_prompt(model: str, *, cache_dir: Optional[Path] = None) -> SplitPrompt:
     """
-    Normalize a raw JSON object string into a standard form.
+    Get the chat prompt for the given model split around the sentence, loading it from `cache_dir` if saved.
 
-    This parses the string as an object, sorts by keys, then re-serializes it to eliminate variation in whitespace.
+    The tokenizer is only loaded if the split isn't saved yet. Raises ValueError if the model's chat template can't be
+    split.
     """
-    return json.dumps(dict(sorted(json.loads(json_string).items(), key=lambda t: t[0])))
-
-
-# Translated from GenFact server code, src/genparse/extract_entities.jl.
-# Current as of 8895efe5f5e51d5bfdd0300d8d4ffd7e0568f2aa
-def _sort_posterior(posterior: dict[str, float]) -> dict[str, float]:
-    """Sort a posterior distribution so the highest likelihood output comes first.
+    return load_split_prompt(
+        JSON_PROMPT_TEMPLATE,
+        SENTENCE_FIELD,
+        model=model,
+        load_tokenizer=partial(_load_tokenizer, model),
+        cache_dir=cache_dir,
+    )
 
-    Breaks ties by preferring the alphabetically earliest inference. This does not explicitly handle Unicode and so
-    it will probably sort in UTF-8 code unit order instead of in collation order.
 
-    The posterior should be a dict-like object mapping strings-like objects to float-likes.
-    This returns a value in the same format.
+def load_prompt_renderer(model: str, *, cache_dir: Optional[Path] = None) -> Callable[[str], str]:
     """
-    return dict(sorted(posterior.items(), key=lambda t: (t[1], t[0]), reverse=True))
-
-
-# Translated from GenFact server code, src/genparse/extract_entities.jl.
-# Current as of 8895efe5f5e51d5bfdd0300d8d4ffd7e0568f2aa
-def _aggregate_identical_json(posterior: dict[str, float]) -> dict[str, float]:
-    """Convert a raw-JSON posterior into a normalized-JSON posterior.
+    Get a function that renders the chat prompt for a sentence.
 
-    The posterior should be a dict-like object mapping strings-like objects (unparsed JSON) to float-likes.
-    This returns a value in the same format.
+    Normally this precomputes the constant parts of the prompt once (or loads them from `cache_dir`) so that rendering
+    is just concatenation. If the model's chat template doesn't allow that, we fall back to rendering each prompt with
+    the tokenizer.
     """
-    result = {}
-    for inference, likelihood in posterior.items():
-        normalized = _normalize_json_object(inference)
-        result.setdefault(normalized, 0.0)
-        result[normalized] += likelihood
-    return _sort_posterior(result)
-
-
-
-class NotCodeError(Exception):
-    pass
-
-
-
-# Translated from GenFact server code, src/genparse/extract_entities.jl,
-# the function extract_code_from_response(text::String)::String.
-# Current as of 8895efe5f5e51d5bfdd0300d8d4ffd7e0568f2aa
-def _extract_code_from_inference(text: str) -> str:
-    """Extract code from the code block in a chatty Genparse generation."""
-    result = text.strip().removeprefix("<|start_header_id|>assistant<|end_header_id|>")
     try:
-        json.loads(result)
-    except json.decoder.JSONDecodeError as e:
-	    raise NotCodeError("Not formatted properly -- expected chat turn prefix followed by JSON.") from e
-    return result
-
-
-# Translated from GenFact server code, src/genparse/extract_entities.jl.
-# Current as of 8895efe5f5e51d5bfdd0300d8d4ffd7e0568f2aa
-def _get_aggregate_likelihoods(posterior: dict[str, float]) -> dict[str, float]:
-    """Convert a raw-text posterior into a code-only posterior.
+        split_prompt = load_sentence_split_prompt(model, cache_dir=cache_dir)
+    except ValueError as e:
+        logger.warning("Can't precompute the prompt for model `%s`, rendering each prompt in full: %s", model, e)
+        return partial(render_chat_prompt, JSON_PROMPT_TEMPLATE, SENTENCE_FIELD, tokenizer=_load_tokenizer(model))
+    return split_prompt.render
 
-    This extracts the code block from each inference and aggregates the likelihoods from identical code blocks.
 
-    The posterior should be a dict-like object mapping strings-like objects to float-likes.
-    This returns a value in the same format.
+def make_prompt(sentence_datum: dict[str, Any], *, render_prompt: Callable[[str], str]) -> str:
     """
-    result = {}
-    n_nocode = 0
-    nocode_likelihood = 0.0
-    for inference, likelihood in posterior.items():
-        try:
-            code_only = _extract_code_from_inference(inference)
-        except NotCodeError as e:
-            logger.debug("Inference is not code: `%s`", inference)
-            n_nocode += 1
-            nocode_likelihood += likelihood
-        else:
-            result.setdefault(code_only, 0.0)
-            result[code_only] += likelihood
-
-    for inference in result.keys():
-        result[inference] += nocode_likelihood / max(n_nocode, 1)
-
-    assert result
-
-    return _sort_posterior(result)
-
-
-
-def cleanup_genparse_output(posterior: dict[str, float]) -> dict[str, float]:
-    """
-    Clean up Genparse output.
-
-    This attempts to imitate what the GenFact server does to clean up the Genparse output as of 2024-09-10.
-    It does not attempt to perform PClean-related cleanup, because for evaluation purposes we don't need that for our
-    pure information extraction evaluation. This therefore only filters for actual JSON respones and aggregates
-    likelihoods over functionally identical outputs.
-    """
-    return _aggregate_identical_json(_get_aggregate_likelihoods(posterior))
-
-
-def get_map_output(posterior: dict[str, float]) -> str:
-    """
-    Given a posterior, get the maximum a posteriori output.
-
-    If there is a tie for maximum, we prefer the output that sorts first alphabetically.
+    Given a sentence datum and prompt renderer, format the prompt appropriately to prompt the model.
     """
-    # Can't get the max directly because it would prefer the output that sorts last alphabetically. There is no easy
-    # way to fix this in the key function.
-    #
-    # Instead, we negate the values and get the minimum. This should get us a MAP output still because when we negate
-    # the values the max becomes the min. However, because we also key on the strings, now we get the alphabetically
-    # first MAP inference.
-    #
-    # Trick: The value is a number but
-    return min(posterior.items(), key=lambda t: (-t[1], t[0]))[0]
+    return render_prompt(sentence_datum["sentence"])
 
 
 def convert_to_extracted_info(sentence_datum: dict[str, Any]) -> dict[str, Any]:
@@ -225,111 +158,367 @@ def augment_sentence_with_genparse_output(sentence_datum: dict[str, Any], poster
     }
 
 
+def make_sampling_params(*, temperature: float, n_particles: int, max_new_tokens: int) -> dict[str, Any]:
+    """
+    Make the Genparse inference request parameters other than the prompt.
+    """
+    return {
+        "method": SAMPLING_METHOD,
+        "n_particles": n_particles,
+        "lark_grammar": GRAMMAR,
+        "proposal_name": PROPOSAL_NAME,
+        "proposal_args": {},
+        "max_tokens": max_new_tokens,
+        "temperature": temperature,
+    }
+
+
+def make_inference_params(prompt: str, *, temperature: float, n_particles: int, max_new_tokens: int) -> dict[str, Any]:
+    """
+    Make the Genparse inference request parameters for the given prompt.
+    """
+    return {
+        "prompt": prompt,
+        **make_sampling_params(temperature=temperature, n_particles=n_particles, max_new_tokens=max_new_tokens),
+    }
+
+
+def _get_posterior_cached(
+    inference_params: dict[str, Any],
+    *,
+    model: str,
+    cache: Optional[PosteriorCache],
+    infer: Callable[[], dict[str, float]],
+) -> dict[str, float]:
+    """
+    Look up the posterior for the given inference in the cache, running `infer` and caching the result on a miss.
+    """
+    if cache is None:
+        return infer()
+
+    key = make_cache_key({**inference_params, "model": model})
+    result = cache.get(key)
+    if result is None:
+        result = infer()
+        cache.put(key, result)
+    else:
+        logger.debug("Using cached posterior %s", key)
+    return result
+
+
+def _get_posteriors_cached_batch(
+    prompts: Sequence[str],
+    sampling_params: dict[str, Any],
+    *,
+    model: str,
+    cache: Optional[PosteriorCache],
+    infer_batch: Callable[[list[str]], list[dict[str, float]]],
+) -> list[dict[str, float]]:
+    """
+    Like `_get_posterior_cached`, but for a batch of prompts. `infer_batch` is called once with the prompts that
+    missed the cache, if any, and must return their posteriors in order.
+    """
+    posteriors: list[Optional[dict[str, float]]] = [None] * len(prompts)
+    if cache is not None:
+        cache_keys = [make_cache_key({"prompt": prompt, **sampling_params, "model": model}) for prompt in prompts]
+        posteriors = [cache.get(key) for key in cache_keys]
+
+    to_infer = [i for i, posterior in enumerate(posteriors) if posterior is None]
+    if to_infer:
+        inferred = infer_batch([prompts[i] for i in to_infer])
+        if len(inferred) != len(to_infer):
+            raise ValueError(f"Expected {len(to_infer)} posteriors from Genparse but got {len(inferred)}")
+        for i, posterior in zip(to_infer, inferred):
+            posteriors[i] = posterior
+            if cache is not None:
+                cache.put(cache_keys[i], posterior)
+    return posteriors
+
+
+def _augment_batch(
+    sentence_batch: Sequence[dict[str, Any]], prompts: Sequence[str], posteriors: Sequence[dict[str, float]]
+) -> list[dict[str, Any]]:
+    result = []
+    for sentence_datum, prompt, posterior in zip(sentence_batch, prompts, posteriors):
+        augmented = augment_sentence_with_genparse_output(sentence_datum, posterior)
+        augmented["genparse_prompt"] = prompt
+        result.append(augmented)
+    return result
+
+
 def extract_info_with_genparse_locally(
     sentence_datum: dict[str, Any],
     *,
-    server: str,
     inference_setup: genparse.InferenceSetupVLLM,
-    tokenizer: PreTrainedTokenizer,
+    render_prompt: Callable[[str], str],
     temperature: float,
     n_particles: int,
     max_new_tokens: int = MAX_TOKENS,
+    model: str = GENPARSE_SERVER_MODEL,
+    cache: Optional[PosteriorCache] = None,
 ) -> dict[str, Any]:
     """
     Process sentences using Genparse locally and extract relevant information.
     """
-    prompt = make_prompt(sentence_datum, tokenizer=tokenizer)
-    posterior = inference_setup(
-        prompt, method="smc-standard", temperature=temperature, n_particles=n_particles, max_tokens=max_new_tokens
-    ).posterior
+    prompt = make_prompt(sentence_datum, render_prompt=render_prompt)
+    inference_params = make_inference_params(
+        prompt, temperature=temperature, n_particles=n_particles, max_new_tokens=max_new_tokens
+    )
+    posterior = _get_posterior_cached(
+        inference_params,
+        model=model,
+        cache=cache,
+        infer=lambda: inference_setup(
+            prompt, method=SAMPLING_METHOD, temperature=temperature, n_particles=n_particles, max_tokens=max_new_tokens
+        ).posterior,
+    )
     result = augment_sentence_with_genparse_output(sentence_datum, posterior)
     result["genparse_prompt"] = prompt
     return result
 
 
-def inference_endpoint(server_ip_or_hostname: str) -> str:
-    """
-    Get the inference endpoint URL for the given server IP or hostname.
+@dataclass(frozen=True)
+class ParticleSchedule:
     """
-    return f"http://{server_ip_or_hostname}:8888/infer"
-
+    Particle counts to try in increasing order, stopping once the cleaned posterior is confident enough.
 
-def restart_endpoint(server_ip_or_hostname: str) -> str:
+    A posterior is confident if its MAP margin is at least `min_map_margin` and its entropy is at most
+    `max_entropy_bits`.
     """
-    Get the endpoint URL to restart the Genparse inference server on the given IP or hostname.
-    """
-    return f"http://{server_ip_or_hostname}:9999/restart"
-
 
-def _get_restart_user():
-    return os.getenv('GENPARSE_USER')
+    n_particles: Sequence[int]
+    min_map_margin: float = DEFAULT_MIN_MAP_MARGIN
+    max_entropy_bits: float = DEFAULT_MAX_ENTROPY_BITS
 
+    def is_confident(self, raw_posterior: dict[str, float]) -> bool:
+        cleaned = cleanup_genparse_output(raw_posterior)
+        return map_margin(cleaned) >= self.min_map_margin and posterior_entropy_bits(cleaned) <= self.max_entropy_bits
 
-def _get_restart_password():
-    return os.getenv('GENPARSE_PASSWORD')
 
+def extract_info_adaptively(
+    sentence_datum: dict[str, Any],
+    *,
+    extract: Callable[..., dict[str, Any]],
+    particle_schedule: ParticleSchedule,
+) -> dict[str, Any]:
+    """
+    Run `extract(sentence_datum, n_particles=...)` with more particles each time until the posterior is confident.
 
-def _request_timeout(timeout):
-    return (CONNECT_TIMEOUT_SECONDS, timeout)
+    The result records the particle count of the posterior we kept in `n_particles` and the total over all attempts
+    in `n_particles_spent`.
+    """
+    return extract_batch_adaptively(
+        [sentence_datum],
+        extract_batch=lambda batch, **kwargs: [extract(batch[0], **kwargs)],
+        particle_schedule=particle_schedule,
+    )[0]
 
 
-def _restart_server(
-    server_ip_or_hostname: str,
+def extract_batch_adaptively(
+    sentence_batch: Sequence[dict[str, Any]],
     *,
-    restart_request_timeout_seconds: int = DEFAULT_RESTART_REQUEST_TIMEOUT_SECONDS,
-    sleep_after_restart_seconds: float = DEFAULT_RESTART_REQUEST_WAIT_TIME_SECONDS,
-) -> None:
+    extract_batch: Callable[..., list[dict[str, Any]]],
+    particle_schedule: ParticleSchedule,
+) -> list[dict[str, Any]]:
     """
-    Get the inference endpoint URL for the given server IP or hostname.
+    Like `extract_info_adaptively`, but for a batch. Each round only re-runs the sentences that aren't confident yet.
     """
-    logger.info("Restarting Genparse server: %s", server_ip_or_hostname)
-    url = restart_endpoint(server_ip_or_hostname)
-    basic = HTTPBasicAuth(_get_restart_user(), _get_restart_password())
-    response = requests.post(url, auth=basic, timeout=_request_timeout(restart_request_timeout_seconds))
-    assert response.status_code == 200
-    time.sleep(sleep_after_restart_seconds)
-
-
-def await_restart() -> None:
+    results: list[Optional[dict[str, Any]]] = [None] * len(sentence_batch)
+    n_particles_spent = [0] * len(sentence_batch)
+    pending = list(range(len(sentence_batch)))
+    for n_particles in particle_schedule.n_particles:
+        if not pending:
+            break
+        still_pending = []
+        for i, result in zip(pending, extract_batch([sentence_batch[i] for i in pending], n_particles=n_particles)):
+            n_particles_spent[i] += n_particles
+            result["n_particles"] = n_particles
+            results[i] = result
+            if not particle_schedule.is_confident(result["raw_genparse_output"]):
+                still_pending.append(i)
+        pending = still_pending
+
+    for result, spent in zip(results, n_particles_spent):
+        result["n_particles_spent"] = spent
+        logger.debug("Spent %d particles on sentence: %s", spent, result["sentence"])
+    return results
+
+
+def _log_particles_spent(results: Iterable[dict[str, Any]]) -> Iterator[dict[str, Any]]:
     """
-    Get the inference endpoint URL for the given server IP or hostname.
+    Pass through results from adaptive inference, logging the mean particles spent per sentence at the end.
     """
-    logger.debug('Sleeping for %d waiting for genparse to reboot', WAIT_FOR_GENPARSE_REBOOT)
-    time.sleep(WAIT_FOR_GENPARSE_REBOOT)
+    n_results = 0
+    n_particles_spent = 0
+    for result in results:
+        n_results += 1
+        n_particles_spent += result["n_particles_spent"]
+        yield result
+    if n_results:
+        logger.info("Spent %.1f particles per sentence on average", n_particles_spent / n_results)
 
 
 def extract_info_with_genparse_server(
     sentence_datum: dict[str, Any],
     *,
-    server: str,
-    tokenizer: PreTrainedTokenizer,
+    call_server: CallServer,
+    render_prompt: Callable[[str], str],
     temperature: float,
     n_particles: int,
     max_new_tokens: int = MAX_TOKENS,
+    cache: Optional[PosteriorCache] = None,
 ) -> dict[str, Any]:
     """
     Process sentences using Genparse inference server and extract relevant information.
+
+    The request is made with `call_server`, like `ServerPool.call`, and only if the posterior isn't cached.
     """
-    prompt = make_prompt(sentence_datum, tokenizer=tokenizer)
-    inference_params = {
-        "prompt": prompt,
-        "method": SAMPLING_METHOD,
-        "n_particles": n_particles,
-        "lark_grammar": GRAMMAR,
-        "proposal_name": PROPOSAL_NAME,
-        "proposal_args": {},
-        "max_tokens": max_new_tokens,
-        "temperature": temperature,
-    }
-    response = requests.post(
-        inference_endpoint(server), headers={"Content-Type": "application/json"}, json=inference_params
+    prompt = make_prompt(sentence_datum, render_prompt=render_prompt)
+    inference_params = make_inference_params(
+        prompt, temperature=temperature, n_particles=n_particles, max_new_tokens=max_new_tokens
     )
-    posterior = response.json()["posterior"]
+
+    def infer_on(server: str) -> dict[str, float]:
+        response = get_session().post(
+            inference_endpoint(server), headers={"Content-Type": "application/json"}, json=inference_params
+        )
+        response.raise_for_status()
+        return response.json()["posterior"]
+
+    def infer() -> dict[str, float]:
+        return call_server(infer_on, work=n_particles)
+
+    posterior = _get_posterior_cached(inference_params, model=GENPARSE_SERVER_MODEL, cache=cache, infer=infer)
     result = augment_sentence_with_genparse_output(sentence_datum, posterior)
     result["genparse_prompt"] = prompt
     return result
 
 
+def extract_info_with_genparse_server_batch(
+    sentence_batch: Sequence[dict[str, Any]],
+    *,
+    call_server: CallServer,
+    split_prompt: SplitPrompt,
+    temperature: float,
+    n_particles: int,
+    max_new_tokens: int = MAX_TOKENS,
+    cache: Optional[PosteriorCache] = None,
+) -> list[dict[str, Any]]:
+    """
+    Process a batch of sentences with one Genparse server request that sends their shared prompt prefix only once.
+
+    The server can then reuse the prefix's KV cache across the batch. Posteriors are cached exactly as in
+    `extract_info_with_genparse_server`, and only sentences without a cached posterior are sent.
+    """
+    prompts = [make_prompt(sentence_datum, render_prompt=split_prompt.render) for sentence_datum in sentence_batch]
+    sampling_params = make_sampling_params(
+        temperature=temperature, n_particles=n_particles, max_new_tokens=max_new_tokens
+    )
+
+    def infer_batch(to_infer: list[str]) -> list[dict[str, float]]:
+        def infer_on(server: str) -> list[dict[str, float]]:
+            response = get_session().post(
+                batch_inference_endpoint(server),
+                headers={"Content-Type": "application/json"},
+                json={
+                    "prompt_prefix": split_prompt.prefix,
+                    "prompts": [prompt.removeprefix(split_prompt.prefix) for prompt in to_infer],
+                    **sampling_params,
+                },
+            )
+            response.raise_for_status()
+            return response.json()["posteriors"]
+
+        return call_server(infer_on, work=n_particles * len(to_infer))
+
+    posteriors = _get_posteriors_cached_batch(
+        prompts, sampling_params, model=GENPARSE_SERVER_MODEL, cache=cache, infer_batch=infer_batch
+    )
+    return _augment_batch(sentence_batch, prompts, posteriors)
+
+
+def _call_genparse_server_retrying(
+    extract: Callable[..., T],
+    inputs: Any,
+    *,
+    pool: ServerPool,
+    max_retries: int,
+    retry_read_timeouts: bool = False,
+    **kwargs: Any,
+) -> T:
+    """
+    Call `extract(inputs, call_server=pool.call, **kwargs)`, retrying on connection errors, HTTP errors and malformed
+    responses.
+
+    Read timeouts aren't retried unless `retry_read_timeouts` is true, since the server is usually still working on
+    the timed-out request, and resending it would only add to its load.
+
+    Each attempt's request goes through the pool, so a retry may go to a different server, failures count towards
+    restarting the server they happened on, and retries avoid servers that are restarting.
+    """
+    return call_with_retries(
+        partial(extract, inputs, call_server=pool.call, **kwargs),
+        max_retries=max_retries,
+        retry_on=(requests.RequestException, KeyError, ValueError),
+        give_up_on=() if retry_read_timeouts else (requests.ReadTimeout,),
+    )
+
+
+def extract_info_with_genparse_server_concurrently(
+    sentence_data: Iterable[dict[str, Any]],
+    *,
+    pool: ServerPool,
+    max_in_flight: int,
+    max_retries: int,
+    retry_read_timeouts: bool = False,
+    prefix_sharing_batch_size: Optional[int] = None,
+    particle_schedule: Optional[ParticleSchedule] = None,
+    **kwargs: Any,
+) -> Iterator[dict[str, Any]]:
+    """
+    Process sentences using the pool's Genparse servers with up to `max_in_flight` requests outstanding at once in
+    total.
+
+    Outputs are yielded in input order. Each request goes to the least loaded server, and if the pool restarts servers,
+    it drains a server's in-flight requests before restarting it so that no request is cut off by the restart.
+
+    By default each sentence is its own request, and extra keyword arguments are passed through to
+    `extract_info_with_genparse_server`. If `prefix_sharing_batch_size` is given, we instead send that many sentences
+    per request using `extract_info_with_genparse_server_batch`, which gets the extra keyword arguments.
+
+    If `particle_schedule` is given, we choose the number of particles for each sentence adaptively.
+    """
+    if prefix_sharing_batch_size is None:
+        extract = partial(
+            _call_genparse_server_retrying,
+            extract_info_with_genparse_server,
+            pool=pool,
+            max_retries=max_retries,
+            retry_read_timeouts=retry_read_timeouts,
+            **kwargs,
+        )
+        if particle_schedule is not None:
+            extract = partial(extract_info_adaptively, extract=extract, particle_schedule=particle_schedule)
+        yield from ordered_map(extract, sentence_data, max_in_flight=max_in_flight)
+    else:
+        extract_batch = partial(
+            _call_genparse_server_retrying,
+            extract_info_with_genparse_server_batch,
+            pool=pool,
+            max_retries=max_retries,
+            retry_read_timeouts=retry_read_timeouts,
+            **kwargs,
+        )
+        if particle_schedule is not None:
+            extract_batch = partial(
+                extract_batch_adaptively, extract_batch=extract_batch, particle_schedule=particle_schedule
+            )
+        for batch_result in ordered_map(
+            extract_batch, chunked(sentence_data, prefix_sharing_batch_size), max_in_flight=max_in_flight
+        ):
+            yield from batch_result
+
+
 def main():
     parser = ArgumentParser(description=__doc__)
     parser.add_argument("sentences_path", type=Path, help="Path to the JSONL file containing the sentences.")
@@ -340,14 +529,81 @@ def main():
     parser.add_argument(
         "--genparse-server",
         type=str,
+        nargs="+",
         default=None,
-        help="Genparse server to use for inference. If none, run inference locally.",
+        help=(
+            "Genparse servers to use for inference. Requests go to whichever server has the fewest outstanding. If "
+            "none, run inference locally."
+        ),
     )
     parser.add_argument(
         "--restart-server-every",
         type=int,
-        default=DEFAULT_RESTART_SERVER_EVERY,
-        help="How many instances to send to the server before restarting the server.",
+        default=None,
+        help="If given, also restart each server after this many requests, however healthy it seems.",
+    )
+    parser.add_argument(
+        "--restart-latency-factor",
+        type=float,
+        default=DEFAULT_LATENCY_FACTOR,
+        help=(
+            "Restart a server when its median latency grows by this factor over the latency after a restart. "
+            "Latency is measured per particle per prompt, so that requests with more particles (say, with "
+            "--particle-schedule) or more prompts (with --prefix-sharing-batch-size) don't look slow, and requests "
+            "answered from the posterior cache don't count. Pass 0 to never restart on latency."
+        ),
+    )
+    parser.add_argument(
+        "--restart-after-errors",
+        type=int,
+        default=DEFAULT_MAX_CONSECUTIVE_ERRORS,
+        help="Restart a server after this many failed requests to it in a row.",
+    )
+    parser.add_argument(
+        "--restart-memory-fraction",
+        type=float,
+        default=DEFAULT_MAX_MEMORY_FRACTION,
+        help="Restart a server when its health endpoint reports using more than this fraction of its memory.",
+    )
+    parser.add_argument(
+        "--no-restarts",
+        action="store_true",
+        help="Never restart the Genparse servers.",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=DEFAULT_MAX_IN_FLIGHT,
+        help="Maximum number of concurrent requests across all Genparse servers. Only relevant when using servers.",
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=DEFAULT_MAX_RETRIES,
+        help="How many times to retry a failed request to the Genparse server before giving up.",
+    )
+    parser.add_argument(
+        "--read-timeout-seconds",
+        type=float,
+        default=None,
+        help="How long to wait for a response from the Genparse server. If not given, wait indefinitely.",
+    )
+    parser.add_argument(
+        "--retry-read-timeouts",
+        action="store_true",
+        help=(
+            "Retry requests that hit --read-timeout-seconds. Off by default since the server is usually still working "
+            "on the request, and with --prefix-sharing-batch-size a retry resends the whole batch."
+        ),
+    )
+    parser.add_argument(
+        "--prefix-sharing-batch-size",
+        type=int,
+        default=None,
+        help=(
+            "If given, send this many sentences per request to the server's batch endpoint, declaring their shared "
+            "prompt prefix once. The server must support `/infer_batch`."
+        ),
     )
     parser.add_argument(
         "--batch-size",
@@ -358,9 +614,60 @@ def main():
     parser.add_argument(
         "--n-particles", type=int, default=DEFAULT_N_PARTICLES, help="Number of particles to use for inference."
     )
+    parser.add_argument(
+        "--particle-schedule",
+        type=int,
+        nargs="+",
+        default=None,
+        help=(
+            "If given, choose the number of particles per sentence adaptively: try each of these particle counts in "
+            "turn until the posterior is confident. Overrides --n-particles."
+        ),
+    )
+    parser.add_argument(
+        "--min-map-margin",
+        type=float,
+        default=DEFAULT_MIN_MAP_MARGIN,
+        help="With --particle-schedule, the smallest margin of the MAP output's probability over the runner-up's.",
+    )
+    parser.add_argument(
+        "--max-entropy-bits",
+        type=float,
+        default=DEFAULT_MAX_ENTROPY_BITS,
+        help="With --particle-schedule, the largest posterior entropy in bits to accept.",
+    )
     parser.add_argument(
         "--temperature", type=float, default=DEFAULT_TEMPERATURE, help="Temperature to use for inference."
         )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=None,
+        help="Directory for the on-disk posterior cache. If none, don't cache posteriors.",
+    )
+    parser.add_argument(
+        "--cache-max-mib",
+        type=int,
+        default=DEFAULT_MAX_CACHE_MIB,
+        help="Maximum size of the posterior cache in MiB. Least recently used posteriors are evicted first.",
+    )
+    parser.add_argument(
+        "--prompt-cache-dir",
+        type=Path,
+        default=None,
+        help="Directory to save the precomputed chat prompt in, so later runs don't need to load the tokenizer.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume a crashed run by skipping sentences already written to the output file and appending the rest.",
+    )
+    parser.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=DEFAULT_CHECKPOINT_EVERY,
+        help="How many sentences to write between flushing the output file to disk.",
+    )
     parser.add_argument(
         "--logging-level", type=str, default="INFO", help="Logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)."
     )
@@ -375,65 +682,129 @@ def main():
     sentences_path: Path = args.sentences_path
     write_to_path: Path = args.write_to_path
     model: str = args.model
-    genparse_server: Optional[str] = args.genparse_server
-    restart_server_every: int = args.restart_server_every
+    genparse_servers: Optional[list[str]] = args.genparse_server
+    restart_server_every: Optional[int] = args.restart_server_every
+    restart_latency_factor: float = args.restart_latency_factor
+    restart_after_errors: int = args.restart_after_errors
+    restart_memory_fraction: float = args.restart_memory_fraction
+    no_restarts: bool = args.no_restarts
+    max_in_flight: int = args.max_in_flight
+    max_retries: int = args.max_retries
+    read_timeout_seconds: Optional[float] = args.read_timeout_seconds
+    retry_read_timeouts: bool = args.retry_read_timeouts
+    prefix_sharing_batch_size: Optional[int] = args.prefix_sharing_batch_size
     batch_size: int = args.batch_size
     n_particles: int = args.n_particles
+    particle_schedule_n_particles: Optional[list[int]] = args.particle_schedule
+    min_map_margin: float = args.min_map_margin
+    max_entropy_bits: float = args.max_entropy_bits
     temperature: float = args.temperature
-
-    assert restart_server_every > 0
+    cache_dir: Optional[Path] = args.cache_dir
+    cache_max_mib: int = args.cache_max_mib
+    prompt_cache_dir: Optional[Path] = args.prompt_cache_dir
+    resume: bool = args.resume
+    checkpoint_every: int = args.checkpoint_every
+
+    assert restart_server_every is None or restart_server_every > 0
+    assert restart_latency_factor == 0 or restart_latency_factor > 1.0
+    assert restart_after_errors > 0
+    assert 0.0 < restart_memory_fraction <= 1.0
+    assert max_in_flight > 0
+    assert max_retries >= 0
+    assert read_timeout_seconds is None or read_timeout_seconds > 0
+    assert prefix_sharing_batch_size is None or prefix_sharing_batch_size > 0
     assert batch_size > 0
     assert n_particles > 0
+    assert particle_schedule_n_particles is None or all(n > 0 for n in particle_schedule_n_particles)
+    assert 0.0 <= min_map_margin <= 1.0
+    assert max_entropy_bits >= 0.0
     assert temperature >= 0.0
-
-    genparse_params = {"n_particles": args.n_particles, "temperature": temperature}
+    assert cache_max_mib > 0
+    assert checkpoint_every > 0
+
+    cache = PosteriorCache(cache_dir, max_bytes=cache_max_mib * BYTES_PER_MIB) if cache_dir else None
+    genparse_params = {"temperature": temperature, "cache": cache}
+    particle_schedule = None
+    if particle_schedule_n_particles:
+        particle_schedule = ParticleSchedule(
+            n_particles=particle_schedule_n_particles, min_map_margin=min_map_margin, max_entropy_bits=max_entropy_bits
+        )
+        logger.info("Choosing particles adaptively from %s", particle_schedule_n_particles)
+    else:
+        genparse_params["n_particles"] = n_particles
 
     if not sentences_path.exists() or not sentences_path.is_file():
         raise FileNotFoundError(f"Input file does not exist or is not a file: {sentences_path}")
     if write_to_path.exists() and write_to_path.is_dir():
         raise ValueError(f"Output path is a directory, not a file: {write_to_path}")
 
-    if genparse_server:
+    if genparse_servers:
         assert model == GENPARSE_SERVER_MODEL
-        logger.info("Using Genparse server %s", genparse_server)
+        logger.info("Using Genparse servers %s", ", ".join(genparse_servers))
+        # At most `max_in_flight` requests can go to any one server at once.
+        configure_session(pool_maxsize=max_in_flight, read_timeout_seconds=read_timeout_seconds)
+        make_restart_manager = None
+        if not no_restarts:
+            make_restart_manager = partial(
+                RestartManager,
+                policy=RestartPolicy(
+                    latency_factor=restart_latency_factor or None,
+                    max_consecutive_errors=restart_after_errors,
+                    max_memory_fraction=restart_memory_fraction,
+                    max_requests=restart_server_every,
+                ),
+            )
+        pool = ServerPool(genparse_servers, make_restart_manager=make_restart_manager)
     else:
         logger.info(f"Loading model `%s`", model)
         inference_setup = genparse.InferenceSetupVLLM(
             model, GRAMMAR, proposal_name="character", batch_size=batch_size
         )
-        nlp = spacy.load(spacy_model)
         logger.info("Successfully loaded model `%s`", model)
 
-    logger.info("Loading tokenizer for model `%s`", model)
-    tokenizer = AutoTokenizer.from_pretrained(model)
-    logger.info("Successfully loaded tokenizer for model `%s`", model)
+    if genparse_servers and prefix_sharing_batch_size is not None:
+        prompt_params = {"split_prompt": load_sentence_split_prompt(model, cache_dir=prompt_cache_dir)}
+    else:
+        prompt_params = {"render_prompt": load_prompt_renderer(model, cache_dir=prompt_cache_dir)}
 
     logger.info("Loading JSONL data from: `%s`", sentences_path)
     sentence_data = read_jsonl(sentences_path)
+    if resume:
+        sentence_data = skip_completed(sentence_data, write_to_path)
     n_written: int = 0
-    if genparse_server:
-        n_written = write_jsonl(
-            # jac: Weird hack to restart the server every so often within a generator expression.
-            #
-            # When i > 0 and i % restart_server_every != 0 evaluates to false, that means we're on
-            # a `restart_server_every`-th iteration. Then the or means we restart the server.
-            # We then AND this with the result of extract_... so that the generator yields the extracted info objects,
-            # i.e. the values we actually care about.
-            ((i == 0 or i % restart_server_every != 0 or _restart_server(genparse_server) is None)
-             and extract_info_with_genparse_server(
-                sentence_datum, server=genparse_server, tokenizer=tokenizer, **genparse_params
-            ) for i, sentence_datum in enumerate(sentence_data)),
-            write_to_path
+    if genparse_servers:
+        results = extract_info_with_genparse_server_concurrently(
+            sentence_data,
+            pool=pool,
+            max_in_flight=max_in_flight,
+            max_retries=max_retries,
+            retry_read_timeouts=retry_read_timeouts,
+            prefix_sharing_batch_size=prefix_sharing_batch_size,
+            particle_schedule=particle_schedule,
+            **prompt_params,
+            **genparse_params,
         )
     else:
-        n_written = write_jsonl(
-            (extract_info_with_genparse_locally(
-                sentence_datum, inference_setup=inference_setup, tokenizer=tokenizer, **genparse_params
-            ) for sentence_datum in sentence_data),
-            write_to_path
+        extract = partial(
+            extract_info_with_genparse_locally,
+            inference_setup=inference_setup,
+            model=model,
+            **prompt_params,
+            **genparse_params,
         )
+        if particle_schedule is not None:
+            extract = partial(extract_info_adaptively, extract=extract, particle_schedule=particle_schedule)
+        results = (extract(sentence_datum) for sentence_datum in sentence_data)
+    if particle_schedule is not None:
+        results = _log_particles_spent(results)
+    n_written = write_jsonl(results, write_to_path, append=resume, checkpoint_every=checkpoint_every)
 
     logger.info("Wrote %d sentences to `%s` augmented with GenFact entities", n_written, write_to_path)
+    if genparse_servers:
+        pool.log_summary()
+    if cache is not None:
+        logger.info("Posterior cache %s: %d hits, %d misses", cache.path, cache.hits, cache.misses)
+        cache.close()
 
 
 if __name__ == "__main__":
@@ -15,21 +15,41 @@ from typing import Any, Iterable, Iterator, Sequence
 import spacy
 from spacy.language import Language
 
-from scripts.utils.jsonl import read_jsonl, write_jsonl
+from scripts.utils.jsonl import read_jsonl, skip_completed, write_jsonl
 
 
 logger = logging.getLogger(__name__)
 
 
-def extract_info_with_spacy(sentence_data: Iterable[dict[str, Any]], nlp: Language) -> Iterator[dict[str, Any]]:
+DEFAULT_CHECKPOINT_EVERY = 100
+DEFAULT_BATCH_SIZE = 256
+DEFAULT_N_PROCESS = 1
+# We only use the entity recognizer, so we can skip everything else except what it listens to (tok2vec/transformer).
+UNNEEDED_COMPONENTS = ("tagger", "morphologizer", "parser", "senter", "attribute_ruler", "lemmatizer")
+
+
+def extract_info_with_spacy(
+    sentence_data: Iterable[dict[str, Any]],
+    nlp: Language,
+    *,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    n_process: int = DEFAULT_N_PROCESS,
+) -> Iterator[dict[str, Any]]:
     """
     Process sentences using spaCy and extract relevant NER entities.
 
     We assume the sentence is under the "sentence" key and add info under "extracted_info", adding to any extracted
     info already present.
+
+    Sentences are streamed through `nlp.pipe` in batches of `batch_size` using `n_process` worker processes. Outputs
+    come back in input order.
     """
-    for sentence_datum in sentence_data:
-        doc = nlp(sentence_datum["sentence"])
+    for doc, sentence_datum in nlp.pipe(
+        ((sentence_datum["sentence"], sentence_datum) for sentence_datum in sentence_data),
+        as_tuples=True,
+        batch_size=batch_size,
+        n_process=n_process,
+    ):
         names = [ent.text for ent in doc.ents if ent.label_ == "PERSON"]
         cities = [ent.text for ent in doc.ents if ent.label_ == "GPE"]
         extracted_info = {
@@ -40,11 +60,40 @@ def extract_info_with_spacy(sentence_data: Iterable[dict[str, Any]], nlp: Langua
         yield {**sentence_datum, "extracted_info": extracted_info}
 
 
+def disable_unneeded_components(nlp: Language) -> list[str]:
+    """
+    Disable the pipeline components we don't need for NER, returning the names of those disabled.
+    """
+    result = [name for name in UNNEEDED_COMPONENTS if name in nlp.pipe_names]
+    nlp.select_pipes(disable=result)
+    return result
+
+
 def main():
     parser = ArgumentParser(description=__doc__)
     parser.add_argument("sentences_path", type=Path, help="Path to the JSONL file containing the sentences")
     parser.add_argument("write_to_path", type=Path, help="Path to write the processed JSONL file to")
     parser.add_argument("--spacy-model", type=str, default="en_web_core_sm", help="spaCy model to use for processing")
+    parser.add_argument(
+        "--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Number of sentences to process in one batch"
+    )
+    parser.add_argument(
+        "--n-process",
+        type=int,
+        default=DEFAULT_N_PROCESS,
+        help="Number of processes to use for spaCy processing (-1 to use all cores)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume a crashed run by skipping sentences already written to the output file and appending the rest",
+    )
+    parser.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=DEFAULT_CHECKPOINT_EVERY,
+        help="How many sentences to write between flushing the output file to disk",
+    )
     parser.add_argument(
         "--logging-level", type=str, default="INFO", help="Logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)"
     )
@@ -59,6 +108,14 @@ def main():
     sentences_path: Path = args.sentences_path
     write_to_path: Path = args.write_to_path
     spacy_model: str = args.spacy_model
+    resume: bool = args.resume
+    checkpoint_every: int = args.checkpoint_every
+    batch_size: int = args.batch_size
+    n_process: int = args.n_process
+
+    assert checkpoint_every > 0
+    assert batch_size > 0
+    assert n_process > 0 or n_process == -1
 
     if not sentences_path.exists() or not sentences_path.is_file():
         raise FileNotFoundError(f"Input file does not exist or is not a file: {sentences_path}")
@@ -68,11 +125,14 @@ def main():
     logger.info(f"Loading spaCy model `%s`", spacy_model)
     nlp = spacy.load(spacy_model)
     logger.info("Successfully loaded spaCy model `%s`", spacy_model)
+    logger.info("Disabled unneeded spaCy components: %s", disable_unneeded_components(nlp))
 
     logger.info("Loading JSONL data from: `%s`", sentences_path)
     sentence_data = read_jsonl(sentences_path)
-    augmented_sentence_data = extract_info_with_spacy(sentence_data, nlp)
-    n_written = write_jsonl(augmented_sentence_data, write_to_path)
+    if resume:
+        sentence_data = skip_completed(sentence_data, write_to_path)
+    augmented_sentence_data = extract_info_with_spacy(sentence_data, nlp, batch_size=batch_size, n_process=n_process)
+    n_written = write_jsonl(augmented_sentence_data, write_to_path, append=resume, checkpoint_every=checkpoint_every)
     logger.info("Wrote %d sentences to `%s` augmented with spaCy entities", n_written, write_to_path)
 
 
@@ -10,18 +10,18 @@ from pathlib import Path
 from typing import Any, Iterable, Optional
 
 from scripts.evaluate_docnames import join_medicare_names
-from scripts.utils.jsonl import read_jsonl
+from scripts.utils.docnames_data import Inference, read_inferences
 
 
 logger = logging.getLogger(__name__)
 
 
-def _n_names(inference: dict[str, Any]) -> int:
-    return len(inference["extracted_info"]["names"])
+def _n_names(inference: Inference) -> int:
+    return len(inference.extracted_info.names)
 
 
-def _n_cities(inference: dict[str, Any]) -> int:
-    return len(inference["extracted_info"]["cities"])
+def _n_cities(inference: Inference) -> int:
+    return len(inference.extracted_info.cities)
 
 
 def _compute_fieldnames(max_names: int, max_cities: int) -> list[str]:
@@ -36,25 +36,26 @@ def _compute_fieldnames(max_names: int, max_cities: int) -> list[str]:
     return result
 
 
-def _make_row(inference: dict[str, Any]) -> dict[str, Any]:
+def _make_row(inference: Inference) -> dict[str, Any]:
     """Convert inferences into CSV rows."""
-    true_name = join_medicare_names(inference["generation_features"])
-    true_city = inference["generation_features"].get("City/Town")
+    prompted_sentence = inference.prompted_sentence
+    true_name = join_medicare_names(prompted_sentence.generation_features)
+    true_city = prompted_sentence.generation_features.get("City/Town")
     result = {
-        "Sentence": inference["sentence"],
-        "Typos In Sentence?": inference["attempted_to_typo"],
+        "Sentence": prompted_sentence.sentence,
+        "Typos In Sentence?": prompted_sentence.attempted_to_typo,
         "True Name": true_name,
         "True City": true_city,
-        "City Included?": "City/Town" in inference["generation_features"],
-        "# Extracted Names": len(inference["extracted_info"]["names"]),
-        "# Extracted Cities": len(inference["extracted_info"]["cities"]),
+        "City Included?": "City/Town" in prompted_sentence.generation_features,
+        "# Extracted Names": _n_names(inference),
+        "# Extracted Cities": _n_cities(inference),
     }
 
-    for i, name in enumerate(inference["extracted_info"]["names"], start=1):
+    for i, name in enumerate(inference.extracted_info.names, start=1):
         result[f"Extracted Name {i}"] = name
         result[f"Extracted Name {i} Correct?"] = true_name and name.upper() == true_name
 
-    for i, city in enumerate(inference["extracted_info"]["cities"], start=1):
+    for i, city in enumerate(inference.extracted_info.cities, start=1):
         result[f"Extracted City {i}"] = city
         result[f"Extracted City {i} Correct?"] = true_city and city.upper() == true_city
 
@@ -99,7 +100,7 @@ def main() -> None:
     rows = []
     max_names = 0
     max_cities = 0
-    for inference in read_jsonl(inferences_path):
+    for inference in read_inferences(inferences_path):
         rows.append(_make_row(inference))
         max_names = max(max_names, _n_names(inference))
         max_cities = max(max_cities, _n_cities(inference))
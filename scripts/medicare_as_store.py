@@ -0,0 +1,42 @@
+"""
+Script to convert the Medicare CSV into a columnar, memory-mapped store for faster sampling and feature lookups.
+"""
+from argparse import ArgumentParser
+import logging
+from pathlib import Path
+
+from scripts.utils.medicare_store import convert_csv_to_store
+
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("medicare_csv", type=Path, help="The path to the Medicare dataset (or a sample of it).")
+    parser.add_argument("store_dir", type=Path, help="The directory to write the store to.")
+    parser.add_argument(
+        "--logging-level",
+        type=str,
+        default="INFO",
+        help="Logging level to use.",
+    )
+    args = parser.parse_args()
+
+    medicare_csv_path: Path = args.medicare_csv
+    store_dir: Path = args.store_dir
+
+    logging.basicConfig(
+        level=getattr(logging, args.logging_level),
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+    if not medicare_csv_path.is_file():
+        raise FileNotFoundError(f"[Medicare CSV] No such file: {medicare_csv_path}")
+
+    convert_csv_to_store(medicare_csv_path, store_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+Script to merge the shards written by `generate_docnames_sentences.py --shard i/N` into one sentences file.
+"""
+from argparse import ArgumentParser
+import logging
+from pathlib import Path
+
+from scripts.utils.sharding import merge_shards
+
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "sentences_path",
+        type=Path,
+        help="The `sentences_path` the shards were generated with, where we write the merged sentences.",
+    )
+    parser.add_argument("n_shards", type=int, help="The number of shards the rows were split into.")
+    parser.add_argument(
+        "--logging-level",
+        type=str,
+        default="INFO",
+        help="Logging level to use.",
+    )
+    args = parser.parse_args()
+
+    sentences_path: Path = args.sentences_path
+    n_shards: int = args.n_shards
+
+    logging.basicConfig(
+        level=getattr(logging, args.logging_level),
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+    assert n_shards > 0
+
+    n_sentences = merge_shards(sentences_path, n_shards)
+    logger.info("Merged %d shards with %d sentences into %s", n_shards, n_sentences, sentences_path)
+
+
+if __name__ == "__main__":
+    main()
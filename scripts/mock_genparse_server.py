@@ -0,0 +1,238 @@
+"""
+A local mock of the Genparse inference server, for testing the inference scripts without a GPU.
+
+It serves the same endpoints as the real server: `/infer` on the inference port and `/restart` on the restart port. It
+also serves a `/health` probe, which reports simulated memory use, and `/infer_batch`, a batch-aware format that
+declares the prompt prefix shared by a group of prompts once:
+
+    {"prompt_prefix": "<chat prompt up to the sentence>", "prompts": ["<sentence + rest of prompt>", ...],
+     "method": ..., "n_particles": ..., "lark_grammar": ..., ...}
+
+Each prompt is inferred as `prompt_prefix + prompt` with the shared parameters, so a server can compute the prefix's
+KV cache once per batch. The response is `{"posteriors": [...]}`, one posterior per prompt, in request order.
+
+The mock "extracts" the last name following "Dr." in the final `Input:` line of each prompt. With `--prefix-seconds`
+and `--prompt-seconds` it sleeps to simulate inference cost, charging the prefix cost once per batch request. Each
+prompt uses `--memory-per-prompt` of the server's memory, and once memory is full requests fail until the server is
+restarted. A restart makes the server unavailable (answering 503) for `--restart-seconds`.
+"""
+from argparse import ArgumentParser
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import re
+import threading
+import time
+from typing import Any, Optional
+
+from scripts.utils.http_client import GENPARSE_INFERENCE_PORT, GENPARSE_RESTART_PORT
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_HOST = "127.0.0.1"
+ASSISTANT_PREFIX = "<|start_header_id|>assistant<|end_header_id|>"
+DOCTOR_PATTERN = re.compile(r"Dr\.?\s+([A-Z][\w'-]*)")
+
+
+def mock_posterior(prompt: str) -> dict[str, float]:
+    """
+    Make a deterministic fake posterior for the given full prompt.
+    """
+    sentence = prompt.rsplit("Input:", maxsplit=1)[-1].split("\nOutput:", maxsplit=1)[0]
+    match = DOCTOR_PATTERN.search(sentence)
+    if match is None:
+        return {ASSISTANT_PREFIX + json.dumps({}): 1.0}
+    return {
+        ASSISTANT_PREFIX + json.dumps({"last": match.group(1)}): 0.75,
+        ASSISTANT_PREFIX + json.dumps({"first": None, "last": match.group(1)}): 0.125,
+        "not JSON": 0.125,
+    }
+
+
+@dataclass
+class MockGenparseState:
+    """
+    Simulation settings and state shared by the inference and restart ports of one mock server.
+    """
+
+    prefix_seconds: float = 0.0
+    prompt_seconds: float = 0.0
+    memory_per_prompt: float = 0.0
+    restart_seconds: float = 0.0
+    memory_used_fraction: float = 0.0
+    down_until: float = 0.0
+    n_restarts: int = 0
+    bytes_received: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def is_down(self) -> bool:
+        return time.monotonic() < self.down_until
+
+    def restart(self) -> None:
+        with self.lock:
+            self.down_until = time.monotonic() + self.restart_seconds
+            self.memory_used_fraction = 0.0
+            self.n_restarts += 1
+
+
+class MockGenparseHandler(BaseHTTPRequestHandler):
+    """
+    Handles requests to the mock server, simulating costs according to the server's `state`.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def _send_json(self, status: int, body: Any) -> None:
+        encoded = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def _read_json(self) -> Optional[dict[str, Any]]:
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length)
+        with self.server.state.lock:
+            self.server.state.bytes_received += length
+        try:
+            return json.loads(raw)
+        except ValueError:
+            self._send_json(400, {"error": "Request body is not JSON"})
+            return None
+
+    def do_GET(self) -> None:
+        state: MockGenparseState = self.server.state
+        if self.path != "/health":
+            self._send_json(404, {"error": f"No route {self.path}"})
+        elif state.is_down():
+            self._send_json(503, {"status": "restarting"})
+        else:
+            self._send_json(200, {"status": "ok", "memory_used_fraction": state.memory_used_fraction})
+
+    def do_POST(self) -> None:
+        state: MockGenparseState = self.server.state
+        if self.path == "/restart":
+            logger.info("Restart requested")
+            state.restart()
+            self._send_json(200, {"status": "restarting"})
+            return
+
+        if self.path not in ("/infer", "/infer_batch"):
+            self._send_json(404, {"error": f"No route {self.path}"})
+            return
+        request = self._read_json()
+        if request is None:
+            return
+        if state.is_down():
+            self._send_json(503, {"error": "Restarting"})
+            return
+
+        if self.path == "/infer":
+            prompts = [request["prompt"]]
+        else:
+            prompts = [request["prompt_prefix"] + prompt for prompt in request["prompts"]]
+        with state.lock:
+            state.memory_used_fraction += state.memory_per_prompt * len(prompts)
+            out_of_memory = state.memory_used_fraction >= 1.0
+        if out_of_memory:
+            self._send_json(500, {"error": "Out of memory"})
+            return
+        time.sleep(state.prefix_seconds + state.prompt_seconds * len(prompts))
+        posteriors = [mock_posterior(prompt) for prompt in prompts]
+        logger.debug("Answered %s with %d prompts", self.path, len(prompts))
+        if self.path == "/infer":
+            self._send_json(200, {"posterior": posteriors[0]})
+        else:
+            self._send_json(200, {"posteriors": posteriors})
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(format, *args)
+
+
+def make_server(host: str, port: int, state: MockGenparseState) -> ThreadingHTTPServer:
+    """
+    Make (but don't start) a mock Genparse server on the given host and port.
+
+    Pass port 0 to pick a free port, available afterwards as `server.server_address[1]`. Give the inference and restart
+    servers the same state.
+    """
+    result = ThreadingHTTPServer((host, port), MockGenparseHandler)
+    result.daemon_threads = True
+    result.state = state
+    return result
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--host", type=str, default=DEFAULT_HOST, help="Host to listen on.")
+    parser.add_argument(
+        "--prefix-seconds",
+        type=float,
+        default=0.0,
+        help="Simulated time to process a prompt prefix. Charged once per request.",
+    )
+    parser.add_argument(
+        "--prompt-seconds",
+        type=float,
+        default=0.0,
+        help="Simulated time to process each prompt's own tokens.",
+    )
+    parser.add_argument(
+        "--memory-per-prompt",
+        type=float,
+        default=0.0,
+        help="Simulated fraction of server memory used up by each prompt until the next restart.",
+    )
+    parser.add_argument(
+        "--restart-seconds",
+        type=float,
+        default=0.0,
+        help="Simulated time the server is unavailable while restarting.",
+    )
+    parser.add_argument(
+        "--logging-level",
+        type=str,
+        default="INFO",
+        help="Logging level to use.",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=getattr(logging, args.logging_level),
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+    state = MockGenparseState(
+        prefix_seconds=args.prefix_seconds,
+        prompt_seconds=args.prompt_seconds,
+        memory_per_prompt=args.memory_per_prompt,
+        restart_seconds=args.restart_seconds,
+    )
+    servers = [make_server(args.host, port, state) for port in (GENPARSE_INFERENCE_PORT, GENPARSE_RESTART_PORT)]
+    threads = [threading.Thread(target=server.serve_forever, daemon=True) for server in servers]
+    for thread in threads:
+        thread.start()
+    logger.info(
+        "Serving mock Genparse on %s ports %d (inference) and %d (restart)",
+        args.host,
+        GENPARSE_INFERENCE_PORT,
+        GENPARSE_RESTART_PORT,
+    )
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            server.shutdown()
+        logger.info("Received %d request bytes and %d restarts", state.bytes_received, state.n_restarts)
+
+
+if __name__ == "__main__":
+    main()
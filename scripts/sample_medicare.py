@@ -1,12 +1,34 @@
 """
 A script meant for sampling the Medicare dataset.
+
+The default `two-pass` method counts the rows and then samples row indices, which reproduces our existing samples for
+a given seed. The `reservoir` method draws a sample in one streaming pass, optionally stratified by some columns (for
+example `State` or `pri_spec`) so that each stratum is represented in proportion to its size.
+
+With `--n-workers` above 1 we split the file into byte-range chunks on record boundaries and parse them in parallel.
+The two-pass method then gives the same sample as it does serially. The reservoir method draws a different sample,
+which is still deterministic for a given seed and `--chunk-mib`.
+
+The Medicare dataset can also be given as a store directory made by `scripts/medicare_as_store.py`. Sampling then works
+on memory-mapped columns without parsing any CSV, and the two-pass method gives the same sample as it does on the CSV.
 """
 from argparse import ArgumentParser
+from concurrent.futures import Executor, ProcessPoolExecutor
 import csv
+from dataclasses import dataclass
+from functools import partial
+import heapq
+import io
+import itertools
 from pathlib import Path
 import logging
+import math
 import random
-from typing import AbstractSet, Any, Collection, Iterator, TextIO
+from typing import AbstractSet, Any, BinaryIO, Collection, Iterable, Iterator, Optional, Sequence, TextIO, TypeVar
+
+import numpy as np
+
+from scripts.utils.medicare_store import MedicareStore, is_store
 
 
 logger = logging.getLogger(__name__)
@@ -14,6 +36,17 @@ logger = logging.getLogger(__name__)
 
 DEFAULT_SEED = 42
 DEFAULT_N_SAMPLE_ROWS = 1000
+TWO_PASS_METHOD = "two-pass"
+RESERVOIR_METHOD = "reservoir"
+DEFAULT_N_WORKERS = 1
+DEFAULT_CHUNK_MIB = 64
+BYTES_PER_MIB = 1024 ** 2
+SCAN_BLOCK_BYTES = BYTES_PER_MIB
+QUOTE = b'"'
+NEWLINE = b"\n"
+
+T = TypeVar("T")
+R = TypeVar("R")
 
 
 def medicare_csv_reader(medicare_csv_in: TextIO) -> csv.DictReader:
@@ -56,12 +89,371 @@ def sample_rows(medicare_csv_in: TextIO, rows_to_sample: AbstractSet[int]) -> It
     assert matched == len(rows_to_sample)
 
 
+def _random_open(rng: random.Random) -> float:
+    """
+    Draw a uniform random number from the open interval (0, 1), so that it's safe to take its log.
+    """
+    result = rng.random()
+    while result == 0.0:
+        result = rng.random()
+    return result
+
+
+def reservoir_sample(items: Iterable[T], k: int, *, rng: random.Random) -> list[tuple[int, T]]:
+    """
+    Sample `k` items uniformly without replacement in one pass, returning (index, item) pairs in input order.
+
+    This is Li's Algorithm L, which needs only O(k log(n / k)) random numbers for n items.
+    """
+    assert k > 0
+    reservoir: list[tuple[int, T]] = []
+    items = iter(items)
+    for index, item in enumerate(items):
+        reservoir.append((index, item))
+        if len(reservoir) == k:
+            break
+    else:
+        return reservoir
+
+    w = math.exp(math.log(_random_open(rng)) / k)
+    next_index = k - 1
+    while True:
+        next_index += math.floor(math.log(_random_open(rng)) / math.log(1 - w)) + 1
+        for index, item in enumerate(items, start=index + 1):
+            if index == next_index:
+                reservoir[rng.randrange(k)] = (index, item)
+                break
+        else:
+            break
+        w *= math.exp(math.log(_random_open(rng)) / k)
+
+    return sorted(reservoir, key=lambda t: t[0])
+
+
+def _allocate_proportionally(stratum_sizes: dict[Any, int], k: int) -> dict[Any, int]:
+    """
+    Split a sample size of `k` across strata in proportion to their sizes, using largest remainder rounding.
+
+    Ties are broken by stratum key so the allocation is deterministic.
+    """
+    total = sum(stratum_sizes.values())
+    quotas = {stratum: k * size / total for stratum, size in stratum_sizes.items()}
+    result = {stratum: math.floor(quota) for stratum, quota in quotas.items()}
+    leftover = k - sum(result.values())
+    by_remainder = sorted(quotas, key=lambda stratum: (-(quotas[stratum] - result[stratum]), str(stratum)))
+    for stratum in by_remainder[:leftover]:
+        result[stratum] += 1
+    return result
+
+
+def _smallest_keys_by_stratum(
+    rows: Iterable[tuple[R, dict[str, Any]]],
+    k: int,
+    *,
+    stratify_by: Sequence[str],
+    rng: random.Random,
+) -> tuple[dict[tuple[str, ...], int], dict[tuple[str, ...], list[tuple[float, R, dict[str, Any]]]]]:
+    """
+    Give each (row ID, row) pair a uniform random key, keeping the `k` smallest-key rows in each stratum.
+
+    Returns the stratum sizes and, for each stratum, a heap of (negated key, row ID, row) entries.
+    """
+    heaps: dict[tuple[str, ...], list[tuple[float, R, dict[str, Any]]]] = {}
+    stratum_sizes: dict[tuple[str, ...], int] = {}
+    for row_id, row in rows:
+        stratum = tuple(row[column] for column in stratify_by)
+        stratum_sizes[stratum] = stratum_sizes.get(stratum, 0) + 1
+        heap = heaps.setdefault(stratum, [])
+        # Max-heap on key via negation, so the root is the largest key we're keeping.
+        entry = (-rng.random(), row_id, row)
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+        elif entry[0] > heap[0][0]:
+            heapq.heapreplace(heap, entry)
+    return stratum_sizes, heaps
+
+
+def _select_from_strata(
+    stratum_sizes: dict[tuple[str, ...], int],
+    heaps: dict[tuple[str, ...], list[tuple[float, R, dict[str, Any]]]],
+    k: int,
+) -> list[tuple[R, dict[str, Any]]]:
+    """
+    Allocate `k` across strata proportionally and take that many smallest-key rows from each, in row ID order.
+    """
+    allocation = _allocate_proportionally(stratum_sizes, min(k, sum(stratum_sizes.values())))
+    result = []
+    for stratum, heap in heaps.items():
+        smallest_keys = heapq.nlargest(allocation[stratum], heap)
+        result.extend((row_id, row) for _key, row_id, row in smallest_keys)
+    logger.info("Sampled from %d strata of %d rows total", len(heaps), sum(stratum_sizes.values()))
+    return sorted(result, key=lambda t: t[0])
+
+
+def stratified_reservoir_sample(
+    rows: Iterable[dict[str, Any]],
+    k: int,
+    *,
+    stratify_by: Sequence[str],
+    rng: random.Random,
+) -> list[tuple[int, dict[str, Any]]]:
+    """
+    Draw a proportionally stratified sample of `k` rows in one pass, returning (index, row) pairs in input order.
+
+    Each row gets a uniform random key, and we keep the `k` rows with the smallest keys in each stratum. Once we know
+    the stratum sizes we allocate the sample across strata proportionally and take that many smallest-key rows from
+    each. Memory is O(k) per stratum.
+    """
+    assert k > 0
+    stratum_sizes, heaps = _smallest_keys_by_stratum(enumerate(rows), k, stratify_by=stratify_by, rng=rng)
+    return _select_from_strata(stratum_sizes, heaps, k)
+
+
+@dataclass(frozen=True)
+class CsvChunk:
+    """
+    A byte range of a CSV file that starts and ends on record boundaries.
+    """
+
+    path: Path
+    start: int
+    end: int
+
+
+def _count_quotes(csv_path: Path, start: int, end: int) -> int:
+    """
+    Count quote characters in the given byte range of the file.
+    """
+    result = 0
+    with csv_path.open(mode="rb") as csv_in:
+        csv_in.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = csv_in.read(min(SCAN_BLOCK_BYTES, remaining))
+            if not block:
+                break
+            result += block.count(QUOTE)
+            remaining -= len(block)
+    return result
+
+
+def _next_record_start(csv_in: BinaryIO, offset: int, *, in_quotes: bool) -> int:
+    """
+    Find the offset of the first record starting after `offset`, given whether `offset` is inside a quoted field.
+
+    This is the byte after the first newline that isn't inside a quoted field, or the end of the file.
+    """
+    csv_in.seek(offset)
+    position = offset
+    while block := csv_in.read(SCAN_BLOCK_BYTES):
+        i = 0
+        while True:
+            if in_quotes:
+                quote = block.find(QUOTE, i)
+                if quote == -1:
+                    break
+                in_quotes = False
+                i = quote + 1
+            else:
+                newline = block.find(NEWLINE, i)
+                quote = block.find(QUOTE, i, newline if newline != -1 else len(block))
+                if quote != -1:
+                    in_quotes = True
+                    i = quote + 1
+                elif newline != -1:
+                    return position + newline + 1
+                else:
+                    break
+        position += len(block)
+    return position
+
+
+def find_csv_chunks(csv_path: Path, chunk_bytes: int, executor: Executor) -> list[CsvChunk]:
+    """
+    Split the body of the CSV file (everything after the header) into chunks of roughly `chunk_bytes` bytes.
+
+    Fields like `Med_sch` can contain quoted newlines, so not every newline ends a record. Assuming standard CSV quoting,
+    where a literal quote inside a quoted field is written as two quotes, an offset is inside a quoted field exactly
+    when an odd number of quotes come before it. We count quotes in each chunk in parallel, then move each chunk's
+    start forward to the next record boundary.
+    """
+    assert chunk_bytes > 0
+    size = csv_path.stat().st_size
+    offsets = [*range(0, size, chunk_bytes), size]
+    quote_counts = executor.map(partial(_count_quotes, csv_path), offsets[:-1], offsets[1:])
+
+    starts = set()
+    n_quotes = 0
+    with csv_path.open(mode="rb") as csv_in:
+        # Starting from offset 0 skips the header.
+        for offset, quote_count in zip(offsets[:-1], quote_counts):
+            starts.add(_next_record_start(csv_in, offset, in_quotes=n_quotes % 2 == 1))
+            n_quotes += quote_count
+    starts = sorted(start for start in starts if start < size)
+    result = [CsvChunk(csv_path, start, end) for start, end in zip(starts, [*starts[1:], size])]
+    logger.debug("Split %s into %d chunks", csv_path, len(result))
+    return result
+
+
+def read_chunk_rows(chunk: CsvChunk, fieldnames: Sequence[str]) -> Iterator[dict[str, Any]]:
+    """
+    Read the rows in the given chunk of the Medicare CSV.
+    """
+    with chunk.path.open(mode="rb") as csv_in:
+        csv_in.seek(chunk.start)
+        data = csv_in.read(chunk.end - chunk.start)
+    chunk_in = io.StringIO(data.decode("utf-8"), newline="")
+    del data
+    yield from csv.DictReader(chunk_in, fieldnames=fieldnames, dialect=csv.excel)
+
+
+def _count_chunk_rows(fieldnames: Sequence[str], chunk: CsvChunk) -> int:
+    return sum(1 for _row in read_chunk_rows(chunk, fieldnames))
+
+
+def _sample_chunk_rows(
+    fieldnames: Sequence[str],
+    chunk: CsvChunk,
+    first_row_no: int,
+    rows_to_sample: AbstractSet[int],
+) -> list[dict[str, Any]]:
+    return [
+        row
+        for row_no, row in enumerate(read_chunk_rows(chunk, fieldnames), start=first_row_no)
+        if row_no in rows_to_sample
+    ]
+
+
+def _smallest_keys_in_chunk(
+    fieldnames: Sequence[str],
+    k: int,
+    stratify_by: Sequence[str],
+    random_seed: int,
+    chunk: CsvChunk,
+) -> tuple[dict[tuple[str, ...], int], dict[tuple[str, ...], list[tuple[float, tuple[int, int], dict[str, Any]]]]]:
+    rng = random.Random(f"{random_seed}:{chunk.start}")
+    rows = (((chunk.start, index), row) for index, row in enumerate(read_chunk_rows(chunk, fieldnames)))
+    return _smallest_keys_by_stratum(rows, k, stratify_by=stratify_by, rng=rng)
+
+
+def count_rows_chunked(chunks: Sequence[CsvChunk], fieldnames: Sequence[str], executor: Executor) -> list[int]:
+    """
+    Count the rows in each chunk in parallel.
+    """
+    return list(executor.map(partial(_count_chunk_rows, fieldnames), chunks))
+
+
+def sample_rows_chunked(
+    chunks: Sequence[CsvChunk],
+    chunk_row_counts: Sequence[int],
+    rows_to_sample: AbstractSet[int],
+    fieldnames: Sequence[str],
+    executor: Executor,
+) -> Iterator[dict[str, Any]]:
+    """
+    Sample the given set of row numbers from the chunks in parallel, yielding them in file order.
+
+    This gives the same rows as `sample_rows()` on the whole file.
+    """
+    first_row_nos = list(itertools.accumulate(chunk_row_counts, initial=0))
+    chunk_rows_to_sample = [
+        {row_no for row_no in rows_to_sample if first <= row_no < next_first}
+        for first, next_first in zip(first_row_nos, first_row_nos[1:])
+    ]
+    matched = 0
+    for sampled in executor.map(
+        partial(_sample_chunk_rows, fieldnames), chunks, first_row_nos[:-1], chunk_rows_to_sample
+    ):
+        matched += len(sampled)
+        yield from sampled
+    assert matched == len(rows_to_sample)
+
+
+def reservoir_sample_chunked(
+    chunks: Sequence[CsvChunk],
+    k: int,
+    *,
+    fieldnames: Sequence[str],
+    stratify_by: Sequence[str] = (),
+    random_seed: int,
+    executor: Executor,
+) -> list[tuple[tuple[int, int], dict[str, Any]]]:
+    """
+    Sample `k` rows from the chunks in parallel, optionally stratified, returning (row ID, row) pairs in file order.
+
+    Each chunk draws random keys from its own generator seeded by `random_seed` and the chunk's offset, and keeps its
+    `k` smallest-key rows per stratum. Merging the chunks' candidates gives the `k` smallest keys overall, so the sample
+    is uniform (within strata). It depends on the seed and chunk size, but not on the number of workers.
+    """
+    assert k > 0
+    stratum_sizes: dict[tuple[str, ...], int] = {}
+    heaps: dict[tuple[str, ...], list[tuple[float, tuple[int, int], dict[str, Any]]]] = {}
+    for chunk_sizes, chunk_heaps in executor.map(
+        partial(_smallest_keys_in_chunk, fieldnames, k, stratify_by, random_seed), chunks
+    ):
+        for stratum, size in chunk_sizes.items():
+            stratum_sizes[stratum] = stratum_sizes.get(stratum, 0) + size
+            heaps[stratum] = heapq.nlargest(k, itertools.chain(heaps.get(stratum, ()), chunk_heaps[stratum]))
+    return _select_from_strata(stratum_sizes, heaps, k)
+
+
+def sample_store_rows(
+    store: MedicareStore,
+    k: int,
+    *,
+    stratify_by: Sequence[str] = (),
+    random_seed: int,
+) -> np.ndarray:
+    """
+    Sample `k` row numbers from the store, optionally stratified proportionally, returning them in sorted order.
+
+    Like the reservoir methods, each row gets a uniform random key and we take the smallest keys in each stratum, but
+    here the keys and strata are computed with vectorized operations over the memory-mapped columns.
+    """
+    assert k > 0
+    keys = np.random.default_rng(random_seed).random(store.n_rows)
+    if not stratify_by:
+        if k >= store.n_rows:
+            return np.arange(store.n_rows)
+        return np.sort(np.argpartition(keys, k)[:k])
+
+    stratum_codes, stratum_ids = np.unique(
+        np.stack([store.column(column).codes for column in stratify_by]), axis=1, return_inverse=True
+    )
+    stratum_ids = stratum_ids.reshape(-1)
+    strata = [
+        tuple(store.column(column).value(code) for column, code in zip(stratify_by, codes))
+        for codes in stratum_codes.T
+    ]
+    stratum_sizes = dict(zip(strata, np.bincount(stratum_ids, minlength=len(strata)).tolist()))
+    allocation = _allocate_proportionally(stratum_sizes, min(k, store.n_rows))
+
+    # Sort by stratum, then by key within each stratum, and take the first rows of each stratum.
+    order = np.lexsort((keys, stratum_ids))
+    stratum_starts = np.concatenate([[0], np.cumsum(list(stratum_sizes.values()))[:-1]])
+    result = np.concatenate([
+        order[start:start + allocation[stratum]] for stratum, start in zip(strata, stratum_starts)
+    ])
+    logger.info("Sampled from %d strata of %d rows total", len(strata), store.n_rows)
+    return np.sort(result)
+
+
+def write_sample(sample_csv_path: Path, fieldnames: Sequence[str], rows: Iterable[dict[str, Any]]) -> None:
+    """
+    Write the sampled rows to a CSV file.
+    """
+    with sample_csv_path.open(mode="w", encoding="utf-8", newline="") as sample_csv_out:
+        writer = csv.DictWriter(sample_csv_out, fieldnames=fieldnames, dialect=csv.excel)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
 def main():
     parser = ArgumentParser(description=__doc__)
     parser.add_argument(
         "medicare_csv",
          type=Path,
-          help="The path to the Medicare dataset.",
+          help="The path to the Medicare dataset, as a CSV file or a store directory.",
           )
     parser.add_argument(
         "sample_csv",
@@ -80,6 +472,30 @@ def main():
         help="The number of sample rows to collect.",
         default=DEFAULT_N_SAMPLE_ROWS,
     )
+    parser.add_argument(
+        "--sampling-method",
+        choices=[TWO_PASS_METHOD, RESERVOIR_METHOD],
+        default=TWO_PASS_METHOD,
+        help="How to sample. `two-pass` reproduces existing samples; `reservoir` reads the file only once.",
+    )
+    parser.add_argument(
+        "--stratify-by",
+        nargs="+",
+        default=None,
+        help="Columns to stratify the sample by, e.g. `State` or `pri_spec`. Only used with reservoir sampling.",
+    )
+    parser.add_argument(
+        "--n-workers",
+        type=int,
+        default=DEFAULT_N_WORKERS,
+        help="Number of processes to parse the CSV with. If more than 1, parse the file in chunks in parallel.",
+    )
+    parser.add_argument(
+        "--chunk-mib",
+        type=int,
+        default=DEFAULT_CHUNK_MIB,
+        help="Approximate size of each chunk in MiB when parsing in parallel.",
+    )
     parser.add_argument(
         "--logging-level",
         type=str,
@@ -92,6 +508,13 @@ def main():
     sample_csv_path: Path = args.sample_csv
     random_seed: int = args.random_seed
     n_sample_rows: int = args.n_sample_rows
+    sampling_method: str = args.sampling_method
+    stratify_by: Optional[list[str]] = args.stratify_by
+    n_workers: int = args.n_workers
+    chunk_mib: int = args.chunk_mib
+
+    assert n_workers > 0
+    assert chunk_mib > 0
 
     logging.basicConfig(
         level=getattr(logging, args.logging_level),
@@ -101,18 +524,80 @@ def main():
 
     if not medicare_csv_path.exists():
         raise FileNotFoundError(f"[Medicare CSV] No such file: {medicare_csv_path}")
-    elif not medicare_csv_path.is_file():
-        raise FileNotFoundError(f"[Medicare CSV] Not a file: {medicare_csv_path}")
+    elif not medicare_csv_path.is_file() and not is_store(medicare_csv_path):
+        raise FileNotFoundError(f"[Medicare CSV] Not a file or Medicare store: {medicare_csv_path}")
 
     try:
         sample_csv_path.open(mode="w", encoding="utf-8")
     except OSError:
         raise ValueError("Couldn't create output (sample CSV) file {sample_csv_path}")
 
+    if stratify_by and sampling_method != RESERVOIR_METHOD:
+        raise ValueError("Stratified sampling requires `--sampling-method reservoir`")
+
     rng = random.Random(random_seed)
 
-    fieldnames = read_fieldnames(medicare_csv_path)
+    store = MedicareStore(medicare_csv_path) if is_store(medicare_csv_path) else None
+    fieldnames = store.columns if store is not None else read_fieldnames(medicare_csv_path)
     logger.debug("Got Medicare CSV field names: %s", fieldnames)
+    if stratify_by and not set(stratify_by).issubset(fieldnames):
+        raise ValueError(f"Can't stratify by columns not in the Medicare CSV: {set(stratify_by) - set(fieldnames)}")
+
+    if store is not None:
+        if sampling_method == RESERVOIR_METHOD:
+            logger.info("Sampling %d rows of Medicare store in %s", n_sample_rows, medicare_csv_path)
+            rows_to_sample = sample_store_rows(
+                store, n_sample_rows, stratify_by=stratify_by or (), random_seed=random_seed
+            )
+        else:
+            logger.info("Sampling from %d rows of Medicare store in %s", store.n_rows, medicare_csv_path)
+            rows_to_sample = sorted(rng.sample(range(1, store.n_rows), k=n_sample_rows))
+        write_sample(sample_csv_path, fieldnames, store.rows(rows_to_sample))
+        logger.info("Wrote %d rows sampled rows to %s", len(rows_to_sample), sample_csv_path)
+        return
+
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            chunks = find_csv_chunks(medicare_csv_path, chunk_mib * BYTES_PER_MIB, executor)
+            logger.info("Parsing Medicare CSV in %d chunks with %d workers", len(chunks), n_workers)
+            if sampling_method == RESERVOIR_METHOD:
+                logger.info("Reservoir sampling %d rows of Medicare CSV in %s", n_sample_rows, medicare_csv_path)
+                sampled = reservoir_sample_chunked(
+                    chunks,
+                    n_sample_rows,
+                    fieldnames=fieldnames,
+                    stratify_by=stratify_by or (),
+                    random_seed=random_seed,
+                    executor=executor,
+                )
+                write_sample(sample_csv_path, fieldnames, (row for _row_id, row in sampled))
+                logger.info("Wrote %d rows sampled rows to %s", len(sampled), sample_csv_path)
+                return
+
+            chunk_row_counts = count_rows_chunked(chunks, fieldnames, executor)
+            dataset_lines = sum(chunk_row_counts)
+            logger.info("Sampling from %d rows of Medicare CSV in %s", dataset_lines, medicare_csv_path)
+            rows_to_sample = set(rng.sample(range(1, dataset_lines), k=n_sample_rows))
+            write_sample(
+                sample_csv_path,
+                fieldnames,
+                sample_rows_chunked(chunks, chunk_row_counts, rows_to_sample, fieldnames, executor),
+            )
+            logger.info("Wrote %d rows sampled rows to %s", len(rows_to_sample), sample_csv_path)
+        return
+
+    if sampling_method == RESERVOIR_METHOD:
+        logger.info("Reservoir sampling %d rows of Medicare CSV in %s", n_sample_rows, medicare_csv_path)
+        with medicare_csv_path.open(mode="r", encoding="utf-8", newline="") as medicare_csv_in:
+            reader = medicare_csv_reader(medicare_csv_in)
+            if stratify_by:
+                sampled = stratified_reservoir_sample(reader, n_sample_rows, stratify_by=stratify_by, rng=rng)
+            else:
+                sampled = reservoir_sample(reader, n_sample_rows, rng=rng)
+        write_sample(sample_csv_path, fieldnames, (row for _row_no, row in sampled))
+        logger.info("Wrote %d rows sampled rows to %s", len(sampled), sample_csv_path)
+        return
+
     dataset_lines = count_rows(medicare_csv_path)
     logger.info("Sampling from %d rows of Medicare CSV in %s", dataset_lines, medicare_csv_path)
     rows_to_sample = set(rng.sample(range(1, dataset_lines), k=n_sample_rows))
@@ -0,0 +1,68 @@
+"""
+Batching items of varying length so that batches need little padding.
+
+Padding a batch to its longest item wastes compute on every shorter item. `map_length_bucketed` sorts each window of
+consecutive items by length, so that items of similar length end up in the same batch, and yields the results back in
+input order. Larger windows make for tighter batches, at the cost of holding a window's results until it's done.
+"""
+from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator, Optional, Sequence, TypeVar
+
+from scripts.utils.concurrency import chunked
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+@dataclass
+class PaddingStats:
+    """
+    Counts of real tokens and of token slots (real tokens plus padding) over the batches seen so far.
+    """
+
+    n_tokens: int = 0
+    n_slots: int = 0
+
+    def add_batch(self, lengths: Sequence[int]) -> None:
+        self.n_tokens += sum(lengths)
+        self.n_slots += max(lengths, default=0) * len(lengths)
+
+    @property
+    def padding_ratio(self) -> float:
+        """The fraction of token slots that are padding."""
+        return 1.0 - self.n_tokens / self.n_slots if self.n_slots else 0.0
+
+
+def map_length_bucketed(
+    fn: Callable[[list[T]], Sequence[R]],
+    items: Iterable[T],
+    *,
+    length: Callable[[T], int],
+    batch_size: int,
+    window: int,
+    padding_stats: Optional[PaddingStats] = None,
+) -> Iterator[R]:
+    """
+    Call `fn` on batches of at most `batch_size` items, yielding its results (one per item) in input order.
+
+    Each window of `window` consecutive items is sorted by `length` and cut into batches, so batches only ever mix
+    items from the same window. Items within a batch keep their input order. If `window` equals `batch_size`, this
+    is plain batching in input order. If given `padding_stats`, we record each batch's lengths there.
+    """
+    assert batch_size > 0
+    assert window >= batch_size
+    for window_items in chunked(items, window):
+        lengths = [length(item) for item in window_items]
+        by_length = sorted(range(len(window_items)), key=lambda i: lengths[i])
+        results: list[Optional[R]] = [None] * len(window_items)
+        for batch_indices in chunked(by_length, batch_size):
+            batch_indices.sort()
+            if padding_stats is not None:
+                padding_stats.add_batch([lengths[i] for i in batch_indices])
+            batch_results = fn([window_items[i] for i in batch_indices])
+            if len(batch_results) != len(batch_indices):
+                raise ValueError(f"Expected {len(batch_indices)} results for the batch but got {len(batch_results)}")
+            for i, result in zip(batch_indices, batch_results):
+                results[i] = result
+        yield from results
@@ -0,0 +1,86 @@
+"""
+Helpers for running blocking work (mostly HTTP requests) concurrently.
+"""
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+import time
+from typing import Callable, Iterable, Iterator, TypeVar
+
+
+logger = logging.getLogger(__name__)
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+DEFAULT_RETRY_BACKOFF_SECONDS = 2.0
+
+
+def chunked(items: Iterable[T], size: int) -> Iterator[list[T]]:
+    """
+    Split an iterable into lists of at most `size` items, lazily.
+    """
+    assert size > 0
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def ordered_map(fn: Callable[[T], R], items: Iterable[T], *, max_in_flight: int) -> Iterator[R]:
+    """
+    Map `fn` over `items` on a thread pool with at most `max_in_flight` calls outstanding at once.
+
+    Results are yielded in input order, and items are pulled from `items` only as slots in the window free up, so
+    this is safe to use on long generators. If a call raises, the remaining calls are cancelled and the exception
+    propagates to the consumer.
+    """
+    assert max_in_flight > 0
+    if max_in_flight == 1:
+        yield from map(fn, items)
+        return
+
+    pending: deque[Future[R]] = deque()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        try:
+            for item in items:
+                pending.append(executor.submit(fn, item))
+                if len(pending) >= max_in_flight:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def call_with_retries(
+    fn: Callable[[], R],
+    *,
+    max_retries: int,
+    retry_on: tuple[type[BaseException], ...],
+    give_up_on: tuple[type[BaseException], ...] = (),
+    backoff_seconds: float = DEFAULT_RETRY_BACKOFF_SECONDS,
+) -> R:
+    """
+    Call `fn`, retrying up to `max_retries` times if it raises one of `retry_on` but not one of `give_up_on`.
+
+    We back off exponentially between attempts, starting from `backoff_seconds`.
+    """
+    assert max_retries >= 0
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except retry_on as e:
+            if attempt >= max_retries or isinstance(e, give_up_on):
+                raise
+            delay = backoff_seconds * 2 ** attempt
+            attempt += 1
+            logger.warning("Attempt %d failed with %r, retrying in %.1f seconds", attempt, e, delay)
+            time.sleep(delay)
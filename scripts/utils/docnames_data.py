@@ -1,17 +1,253 @@
 """
 Functions and helpers related to the Docnames Data.
+
+The record types here are compact so that we can hold 100k+ row datasets in memory. They use `__slots__` and intern the
+feature names and values that repeat across rows.
 """
-from dataclasses import dataclass
-from typing import Any
-
-@dataclass
-class PromptedSentence:
-    """An output sentence plus some metadata about how it was generated."""
-
-    sentence: str
-    raw_generation: str
-    prompt: str
-    nochat_prompt: str
-    generation_features: dict[str, Any]
-    full_features: dict[str, Any]
-    attempted_to_typo: bool
+from pathlib import Path
+import sys
+from typing import Any, Iterator, Optional, Sequence
+
+from scripts.utils.jsonl import read_jsonl
+
+
+# Old DocNames data has no `nochat_prompt`, so we recover it by stripping the chat tags from `prompt`.
+OLD_PROMPT_PREFIX = "<bos><start_of_turn>user\n\n"
+OLD_PROMPT_SUFFIX = "<end_of_turn>"
+
+
+def recover_nochat_prompt(prompt: str) -> str:
+    """
+    Recover the prompt without chat tags from the chat-formatted prompt of old DocNames data.
+    """
+    return prompt.removeprefix(OLD_PROMPT_PREFIX).strip().removesuffix(OLD_PROMPT_SUFFIX).strip()
+
+
+def intern_features(features: dict[str, Any]) -> dict[str, Any]:
+    """
+    Intern the feature names and string values, which repeat across rows, so that rows share them.
+    """
+    return {
+        sys.intern(name): sys.intern(value) if isinstance(value, str) else value for name, value in features.items()
+    }
+
+
+def _maybe_intern_features(features: Optional[dict[str, Any]]) -> Optional[dict[str, Any]]:
+    return intern_features(features) if features is not None else None
+
+
+def _intern_keys(extra: Optional[dict[str, Any]]) -> dict[str, Any]:
+    return {sys.intern(key): value for key, value in (extra or {}).items()}
+
+
+def _without_nones(json_: dict[str, Any]) -> dict[str, Any]:
+    return {key: value for key, value in json_.items() if value is not None}
+
+
+class _Record:
+    """
+    Base for immutable records with slots. Fields are set once in `__init__` using `_set`.
+    """
+
+    __slots__ = ()
+
+    def _set(self, name: str, value: Any) -> None:
+        object.__setattr__(self, name, value)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __eq__(self, other: Any) -> bool:
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class PromptedSentence(_Record):
+    """
+    An output sentence plus some metadata about how it was generated.
+
+    Only `sentence` is required. Missing fields are `None`, and any other keys in the JSON are kept in `extra`.
+    """
+
+    __slots__ = (
+        "sentence",
+        "raw_generation",
+        "prompt",
+        "nochat_prompt",
+        "generation_features",
+        "full_features",
+        "attempted_to_typo",
+        "extra",
+    )
+
+    JSON_KEYS = (
+        "sentence",
+        "raw_generation",
+        "prompt",
+        "nochat_prompt",
+        "generation_features",
+        "full_features",
+        "attempted_to_typo",
+    )
+
+    def __init__(
+        self,
+        *,
+        sentence: str,
+        raw_generation: Optional[str] = None,
+        prompt: Optional[str] = None,
+        nochat_prompt: Optional[str] = None,
+        generation_features: Optional[dict[str, Any]] = None,
+        full_features: Optional[dict[str, Any]] = None,
+        attempted_to_typo: Optional[bool] = None,
+        extra: Optional[dict[str, Any]] = None,
+    ):
+        self._set("sentence", sentence)
+        self._set("raw_generation", raw_generation)
+        self._set("prompt", prompt)
+        self._set("nochat_prompt", nochat_prompt)
+        self._set("generation_features", _maybe_intern_features(generation_features))
+        self._set("full_features", _maybe_intern_features(full_features))
+        self._set("attempted_to_typo", attempted_to_typo)
+        self._set("extra", _intern_keys(extra))
+
+    @classmethod
+    def from_json(cls, json_: dict[str, Any]) -> "PromptedSentence":
+        """
+        Make a prompted sentence from its JSON form.
+        """
+        return cls(
+            sentence=json_["sentence"],
+            raw_generation=json_.get("raw_generation"),
+            prompt=json_.get("prompt"),
+            nochat_prompt=json_.get("nochat_prompt"),
+            generation_features=json_.get("generation_features"),
+            full_features=json_.get("full_features"),
+            attempted_to_typo=json_.get("attempted_to_typo"),
+            extra={key: value for key, value in json_.items() if key not in cls.JSON_KEYS},
+        )
+
+    def get_nochat_prompt(self) -> str:
+        """
+        Get the prompt without chat tags, recovering it from `prompt` for old DocNames data.
+        """
+        return self.nochat_prompt if self.nochat_prompt is not None else recover_nochat_prompt(self.prompt)
+
+    def to_json(self) -> dict[str, Any]:
+        return {**_without_nones({key: getattr(self, key) for key in self.JSON_KEYS}), **self.extra}
+
+
+class ExtractedInfo(_Record):
+    """
+    The doctor names and cities extracted from a sentence. Any other keys in the JSON are kept in `extra`.
+    """
+
+    __slots__ = ("names", "cities", "extra")
+
+    def __init__(
+        self,
+        *,
+        names: Sequence[str] = (),
+        cities: Sequence[str] = (),
+        extra: Optional[dict[str, Any]] = None,
+    ):
+        self._set("names", tuple(names))
+        self._set("cities", tuple(cities))
+        self._set("extra", _intern_keys(extra))
+
+    @classmethod
+    def from_json(cls, json_: dict[str, Any]) -> "ExtractedInfo":
+        return cls(
+            names=json_.get("names", ()),
+            cities=json_.get("cities", ()),
+            extra={key: value for key, value in json_.items() if key not in ("names", "cities")},
+        )
+
+    def to_json(self) -> dict[str, Any]:
+        return {"names": list(self.names), "cities": list(self.cities), **self.extra}
+
+
+class Inference(_Record):
+    """
+    A DocNames sentence with the information extracted from it, plus the Genparse output it came from, if any.
+
+    Any other keys in the JSON (such as `n_particles`) are kept in `extra`.
+    """
+
+    __slots__ = (
+        "prompted_sentence",
+        "extracted_info",
+        "genparse_prompt",
+        "raw_genparse_output",
+        "cleaned_genparse_output",
+        "extra",
+    )
+
+    INFERENCE_KEYS = ("extracted_info", "genparse_prompt", "raw_genparse_output", "cleaned_genparse_output")
+
+    def __init__(
+        self,
+        *,
+        prompted_sentence: PromptedSentence,
+        extracted_info: ExtractedInfo,
+        genparse_prompt: Optional[str] = None,
+        raw_genparse_output: Optional[dict[str, Any]] = None,
+        cleaned_genparse_output: Optional[dict[str, Any]] = None,
+        extra: Optional[dict[str, Any]] = None,
+    ):
+        self._set("prompted_sentence", prompted_sentence)
+        self._set("extracted_info", extracted_info)
+        self._set("genparse_prompt", genparse_prompt)
+        self._set("raw_genparse_output", raw_genparse_output)
+        self._set("cleaned_genparse_output", cleaned_genparse_output)
+        self._set("extra", _intern_keys(extra))
+
+    @classmethod
+    def from_json(cls, json_: dict[str, Any]) -> "Inference":
+        """
+        Make an inference from its JSON form. Only `sentence` and `extracted_info` are required.
+        """
+        known_keys = {*PromptedSentence.JSON_KEYS, *cls.INFERENCE_KEYS}
+        return cls(
+            prompted_sentence=PromptedSentence.from_json(
+                {key: json_[key] for key in PromptedSentence.JSON_KEYS if key in json_}
+            ),
+            extracted_info=ExtractedInfo.from_json(json_["extracted_info"]),
+            genparse_prompt=json_.get("genparse_prompt"),
+            raw_genparse_output=json_.get("raw_genparse_output"),
+            cleaned_genparse_output=json_.get("cleaned_genparse_output"),
+            extra={key: value for key, value in json_.items() if key not in known_keys},
+        )
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            **self.prompted_sentence.to_json(),
+            **_without_nones(
+                {
+                    "raw_genparse_output": self.raw_genparse_output,
+                    "cleaned_genparse_output": self.cleaned_genparse_output,
+                    "extracted_info": self.extracted_info.to_json(),
+                    "genparse_prompt": self.genparse_prompt,
+                }
+            ),
+            **self.extra,
+        }
+
+
+def read_inferences(jsonl_path: Path) -> Iterator[Inference]:
+    """
+    Read DocNames inferences from JSONL.
+    """
+    for datum in read_jsonl(jsonl_path):
+        yield Inference.from_json(datum)
+
@@ -0,0 +1,131 @@
+"""
+Cleanup of raw Genparse posteriors, imitating what the GenFact server does.
+"""
+import heapq
+import json
+import logging
+import math
+from typing import Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+ASSISTANT_HEADER = "<|start_header_id|>assistant<|end_header_id|>"
+
+
+# Translated from GenFact server code, src/genparse/extract_entities.jl.
+# Current as of 8895efe5f5e51d5bfdd0300d8d4ffd7e0568f2aa
+def normalize_json_object(json_string: str) -> str:
+    """
+    Normalize a raw JSON object string into a standard form.
+
+    This parses the string as an object, sorts by keys, then re-serializes it to eliminate variation in whitespace.
+    """
+    return json.dumps(dict(sorted(json.loads(json_string).items(), key=lambda t: t[0])))
+
+
+# Translated from GenFact server code, src/genparse/extract_entities.jl.
+# Current as of 8895efe5f5e51d5bfdd0300d8d4ffd7e0568f2aa
+def sort_posterior(posterior: dict[str, float]) -> dict[str, float]:
+    """Sort a posterior distribution so the highest likelihood output comes first.
+
+    Breaks ties by preferring the alphabetically earliest inference. This does not explicitly handle Unicode and so
+    it will probably sort in UTF-8 code unit order instead of in collation order.
+
+    The posterior should be a dict-like object mapping strings-like objects to float-likes.
+    This returns a value in the same format.
+    """
+    return dict(sorted(posterior.items(), key=lambda t: (t[1], t[0]), reverse=True))
+
+
+def cleanup_genparse_output(posterior: dict[str, float]) -> dict[str, float]:
+    """
+    Clean up Genparse output.
+
+    This attempts to imitate what the GenFact server does to clean up the Genparse output as of 2024-09-10.
+    It does not attempt to perform PClean-related cleanup, because for evaluation purposes we don't need that for our
+    pure information extraction evaluation. This therefore only filters for actual JSON respones and aggregates
+    likelihoods over functionally identical outputs.
+
+    The GenFact server extracts the code from each inference, aggregates likelihoods over identical code blocks and
+    sorts, then normalizes each code block and aggregates and sorts again. We give exactly the same result, down to the
+    order of floating point additions, but parse each distinct code block once and sort once.
+    """
+    normalized_by_code: dict[str, Optional[str]] = {}
+    code_likelihoods: dict[str, float] = {}
+    n_nocode = 0
+    nocode_likelihood = 0.0
+    for inference, likelihood in posterior.items():
+        code = inference.strip().removeprefix(ASSISTANT_HEADER)
+        if code not in normalized_by_code:
+            try:
+                normalized_by_code[code] = normalize_json_object(code)
+            except json.decoder.JSONDecodeError:
+                normalized_by_code[code] = None
+        if normalized_by_code[code] is None:
+            logger.debug("Inference is not code: `%s`", inference)
+            n_nocode += 1
+            nocode_likelihood += likelihood
+        else:
+            code_likelihoods[code] = code_likelihoods.get(code, 0.0) + likelihood
+
+    assert code_likelihoods
+
+    nocode_share = nocode_likelihood / max(n_nocode, 1)
+    codes_by_normalized: dict[str, list[str]] = {}
+    for code in code_likelihoods:
+        code_likelihoods[code] += nocode_share
+        codes_by_normalized.setdefault(normalized_by_code[code], []).append(code)
+
+    result = {}
+    for normalized, codes in codes_by_normalized.items():
+        if len(codes) == 1:
+            result[normalized] = code_likelihoods[codes[0]]
+        else:
+            # Add up in the same order as the GenFact server, so we get bit-for-bit the same likelihoods.
+            total = 0.0
+            for code in sorted(codes, key=lambda code: (code_likelihoods[code], code), reverse=True):
+                total += code_likelihoods[code]
+            result[normalized] = total
+    return sort_posterior(result)
+
+
+def get_map_output(posterior: dict[str, float]) -> str:
+    """
+    Given a posterior, get the maximum a posteriori output.
+
+    If there is a tie for maximum, we prefer the output that sorts first alphabetically.
+    """
+    # Can't get the max directly because it would prefer the output that sorts last alphabetically. There is no easy
+    # way to fix this in the key function.
+    #
+    # Instead, we negate the values and get the minimum. This should get us a MAP output still because when we negate
+    # the values the max becomes the min. However, because we also key on the strings, now we get the alphabetically
+    # first MAP inference.
+    #
+    # Trick: The value is a number but
+    return min(posterior.items(), key=lambda t: (-t[1], t[0]))[0]
+
+
+def posterior_entropy_bits(posterior: dict[str, float]) -> float:
+    """
+    Compute the entropy in bits of the posterior, normalized to sum to 1.
+    """
+    total = sum(posterior.values())
+    return -sum(
+        likelihood / total * math.log2(likelihood / total) for likelihood in posterior.values() if likelihood > 0
+    )
+
+
+def map_margin(posterior: dict[str, float]) -> float:
+    """
+    Compute how much more probable the MAP output is than the runner-up, after normalizing the posterior to sum to 1.
+
+    The margin is 1 if there is only one output.
+    """
+    total = sum(posterior.values())
+    top_two = heapq.nlargest(2, posterior.values())
+    if len(top_two) < 2:
+        return 1.0
+    return (top_two[0] - top_two[1]) / total
@@ -0,0 +1,162 @@
+"""
+Shared HTTP client for talking to the GenFact (port 8888) and Genparse (ports 8888 and 9999) servers.
+
+All scripts should get their session from `get_session()` rather than calling `requests.post` directly so that
+connections are pooled and kept alive across requests, and so that every request gets the same timeout and retry
+policy.
+"""
+import os
+import threading
+from typing import Any, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+
+
+GENPARSE_INFERENCE_PORT = 8888
+GENPARSE_RESTART_PORT = 9999
+GENFACT_PORT = 8888
+
+CONNECT_TIMEOUT_SECONDS = 3.05
+DEFAULT_POOL_MAXSIZE = 32
+DEFAULT_CONNECT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+# We deliberately don't retry on 504. The GenFact server returns 504 when Genparse has fallen over, and callers
+# need to see that to decide whether to restart Genparse.
+RETRY_STATUS_CODES = (502, 503)
+
+
+def inference_endpoint(server_ip_or_hostname: str) -> str:
+    """
+    Get the inference endpoint URL for the given server IP or hostname.
+    """
+    return f"http://{server_ip_or_hostname}:{GENPARSE_INFERENCE_PORT}/infer"
+
+
+def batch_inference_endpoint(server_ip_or_hostname: str) -> str:
+    """
+    Get the batch inference endpoint URL for the given server IP or hostname.
+
+    See `scripts/mock_genparse_server.py` for the request format.
+    """
+    return f"http://{server_ip_or_hostname}:{GENPARSE_INFERENCE_PORT}/infer_batch"
+
+
+def health_endpoint(server_ip_or_hostname: str) -> str:
+    """
+    Get the health probe URL for the Genparse inference server on the given IP or hostname.
+    """
+    return f"http://{server_ip_or_hostname}:{GENPARSE_INFERENCE_PORT}/health"
+
+
+def restart_endpoint(server_ip_or_hostname: str) -> str:
+    """
+    Get the endpoint URL to restart the Genparse inference server on the given IP or hostname.
+    """
+    return f"http://{server_ip_or_hostname}:{GENPARSE_RESTART_PORT}/restart"
+
+
+def genfact_endpoint(server_ip_or_hostname: str) -> str:
+    """
+    Get the sentence-to-doctor-data endpoint URL for the GenFact server on the given IP or hostname.
+    """
+    return f"http://{server_ip_or_hostname}:{GENFACT_PORT}/sentence-to-doctor-data"
+
+
+def request_timeout(read_timeout_seconds: Optional[float]) -> tuple[float, Optional[float]]:
+    """
+    Get a (connect, read) timeout pair with our standard connect timeout. A read timeout of `None` means no timeout.
+    """
+    return (CONNECT_TIMEOUT_SECONDS, read_timeout_seconds)
+
+
+def restart_auth() -> HTTPBasicAuth:
+    """
+    Get the basic auth credentials for the Genparse restart endpoint from the environment.
+    """
+    return HTTPBasicAuth(os.getenv("GENPARSE_USER"), os.getenv("GENPARSE_PASSWORD"))
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    An HTTP adapter that applies a default timeout to requests that don't specify one.
+    """
+
+    def __init__(self, *args: Any, timeout: tuple[float, Optional[float]], **kwargs: Any):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request: requests.PreparedRequest, **kwargs: Any) -> requests.Response:
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def make_session(
+    *,
+    pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+    connect_retries: int = DEFAULT_CONNECT_RETRIES,
+    backoff_factor: float = DEFAULT_BACKOFF_FACTOR,
+    read_timeout_seconds: Optional[float] = None,
+) -> requests.Session:
+    """
+    Create a session with pooled keep-alive connections, retries and default timeouts.
+
+    `pool_maxsize` is how many connections we keep open to each host, so it should cover the most concurrent requests
+    we make to one server. By default there's no read timeout, since Genparse can take a long time on a busy server.
+
+    We only retry failed connections and gateway errors, never read timeouts, since a read timeout usually means the
+    server is busy with our request and resending it would only make things worse.
+    """
+    retry = Retry(
+        total=None,
+        connect=connect_retries,
+        # False rather than 0, so that read timeouts raise `requests.ReadTimeout` instead of a `ConnectionError`.
+        read=False,
+        status=connect_retries,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=None,
+        backoff_factor=backoff_factor,
+        raise_on_status=False,
+    )
+    adapter = TimeoutHTTPAdapter(
+        timeout=request_timeout(read_timeout_seconds),
+        max_retries=retry,
+        pool_connections=pool_maxsize,
+        pool_maxsize=pool_maxsize,
+    )
+    result = requests.Session()
+    result.mount("http://", adapter)
+    result.mount("https://", adapter)
+    return result
+
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    Get the process-wide shared session, creating it with the default settings on first use.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = make_session()
+        return _session
+
+
+def configure_session(**kwargs: Any) -> requests.Session:
+    """
+    Replace the process-wide shared session with one made by `make_session(**kwargs)`, returning it.
+
+    Call this before making any requests, since requests already using the old session keep using it.
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = make_session(**kwargs)
+        return _session
@@ -1,24 +1,257 @@
+"""
+Helpers for reading and writing JSONL.
+
+By default we write exactly what the standard library's `json.dumps` writes, so outputs stay byte-compatible with
+existing files, and read with the fastest available library (orjson, then msgspec), falling back to the standard
+library for lines it rejects (such as `NaN`). We transparently (de)compress paths ending in `.gz` or `.zst`. zstd
+support requires the `zstandard` package.
+
+The `orjson` and `msgspec` backends are opt-in through `set_json_backend`. They write faster but different bytes:
+compact separators, raw non-ASCII characters, and `null` in place of NaN and infinities.
+"""
+import gzip
+import hashlib
+import io
 import json
+import logging
+import os
 from pathlib import Path
-from typing import Any, Iterable, Iterator
+from typing import IO, Any, Callable, Hashable, Iterable, Iterator, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger(__name__)
+
+
+IO_BUFFER_BYTES = 1024 ** 2
+COMPRESSED_SUFFIXES = (".gz", ".zst")
+# Level 9 (gzip's default) is several times slower to write for very little size benefit on our data.
+GZIP_COMPRESSLEVEL = 6
+DEFAULT_JSON_BACKEND = "json"
+
+
+_DECODE_ERRORS = (ValueError, msgspec.DecodeError) if msgspec is not None else (ValueError,)
+
+
+def _stdlib_loads(data: bytes) -> Any:
+    return json.loads(data.decode("utf-8"))
+
+
+def _stdlib_dumps(obj: Any) -> bytes:
+    return json.dumps(obj).encode("utf-8")
+
+
+def _with_stdlib_fallback(fast_loads: Callable[[bytes], Any]) -> Callable[[bytes], Any]:
+    """
+    Wrap a fast decoder so that anything it rejects but the standard library accepts (NaN, infinities, lone
+    surrogates, huge integers) is still decoded, to the same value the standard library would give.
+    """
+    def loads(data: bytes) -> Any:
+        try:
+            return fast_loads(data)
+        except _DECODE_ERRORS:
+            return _stdlib_loads(data)
+
+    return loads
+
+
+def _json_backends() -> dict[str, tuple[Callable[[bytes], Any], Callable[[Any], bytes]]]:
+    """
+    Get the available JSON backends as (loads, dumps) pairs, the default first.
+
+    Each `dumps` returns UTF-8 encoded bytes.
+    """
+    fast_loads = orjson.loads if orjson is not None else msgspec.json.decode if msgspec is not None else None
+    result = {
+        DEFAULT_JSON_BACKEND: (
+            _with_stdlib_fallback(fast_loads) if fast_loads is not None else _stdlib_loads, _stdlib_dumps
+        ),
+    }
+    if orjson is not None:
+        result["orjson"] = (
+            orjson.loads, lambda obj: orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+        )
+    if msgspec is not None:
+        encoder = msgspec.json.Encoder()
+        result["msgspec"] = (msgspec.json.decode, encoder.encode)
+    return result
+
+
+JSON_BACKENDS = _json_backends()
+_loads, _dumps = JSON_BACKENDS[DEFAULT_JSON_BACKEND]
+
+
+def set_json_backend(name: str) -> None:
+    """
+    Choose which JSON library to use, by name. Mostly useful for benchmarking.
+
+    Only the default backend writes the same bytes as the standard library, see the module docstring.
+    """
+    global _loads, _dumps
+    if name not in JSON_BACKENDS:
+        raise ValueError(f"JSON backend `{name}` is not available, choose one of: {list(JSON_BACKENDS)}")
+    _loads, _dumps = JSON_BACKENDS[name]
+
+
+def is_compressed(jsonl_path: Path) -> bool:
+    """
+    Check whether we'd transparently compress the given path.
+    """
+    return jsonl_path.suffix in COMPRESSED_SUFFIXES
+
+
+def open_jsonl(jsonl_path: Path, mode: str) -> IO[bytes]:
+    """
+    Open the JSONL file in binary mode ("rb", "wb" or "ab"), compressing or decompressing based on the suffix.
+
+    The file is buffered with a large buffer so that writing one record at a time turns into bulk writes.
+    """
+    if jsonl_path.suffix == ".gz":
+        compressed = gzip.open(jsonl_path, mode=mode, compresslevel=GZIP_COMPRESSLEVEL)
+    elif jsonl_path.suffix == ".zst":
+        if zstandard is None:
+            raise ImportError(f"Reading or writing `{jsonl_path}` requires the `zstandard` package")
+        compressed = zstandard.open(jsonl_path, mode=mode)
+    else:
+        return jsonl_path.open(mode=mode, buffering=IO_BUFFER_BYTES)
+
+    if mode.startswith("r"):
+        return io.BufferedReader(compressed, buffer_size=IO_BUFFER_BYTES)
+    return io.BufferedWriter(compressed, buffer_size=IO_BUFFER_BYTES)
+
+
+def _checkpoint(jsonl_out: IO[bytes]) -> None:
+    """
+    Flush the file and fsync it to disk if it's backed by a real file.
+    """
+    jsonl_out.flush()
+    try:
+        os.fsync(jsonl_out.fileno())
+    except (AttributeError, io.UnsupportedOperation):
+        pass
+
 
 def read_jsonl(jsonl_path: Path) -> Iterator[dict[str, Any]]:
     """
     Read the given JSONL file.
     """
-    with jsonl_path.open(mode="r", encoding="utf-8") as jsonl_in:
+    with open_jsonl(jsonl_path, mode="rb") as jsonl_in:
         for line in jsonl_in:
-            yield json.loads(line.strip())
+            yield _loads(line.strip())
 
 
-def write_jsonl(data: Iterable[dict[str, Any]], write_to_path: Path) -> int:
+def write_jsonl(
+    data: Iterable[dict[str, Any]],
+    write_to_path: Path,
+    *,
+    append: bool = False,
+    checkpoint_every: Optional[int] = None,
+) -> int:
     """
     Write an iterable of dicts to a path as JSONL, returning the number written.
+
+    Records are written through a large buffer, so they reach the disk in bulk.
+
+    If `append` is true, add to the end of the file instead of overwriting it. If `checkpoint_every` is given, write
+    out, flush and fsync the file every that many records, so that at most that many records are lost if we crash. A
+    crash can leave at most one partial line at the end of the file, which `recover_jsonl` removes.
     """
+    assert checkpoint_every is None or checkpoint_every > 0
     result = 0
-    with write_to_path.open(mode="w", encoding="utf-8") as jsonl_out:
+    with open_jsonl(write_to_path, mode="ab" if append else "wb") as jsonl_out:
         for datum in data:
-            jsonl_out.write(json.dumps(datum))
-            jsonl_out.write("\n")
+            jsonl_out.write(_dumps(datum))
+            jsonl_out.write(b"\n")
+            result += 1
+            if checkpoint_every is not None and result % checkpoint_every == 0:
+                _checkpoint(jsonl_out)
+        if checkpoint_every is not None:
+            _checkpoint(jsonl_out)
+    return result
+
+
+def recover_jsonl(jsonl_path: Path) -> int:
+    """
+    Truncate a partially written record from the end of a JSONL file, returning the number of complete records.
+
+    A record counts as complete if it ends in a newline and parses as JSON. Compressed files can't be recovered this
+    way, so we raise ValueError for those.
+    """
+    if not jsonl_path.exists():
+        return 0
+    if is_compressed(jsonl_path):
+        raise ValueError(f"Can't recover compressed JSONL file `{jsonl_path}`")
+
+    result = 0
+    good_length = 0
+    with jsonl_path.open(mode="rb") as jsonl_in:
+        for line in jsonl_in:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                _loads(line)
+            except _DECODE_ERRORS:
+                break
+            good_length += len(line)
             result += 1
-    return result
\ No newline at end of file
+
+    if good_length < jsonl_path.stat().st_size:
+        logger.warning(
+            "Truncating %d bytes of partial output from `%s`", jsonl_path.stat().st_size - good_length, jsonl_path
+        )
+        with jsonl_path.open(mode="r+b") as jsonl_out:
+            jsonl_out.truncate(good_length)
+            jsonl_out.flush()
+            os.fsync(jsonl_out.fileno())
+    return result
+
+
+def sentence_row_key(datum: dict[str, Any]) -> str:
+    """
+    Get a stable key identifying an input row by its sentence.
+    """
+    return hashlib.sha1(datum["sentence"].encode("utf-8")).hexdigest()
+
+
+def skip_completed(
+    data: Iterable[dict[str, Any]],
+    completed_path: Path,
+    *,
+    row_key: Callable[[dict[str, Any]], Hashable] = sentence_row_key,
+) -> Iterator[dict[str, Any]]:
+    """
+    Skip the input rows that already have outputs in the JSONL file at `completed_path`, returning the rest.
+
+    This eagerly removes any partial record from the end of the output file and consumes the already-completed input
+    rows, so the output file is ready to append to once this returns.
+
+    The outputs are assumed to be in input order, as our scripts write them. We check that each output row's key
+    matches the key of the input row it's paired with and raise ValueError if not, since that means the output came
+    from a different input file.
+    """
+    n_complete = recover_jsonl(completed_path)
+    data = iter(data)
+    if n_complete:
+        n_matched = 0
+        for row_no, (completed, datum) in enumerate(zip(read_jsonl(completed_path), data)):
+            if row_key(datum) != row_key(completed):
+                raise ValueError(f"Existing output `{completed_path}` doesn't match input at row {row_no}")
+            n_matched += 1
+        if n_matched < n_complete:
+            raise ValueError(f"Existing output `{completed_path}` has more rows than the input")
+        logger.info("Resuming after %d rows already written to `%s`", n_complete, completed_path)
+    return data
@@ -0,0 +1,216 @@
+"""
+A compact, columnar, memory-mapped store for the Medicare dataset.
+
+Parsing the Medicare CSV into per-row dicts of strings is slow and takes a lot of memory. Most columns have few
+distinct values (states, specialties, cities, medical schools), so we dictionary-encode each column: a store directory
+holds, per column, a numpy array of integer codes, one per row, plus the column's distinct values as one UTF-8 blob
+with an array of offsets into it. Everything is memory-mapped when loaded, so opening a store is instant and lookups
+only touch the pages they need.
+
+Use `convert_csv_to_store()` (or `scripts/medicare_as_store.py`) to build a store and `MedicareStore` to read one.
+"""
+import array
+import csv
+import json
+import logging
+import mmap
+from pathlib import Path
+import sys
+from typing import Any, Iterable, Iterator, Optional, Sequence
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+STORE_VERSION = 1
+METADATA_FILENAME = "metadata.json"
+LOG_EVERY_N_ROWS = 500_000
+
+
+def is_store(path: Path) -> bool:
+    """
+    Check whether the given path is a Medicare store directory.
+    """
+    return (path / METADATA_FILENAME).is_file()
+
+
+def _codes_dtype(n_values: int) -> np.dtype:
+    """
+    Get the smallest unsigned integer type that can hold codes for the given number of distinct values.
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if n_values <= np.iinfo(dtype).max + 1:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def _write_column(store_dir: Path, column_no: int, codes: array.array, values: dict[str, int]) -> None:
+    """
+    Write one dictionary-encoded column: its codes, its values blob, and the offsets of each value in the blob.
+    """
+    np.save(store_dir / f"{column_no}.codes.npy", np.asarray(codes).astype(_codes_dtype(len(values))))
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    np.save(store_dir / f"{column_no}.offsets.npy", offsets)
+    with (store_dir / f"{column_no}.values.bin").open(mode="wb") as values_out:
+        values_out.writelines(encoded)
+
+
+def convert_csv_to_store(csv_path: Path, store_dir: Path) -> int:
+    """
+    Convert the Medicare CSV at `csv_path` into a store in `store_dir`, returning the number of rows.
+
+    This reads the CSV once. Codes are kept as 32-bit integers in memory until we know each column's cardinality, so
+    this needs about 4 bytes per cell.
+    """
+    store_dir.mkdir(parents=True, exist_ok=True)
+    with csv_path.open(mode="r", encoding="utf-8", newline="") as csv_in:
+        reader = csv.reader(csv_in, dialect=csv.excel)
+        columns = next(reader)
+        codes = [array.array("I") for _ in columns]
+        values: list[dict[str, int]] = [{} for _ in columns]
+        n_rows = 0
+        for row in reader:
+            if not row:
+                continue
+            if len(row) != len(columns):
+                raise ValueError(f"Row {n_rows} of {csv_path} has {len(row)} fields, expected {len(columns)}")
+            for value, column_codes, column_values in zip(row, codes, values):
+                code = column_values.get(value)
+                if code is None:
+                    code = column_values[value] = len(column_values)
+                column_codes.append(code)
+            n_rows += 1
+            if n_rows % LOG_EVERY_N_ROWS == 0:
+                logger.info("Read %d rows from %s", n_rows, csv_path)
+
+    for column_no, (column_codes, column_values) in enumerate(zip(codes, values)):
+        _write_column(store_dir, column_no, column_codes, column_values)
+    with (store_dir / METADATA_FILENAME).open(mode="w", encoding="utf-8") as metadata_out:
+        json.dump({"version": STORE_VERSION, "n_rows": n_rows, "columns": columns}, metadata_out)
+    logger.info("Wrote %d rows and %d columns to store %s", n_rows, len(columns), store_dir)
+    return n_rows
+
+
+class DictionaryColumn:
+    """
+    A memory-mapped, dictionary-encoded column of strings.
+
+    `codes[i]` is the code of row `i`'s value, and `value(code)` decodes a code. Values are decoded lazily and cached.
+    """
+
+    def __init__(self, store_dir: Path, column_no: int):
+        self.codes: np.ndarray = np.load(store_dir / f"{column_no}.codes.npy", mmap_mode="r")
+        self._offsets: np.ndarray = np.load(store_dir / f"{column_no}.offsets.npy", mmap_mode="r")
+        values_path = store_dir / f"{column_no}.values.bin"
+        if values_path.stat().st_size:
+            with values_path.open(mode="rb") as values_in:
+                self._values = mmap.mmap(values_in.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # Can't map an empty file.
+            self._values = b""
+        self._decoded: dict[int, str] = {}
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @property
+    def n_values(self) -> int:
+        """The number of distinct values in the column."""
+        return len(self._offsets) - 1
+
+    def value(self, code: int) -> str:
+        """
+        Decode the given code.
+        """
+        code = int(code)
+        result = self._decoded.get(code)
+        if result is None:
+            start, end = self._offsets[code], self._offsets[code + 1]
+            result = self._decoded[code] = self._values[start:end].decode("utf-8")
+        return result
+
+    def __getitem__(self, row_no: int) -> str:
+        return self.value(self.codes[row_no])
+
+    def take(self, row_nos: Sequence[int]) -> list[str]:
+        """
+        Get the values for the given rows.
+        """
+        return [self.value(code) for code in self.codes[np.asarray(row_nos, dtype=np.int64)]]
+
+    def code_of(self, value: str) -> Optional[int]:
+        """
+        Get the code for the given value, or None if it doesn't occur in the column.
+
+        This scans the dictionary, so prefer to look codes up once and then compare codes.
+        """
+        encoded = value.encode("utf-8")
+        for code in range(self.n_values):
+            if self._values[self._offsets[code]:self._offsets[code + 1]] == encoded:
+                return code
+        return None
+
+    def value_counts(self) -> dict[str, int]:
+        """
+        Count the rows with each value.
+        """
+        counts = np.bincount(self.codes, minlength=self.n_values)
+        return {self.value(code): int(count) for code, count in enumerate(counts)}
+
+
+class MedicareStore:
+    """
+    A read-only view of a Medicare store directory.
+
+    Columns are loaded (memory-mapped) on first access. Column names are interned, so the dicts built by `row()` and
+    `rows()` share key strings.
+    """
+
+    def __init__(self, store_dir: Path):
+        with (store_dir / METADATA_FILENAME).open(mode="r", encoding="utf-8") as metadata_in:
+            metadata = json.load(metadata_in)
+        if metadata["version"] != STORE_VERSION:
+            raise ValueError(
+                f"Store {store_dir} has version {metadata['version']}, but we can only read version {STORE_VERSION}"
+            )
+        self.store_dir = store_dir
+        self.n_rows: int = metadata["n_rows"]
+        self.columns: list[str] = [sys.intern(column) for column in metadata["columns"]]
+        self._column_nos = {column: column_no for column_no, column in enumerate(self.columns)}
+        self._loaded: dict[str, DictionaryColumn] = {}
+
+    def __len__(self) -> int:
+        return self.n_rows
+
+    def column(self, name: str) -> DictionaryColumn:
+        """
+        Get the named column.
+        """
+        result = self._loaded.get(name)
+        if result is None:
+            if name not in self._column_nos:
+                raise KeyError(f"No column {name!r} in store {self.store_dir}")
+            result = self._loaded[name] = DictionaryColumn(self.store_dir, self._column_nos[name])
+        return result
+
+    def row(self, row_no: int, columns: Optional[Sequence[str]] = None) -> dict[str, Any]:
+        """
+        Get one row as a dict, optionally only the given columns.
+        """
+        return {column: self.column(column)[row_no] for column in (columns or self.columns)}
+
+    def rows(self, row_nos: Iterable[int], columns: Optional[Sequence[str]] = None) -> Iterator[dict[str, Any]]:
+        """
+        Get the given rows as dicts in the given order, optionally only the given columns.
+
+        Rows are decoded column by column, so this is much faster than calling `row()` for each row.
+        """
+        row_nos = np.fromiter(row_nos, dtype=np.int64)
+        columns = columns or self.columns
+        values_by_column = [self.column(column).take(row_nos) for column in columns]
+        for values in zip(*values_by_column):
+            yield dict(zip(columns, values))
@@ -0,0 +1,258 @@
+"""
+Memory probes for benchmarking, and a helper to run probed work in an isolated subprocess.
+
+`tracemalloc` only sees allocations made through Python's allocator, so it misses most of the memory used by native
+libraries like torch and thinc. To see what a process actually needs we also track resident set size (RSS, which
+includes shared pages such as mapped libraries) and unique set size (USS, memory that would be freed if the process
+exited). Running each measurement in a fresh subprocess keeps models loaded earlier from polluting the numbers.
+
+tracemalloc's per-allocation bookkeeping itself takes memory, which would inflate RSS and USS, so it always gets a
+subprocess of its own.
+"""
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+import multiprocessing
+import threading
+import tracemalloc
+from typing import Any, Callable, Optional, Sequence
+
+import psutil
+
+
+DEFAULT_SAMPLE_INTERVAL_SECONDS = 0.05
+
+
+class MemoryProbe(ABC):
+    """
+    Tracks current and peak memory usage by some measure.
+
+    Subclasses implement `current()` and may override the other methods if they can track peaks more directly.
+    """
+
+    name: str = ""
+
+    def start(self) -> None:
+        self._peak = self.current()
+
+    @abstractmethod
+    def current(self) -> int:
+        """Get current memory usage in bytes."""
+
+    def peak(self) -> int:
+        """Get peak memory usage in bytes since the last reset."""
+        return max(self._peak, self.current())
+
+    def reset_peak(self) -> None:
+        self._peak = self.current()
+
+    def stop(self) -> None:
+        pass
+
+
+class TracemallocProbe(MemoryProbe):
+    """
+    Memory allocated through Python's allocator, as seen by `tracemalloc`.
+    """
+
+    name = "tracemalloc"
+
+    def start(self) -> None:
+        tracemalloc.start()
+
+    def current(self) -> int:
+        current, _peak = tracemalloc.get_traced_memory()
+        return current
+
+    def peak(self) -> int:
+        _current, peak = tracemalloc.get_traced_memory()
+        return peak
+
+    def reset_peak(self) -> None:
+        tracemalloc.reset_peak()
+
+    def stop(self) -> None:
+        tracemalloc.stop()
+
+
+class SampledProbe(MemoryProbe):
+    """
+    A probe that tracks its peak by polling `current()` on a background thread.
+    """
+
+    def __init__(self, *, sample_interval_seconds: float = DEFAULT_SAMPLE_INTERVAL_SECONDS):
+        self.sample_interval_seconds = sample_interval_seconds
+        self._process = psutil.Process()
+        self._peak = 0
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _sample(self) -> None:
+        while not self._stopping.wait(self.sample_interval_seconds):
+            value = self.current()
+            with self._lock:
+                self._peak = max(self._peak, value)
+
+    def start(self) -> None:
+        self._peak = self.current()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def peak(self) -> int:
+        value = self.current()
+        with self._lock:
+            return max(self._peak, value)
+
+    def reset_peak(self) -> None:
+        value = self.current()
+        with self._lock:
+            self._peak = value
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class RssProbe(SampledProbe):
+    """
+    Resident set size of this process.
+    """
+
+    name = "rss"
+
+    def current(self) -> int:
+        return self._process.memory_info().rss
+
+
+class UssProbe(SampledProbe):
+    """
+    Unique set size of this process. This is slower to read than RSS.
+    """
+
+    name = "uss"
+
+    def current(self) -> int:
+        return self._process.memory_full_info().uss
+
+
+PROBES: dict[str, Callable[[], MemoryProbe]] = {
+    TracemallocProbe.name: TracemallocProbe,
+    RssProbe.name: RssProbe,
+    UssProbe.name: UssProbe,
+}
+DEFAULT_PROBES = tuple(PROBES)
+# Probes that perturb the other probes' measurements, so must run in a subprocess of their own.
+ISOLATED_PROBES = frozenset({TracemallocProbe.name})
+
+
+@dataclass
+class MemoryMeasurement:
+    """Memory usage in bytes by probe name, measured while loading a model and then while using it."""
+
+    load_bytes: dict[str, int] = field(default_factory=dict)
+    load_peak_bytes: dict[str, int] = field(default_factory=dict)
+    work_peak_bytes: dict[str, int] = field(default_factory=dict)
+
+    def update(self, other: "MemoryMeasurement") -> None:
+        """Add the measurements of another set of probes to this one."""
+        self.load_bytes.update(other.load_bytes)
+        self.load_peak_bytes.update(other.load_peak_bytes)
+        self.work_peak_bytes.update(other.work_peak_bytes)
+
+
+def _measure(
+    load: Callable[[], Any],
+    work: Optional[Callable[[Any], Any]],
+    probe_names: Sequence[str],
+) -> MemoryMeasurement:
+    probes = [PROBES[name]() for name in probe_names]
+    for probe in probes:
+        probe.start()
+    try:
+        baselines = {probe.name: probe.current() for probe in probes}
+        for probe in probes:
+            probe.reset_peak()
+
+        loaded = load()
+
+        result = MemoryMeasurement()
+        for probe in probes:
+            result.load_bytes[probe.name] = probe.current() - baselines[probe.name]
+            result.load_peak_bytes[probe.name] = probe.peak() - baselines[probe.name]
+        if work is not None:
+            after_load = {probe.name: probe.current() for probe in probes}
+            for probe in probes:
+                probe.reset_peak()
+            work(loaded)
+            for probe in probes:
+                result.work_peak_bytes[probe.name] = probe.peak() - after_load[probe.name]
+    finally:
+        for probe in probes:
+            probe.stop()
+    return result
+
+
+def _measure_and_send(
+    load: Callable[[], Any],
+    work: Optional[Callable[[Any], Any]],
+    probe_names: Sequence[str],
+    connection: Any,
+) -> None:
+    try:
+        connection.send(_measure(load, work, probe_names))
+    except BaseException as e:
+        connection.send(e)
+        raise
+    finally:
+        connection.close()
+
+
+def _measure_one_subprocess(
+    load: Callable[[], Any],
+    work: Optional[Callable[[Any], Any]],
+    probe_names: Sequence[str],
+) -> MemoryMeasurement:
+    context = multiprocessing.get_context("spawn")
+    receive, send = context.Pipe(duplex=False)
+    process = context.Process(target=_measure_and_send, args=(load, work, list(probe_names), send))
+    process.start()
+    send.close()
+    try:
+        result = receive.recv()
+    except EOFError:
+        process.join()
+        result = RuntimeError(f"Memory measurement subprocess died with exit code {process.exitcode}")
+    process.join()
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+
+def measure_in_subprocess(
+    load: Callable[[], Any],
+    work: Optional[Callable[[Any], Any]] = None,
+    *,
+    probe_names: Sequence[str] = DEFAULT_PROBES,
+) -> MemoryMeasurement:
+    """
+    In fresh subprocesses, measure memory used by `load()` and, if given, peak memory used by `work(load())`.
+
+    Each of `ISOLATED_PROBES` runs in a subprocess of its own and the other probes share one, so `load` (and `work`)
+    may run several times. Load memory is what remains allocated after loading, and load peak memory is the peak while
+    loading, both relative to the subprocess baseline.
+    Work memory is the peak during `work` relative to the memory in use after loading. Both `load` and `work` must be
+    picklable, so use module-level functions or `functools.partial` of them.
+    """
+    unknown = set(probe_names) - set(PROBES)
+    if unknown:
+        raise ValueError(f"Unknown memory probes: {sorted(unknown)}")
+
+    shared = [name for name in probe_names if name not in ISOLATED_PROBES]
+    groups = [[name] for name in probe_names if name in ISOLATED_PROBES] + ([shared] if shared else [])
+    result = MemoryMeasurement()
+    for group in groups:
+        result.update(_measure_one_subprocess(load, work, group))
+    return result
@@ -0,0 +1,112 @@
+"""
+An on-disk cache of Genparse posteriors.
+
+Entries are keyed by a hash of everything that determines the inference: the fully rendered prompt, the grammar, the
+model, and all sampling parameters. Changing any of these gives a new key, so stale entries are never returned; they
+just age out under the size bound.
+"""
+import hashlib
+import json
+import logging
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+CACHE_FILENAME = "genparse_posteriors.sqlite3"
+DEFAULT_MAX_CACHE_MIB = 1024
+BYTES_PER_MIB = 1024 ** 2
+
+
+def make_cache_key(inference_params: dict[str, Any]) -> str:
+    """
+    Hash the given inference parameters into a cache key.
+
+    The parameters must be JSON-serializable. Key order doesn't matter.
+    """
+    canonical = json.dumps(inference_params, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class PosteriorCache:
+    """
+    A size-bounded SQLite cache mapping inference parameter hashes to posteriors.
+
+    When the cache grows past `max_bytes` we evict the least recently used entries. This is safe to share between
+    threads.
+    """
+
+    def __init__(self, cache_dir: Path, *, max_bytes: int = DEFAULT_MAX_CACHE_MIB * BYTES_PER_MIB):
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self.path = cache_dir / CACHE_FILENAME
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS posteriors ("
+                "key TEXT PRIMARY KEY, posterior TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS posteriors_last_used ON posteriors (last_used)")
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[dict[str, float]]:
+        """
+        Get the cached posterior for the given key, or None if it's not cached.
+        """
+        with self._lock, self._connection:
+            row = self._connection.execute("SELECT posterior FROM posteriors WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute("UPDATE posteriors SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, posterior: dict[str, float]) -> None:
+        """
+        Cache the posterior under the given key, evicting old entries if we're over the size bound.
+        """
+        serialized = json.dumps(posterior)
+        size = len(serialized.encode("utf-8"))
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO posteriors (key, posterior, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, serialized, size, time.time()),
+            )
+            self._evict()
+
+    def _evict(self) -> None:
+        """
+        Evict least recently used entries until the cache fits in `max_bytes`.
+
+        Must be called with the lock held and inside a transaction.
+        """
+        (total,) = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM posteriors").fetchone()
+        if total <= self.max_bytes:
+            return
+
+        n_evicted = 0
+        for key, size in self._connection.execute(
+            "SELECT key, size FROM posteriors ORDER BY last_used ASC"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            self._connection.execute("DELETE FROM posteriors WHERE key = ?", (key,))
+            total -= size
+            n_evicted += 1
+        logger.debug("Evicted %d posteriors from cache %s", n_evicted, self.path)
+
+    def close(self) -> None:
+        """
+        Close the underlying database connection.
+        """
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,106 @@
+"""
+Fast rendering of chat prompts that differ only in one substituted field.
+
+Rendering a chat template with `tokenizer.apply_chat_template` for every sentence re-renders the whole few-shot
+template each time, and loading the tokenizer just to do that is slow. Instead we render the template once with a
+placeholder, split the result into a constant prefix and suffix around the placeholder, and render each prompt by
+concatenation. The split can be saved to disk so later runs don't need to load the tokenizer at all.
+"""
+from dataclasses import asdict, dataclass
+import hashlib
+import json
+import logging
+from pathlib import Path
+import string
+from typing import Callable, Optional
+
+from transformers import PreTrainedTokenizer
+
+
+logger = logging.getLogger(__name__)
+
+
+PLACEHOLDER = "<<<GENFACT_PROMPT_FIELD>>>"
+# Bump this if the way we render prompts changes, to invalidate saved splits.
+SPLIT_PROMPT_VERSION = 1
+
+
+@dataclass(frozen=True)
+class SplitPrompt:
+    """
+    A rendered chat prompt split around the position of its single variable field.
+    """
+
+    prefix: str
+    suffix: str
+
+    def render(self, value: str) -> str:
+        return self.prefix + value + self.suffix
+
+
+def render_chat_prompt(template: string.Template, field: str, value: str, *, tokenizer: PreTrainedTokenizer) -> str:
+    """
+    Render the template with the given field value as a single user turn, the slow way.
+    """
+    return tokenizer.apply_chat_template(
+        [{"role": "user", "content": template.substitute({field: value})}], tokenize=False
+    )
+
+
+def split_chat_prompt(template: string.Template, field: str, *, tokenizer: PreTrainedTokenizer) -> SplitPrompt:
+    """
+    Render the template once and split it around the given field.
+
+    Raises ValueError if the chat template doesn't pass the field through unchanged, in which case prompts have to be
+    rendered the slow way.
+    """
+    rendered = render_chat_prompt(template, field, PLACEHOLDER, tokenizer=tokenizer)
+    if rendered.count(PLACEHOLDER) != 1:
+        raise ValueError(f"Chat template doesn't contain the `{field}` placeholder exactly once after rendering")
+    prefix, suffix = rendered.split(PLACEHOLDER)
+    result = SplitPrompt(prefix=prefix, suffix=suffix)
+    check_value = "Dr. Check saw me in Springfield."
+    if result.render(check_value) != render_chat_prompt(template, field, check_value, tokenizer=tokenizer):
+        raise ValueError("Chat template renders differently with a real value than with the placeholder")
+    return result
+
+
+def _split_prompt_cache_path(cache_dir: Path, *, model: str, template: string.Template, field: str) -> Path:
+    key = json.dumps(
+        {"version": SPLIT_PROMPT_VERSION, "model": model, "template": template.template, "field": field},
+        sort_keys=True,
+    )
+    return cache_dir / f"split_prompt_{hashlib.sha256(key.encode('utf-8')).hexdigest()}.json"
+
+
+def load_split_prompt(
+    template: string.Template,
+    field: str,
+    *,
+    model: str,
+    load_tokenizer: Callable[[], PreTrainedTokenizer],
+    cache_dir: Optional[Path] = None,
+) -> SplitPrompt:
+    """
+    Get the split prompt for the given template and model, loading it from `cache_dir` if we've saved it before.
+
+    On a cache miss we call `load_tokenizer()`, split the prompt and save the split. Saved splits are keyed by the model
+    name and template text, so clear the cache if the model's chat template itself changes.
+    """
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = _split_prompt_cache_path(cache_dir, model=model, template=template, field=field)
+        if cache_path.exists():
+            logger.info("Using saved prompt split `%s`", cache_path)
+            with cache_path.open(mode="r", encoding="utf-8") as split_in:
+                return SplitPrompt(**json.load(split_in))
+
+    result = split_chat_prompt(template, field, tokenizer=load_tokenizer())
+    if cache_path is not None:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        temp_path = cache_path.with_suffix(".tmp")
+        with temp_path.open(mode="w", encoding="utf-8") as split_out:
+            json.dump(asdict(result), split_out)
+        temp_path.replace(cache_path)
+        logger.info("Saved prompt split to `%s`", cache_path)
+    return result
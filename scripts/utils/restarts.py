@@ -0,0 +1,315 @@
+"""
+Restarting Genparse servers when they need it, and only as long as they need.
+
+The Genparse server slows down and eventually falls over as its caches fill up, so we restart it periodically. Rather
+than restarting every N requests and then sleeping for a fixed minute or more, `RestartManager` watches request
+latencies, errors and (if the server reports it) memory use, and restarts the server when these degrade. It drains
+in-flight requests before restarting, holds new ones back meanwhile, and polls the server's health endpoint with
+backoff so that work resumes as soon as the server is ready again.
+"""
+from collections import deque
+from dataclasses import dataclass
+import logging
+import statistics
+import threading
+import time
+from typing import Callable, Optional, TypeVar
+
+import requests
+
+from scripts.utils.http_client import (
+    get_session,
+    health_endpoint,
+    make_session,
+    request_timeout,
+    restart_auth,
+    restart_endpoint,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+R = TypeVar("R")
+
+DEFAULT_RESTART_REQUEST_TIMEOUT_SECONDS = 30
+DEFAULT_PROBE_TIMEOUT_SECONDS = 5
+DEFAULT_INITIAL_POLL_SECONDS = 1.0
+DEFAULT_MAX_POLL_SECONDS = 15.0
+# If we never see the server go down after asking it to restart, assume it restarted faster than we could poll.
+DEFAULT_MAX_WAIT_FOR_DOWN_SECONDS = 15.0
+DEFAULT_READY_TIMEOUT_SECONDS = 600.0
+
+DEFAULT_LATENCY_WINDOW = 10
+DEFAULT_LATENCY_FACTOR = 3.0
+DEFAULT_MAX_CONSECUTIVE_ERRORS = 3
+DEFAULT_MAX_MEMORY_FRACTION = 0.9
+DEFAULT_PROBE_MEMORY_EVERY = 10
+
+
+@dataclass(frozen=True)
+class HealthStatus:
+    """
+    The result of probing a server's health endpoint.
+
+    The server is ready if it answers with anything other than a server error. Servers may report the fraction of
+    their memory in use as `memory_used_fraction` in a JSON response.
+    """
+
+    ready: bool
+    memory_used_fraction: Optional[float] = None
+
+
+def probe_health(server_ip_or_hostname: str, *, session: Optional[requests.Session] = None) -> HealthStatus:
+    """
+    Probe the health endpoint of the Genparse server on the given IP or hostname.
+    """
+    session = session or get_session()
+    try:
+        response = session.get(
+            health_endpoint(server_ip_or_hostname), timeout=request_timeout(DEFAULT_PROBE_TIMEOUT_SECONDS)
+        )
+    except requests.RequestException:
+        return HealthStatus(ready=False)
+    if response.status_code >= 500:
+        return HealthStatus(ready=False)
+
+    memory_used_fraction = None
+    try:
+        memory_used_fraction = float(response.json()["memory_used_fraction"])
+    except (ValueError, KeyError, TypeError):
+        pass
+    return HealthStatus(ready=True, memory_used_fraction=memory_used_fraction)
+
+
+def request_restart(
+    server_ip_or_hostname: str, *, timeout_seconds: float = DEFAULT_RESTART_REQUEST_TIMEOUT_SECONDS
+) -> None:
+    """
+    Ask the Genparse server on the given IP or hostname to restart, without waiting for it.
+    """
+    response = get_session().post(
+        restart_endpoint(server_ip_or_hostname), auth=restart_auth(), timeout=request_timeout(timeout_seconds)
+    )
+    response.raise_for_status()
+
+
+def wait_until_ready(
+    server_ip_or_hostname: str,
+    *,
+    initial_poll_seconds: float = DEFAULT_INITIAL_POLL_SECONDS,
+    max_poll_seconds: float = DEFAULT_MAX_POLL_SECONDS,
+    max_wait_for_down_seconds: float = DEFAULT_MAX_WAIT_FOR_DOWN_SECONDS,
+    timeout_seconds: float = DEFAULT_READY_TIMEOUT_SECONDS,
+) -> float:
+    """
+    Wait for a server we just asked to restart to come back up, returning how many seconds we waited.
+
+    A restarting server may keep answering for a moment before it goes down, so we first poll quickly until we see it
+    go down (or until `max_wait_for_down_seconds` pass), then poll with exponential backoff until it's ready. Raises
+    TimeoutError if it isn't ready after `timeout_seconds`.
+    """
+    # Don't retry probes: a refused connection is an answer.
+    session = make_session(connect_retries=0)
+    start = time.monotonic()
+    delay = initial_poll_seconds
+    seen_down = False
+    while True:
+        elapsed = time.monotonic() - start
+        if probe_health(server_ip_or_hostname, session=session).ready:
+            if seen_down or elapsed >= max_wait_for_down_seconds:
+                logger.info("Genparse server %s ready after %.1f seconds", server_ip_or_hostname, elapsed)
+                return elapsed
+            time.sleep(initial_poll_seconds)
+            continue
+
+        seen_down = True
+        if elapsed >= timeout_seconds:
+            raise TimeoutError(f"Genparse server {server_ip_or_hostname} not ready after {elapsed:.0f} seconds")
+        logger.debug("Genparse server %s not ready, polling again in %.1f seconds", server_ip_or_hostname, delay)
+        time.sleep(delay)
+        delay = min(delay * 2, max_poll_seconds)
+
+
+def restart_and_wait(server_ip_or_hostname: str) -> float:
+    """
+    Restart the Genparse server on the given IP or hostname and wait until it's ready, returning the seconds waited.
+    """
+    logger.info("Restarting Genparse server: %s", server_ip_or_hostname)
+    request_restart(server_ip_or_hostname)
+    return wait_until_ready(server_ip_or_hostname)
+
+
+@dataclass(frozen=True)
+class RestartPolicy:
+    """
+    When to restart a server.
+
+    We restart if the median of the last `latency_window` request latencies exceeds `latency_factor` times the median
+    of the first `latency_window` latencies after the last restart, after `max_consecutive_errors` failed requests in
+    a row, if the server reports using more than `max_memory_fraction` of its memory (checked every
+    `probe_memory_every` requests), or after `max_requests` requests if given.
+
+    Latencies are per unit of work, as given to `RestartManager.call`, so that requests of different sizes (say, more
+    particles or more prompts) compare fairly. Set `latency_factor` to None if the work per request varies in a way
+    the caller can't measure.
+    """
+
+    latency_window: int = DEFAULT_LATENCY_WINDOW
+    latency_factor: Optional[float] = DEFAULT_LATENCY_FACTOR
+    max_consecutive_errors: Optional[int] = DEFAULT_MAX_CONSECUTIVE_ERRORS
+    max_memory_fraction: Optional[float] = DEFAULT_MAX_MEMORY_FRACTION
+    probe_memory_every: int = DEFAULT_PROBE_MEMORY_EVERY
+    max_requests: Optional[int] = None
+
+
+class RestartManager:
+    """
+    Runs requests against one server, restarting the server when its health degrades according to a `RestartPolicy`.
+
+    Call `call(fn)` to make each request. This is safe to use from many threads: when a restart is needed, new calls
+    wait while in-flight calls finish, then the last one to finish restarts the server and lets the waiting calls go.
+
+    Health checks and restarts never fail a request: if probing or restarting the server fails, we log it and put the
+    server back in rotation, so that later failed requests can trigger another restart.
+    """
+
+    def __init__(
+        self,
+        server_ip_or_hostname: str,
+        *,
+        policy: RestartPolicy = RestartPolicy(),
+        restart: Callable[[str], float] = restart_and_wait,
+        probe: Callable[[str], HealthStatus] = probe_health,
+    ):
+        self.server = server_ip_or_hostname
+        self.policy = policy
+        self._restart = restart
+        self._probe = probe
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._restart_reason: Optional[str] = None
+        self.n_restarts = 0
+        self.n_failed_restarts = 0
+        self.restart_wait_seconds = 0.0
+        self._reset_stats()
+
+    def _reset_stats(self) -> None:
+        self._n_requests = 0
+        self._n_consecutive_errors = 0
+        self._baseline_latencies: list[float] = []
+        self._recent_latencies: deque[float] = deque(maxlen=self.policy.latency_window)
+
+    @property
+    def restarting(self) -> bool:
+        """Whether a restart is pending or in progress, so the server isn't taking new requests."""
+        with self._condition:
+            return self._restart_reason is not None
+
+    @property
+    def in_flight(self) -> int:
+        """The number of calls currently running."""
+        with self._condition:
+            return self._in_flight
+
+    def call(self, fn: Callable[[], R], *, work: float = 1.0) -> R:
+        """
+        Call `fn`, which should make one request to the server, waiting first if the server is due for a restart.
+
+        `work` is how much work the request asks of the server, in any unit proportional to the time it should take,
+        such as particles times prompts. Its latency is judged per unit of work.
+        """
+        assert work > 0
+        with self._condition:
+            while self._restart_reason is not None:
+                self._condition.wait()
+            self._in_flight += 1
+            self._n_requests += 1
+            n_requests = self._n_requests
+
+        start = time.monotonic()
+        succeeded = False
+        try:
+            result = fn()
+            succeeded = True
+        finally:
+            latency = (time.monotonic() - start) / work
+            self._finish(latency, succeeded=succeeded, memory_used_fraction=self._probe_memory(n_requests))
+        return result
+
+    def _probe_memory(self, n_requests: int) -> Optional[float]:
+        """
+        Get the fraction of memory the server uses if it's time to check, or None. Never raises.
+        """
+        if self.policy.max_memory_fraction is None or n_requests % self.policy.probe_memory_every != 0:
+            return None
+        try:
+            return self._probe(self.server).memory_used_fraction
+        except Exception as e:
+            logger.warning("Couldn't probe the memory use of %s: %s", self.server, e)
+            return None
+
+    def _check_health(
+        self, latency: float, *, succeeded: bool, memory_used_fraction: Optional[float]
+    ) -> Optional[str]:
+        """
+        Record a finished request, returning a reason to restart if the server needs one.
+
+        Must be called with the lock held.
+        """
+        policy = self.policy
+        if not succeeded:
+            self._n_consecutive_errors += 1
+            max_errors = policy.max_consecutive_errors
+            if max_errors is not None and self._n_consecutive_errors >= max_errors:
+                return f"{self._n_consecutive_errors} consecutive errors"
+        else:
+            self._n_consecutive_errors = 0
+            if len(self._baseline_latencies) < policy.latency_window:
+                self._baseline_latencies.append(latency)
+            else:
+                self._recent_latencies.append(latency)
+            if policy.latency_factor is not None and len(self._recent_latencies) == policy.latency_window:
+                baseline = statistics.median(self._baseline_latencies)
+                recent = statistics.median(self._recent_latencies)
+                if recent > policy.latency_factor * baseline:
+                    return f"median latency rose from {baseline:.3f} to {recent:.3f} seconds per unit of work"
+
+        if (
+            memory_used_fraction is not None
+            and policy.max_memory_fraction is not None
+            and memory_used_fraction > policy.max_memory_fraction
+        ):
+            return f"using {100 * memory_used_fraction:.0f}% of memory"
+        if policy.max_requests is not None and self._n_requests >= policy.max_requests:
+            return f"{self._n_requests} requests since the last restart"
+        return None
+
+    def _finish(self, latency: float, *, succeeded: bool, memory_used_fraction: Optional[float]) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            reason = self._check_health(latency, succeeded=succeeded, memory_used_fraction=memory_used_fraction)
+            if reason is not None and self._restart_reason is None:
+                logger.info("Draining %d in-flight requests to restart %s: %s", self._in_flight, self.server, reason)
+                self._restart_reason = reason
+            if self._restart_reason is None or self._in_flight > 0:
+                return
+
+        # We're the last call to finish before the restart. New calls are waiting, so nothing else touches the server.
+        start = time.monotonic()
+        restarted = False
+        try:
+            self._restart(self.server)
+            restarted = True
+        except Exception as e:
+            logger.warning("Couldn't restart %s, putting it back in rotation: %s", self.server, e)
+        finally:
+            with self._condition:
+                if restarted:
+                    self.n_restarts += 1
+                else:
+                    self.n_failed_restarts += 1
+                self.restart_wait_seconds += time.monotonic() - start
+                self._restart_reason = None
+                self._reset_stats()
+                self._condition.notify_all()
@@ -0,0 +1,106 @@
+"""
+Spreading requests across several interchangeable inference servers.
+
+`ServerPool` sends each request to the server with the fewest requests outstanding, so faster servers naturally take
+more of the load. Servers that are restarting are taken out of rotation until they're ready again, and their share of
+the work moves to the others in the meantime.
+"""
+import logging
+import threading
+from typing import Callable, Optional, Sequence, TypeVar
+
+from scripts.utils.restarts import RestartManager
+
+
+logger = logging.getLogger(__name__)
+
+
+R = TypeVar("R")
+
+
+class ServerPool:
+    """
+    A client-side pool of servers dispatching by least outstanding requests.
+
+    Call `call(fn)` to make each request, where `fn` takes the server to use. This is safe to use from many threads.
+    Ties go round-robin, so sequential callers still spread their requests over all servers. If given
+    `make_restart_manager`, each server gets its own restart manager, and requests to it go through that manager.
+    """
+
+    def __init__(
+        self,
+        servers: Sequence[str],
+        *,
+        make_restart_manager: Optional[Callable[[str], RestartManager]] = None,
+    ):
+        if not servers:
+            raise ValueError("Need at least one server")
+        if len(set(servers)) != len(servers):
+            raise ValueError(f"Servers must be distinct, got: {servers}")
+        self.servers = list(servers)
+        self.restart_managers: dict[str, RestartManager] = {}
+        if make_restart_manager is not None:
+            self.restart_managers = {server: make_restart_manager(server) for server in self.servers}
+        self._lock = threading.Lock()
+        self._outstanding = {server: 0 for server in self.servers}
+        self._n_requests = {server: 0 for server in self.servers}
+        self._next = 0
+
+    def _in_rotation(self, server: str) -> bool:
+        manager = self.restart_managers.get(server)
+        return manager is None or not manager.restarting
+
+    def _acquire(self) -> str:
+        with self._lock:
+            n_servers = len(self.servers)
+            order = [self.servers[(self._next + offset) % n_servers] for offset in range(n_servers)]
+            # If every server is restarting, queue on the least loaded one; its restart manager holds us back.
+            candidates = [server for server in order if self._in_rotation(server)] or order
+            result = min(candidates, key=lambda server: self._outstanding[server])
+            self._next = (self.servers.index(result) + 1) % n_servers
+            self._outstanding[result] += 1
+            self._n_requests[result] += 1
+            return result
+
+    def _release(self, server: str) -> None:
+        with self._lock:
+            self._outstanding[server] -= 1
+
+    def call(self, fn: Callable[[str], R], *, work: float = 1.0) -> R:
+        """
+        Call `fn(server)` on the least loaded server that isn't restarting.
+
+        `work` is passed on to the server's restart manager, see `RestartManager.call`.
+        """
+        server = self._acquire()
+        try:
+            manager = self.restart_managers.get(server)
+            if manager is None:
+                return fn(server)
+            return manager.call(lambda: fn(server), work=work)
+        finally:
+            self._release(server)
+
+    @property
+    def n_requests(self) -> dict[str, int]:
+        """The number of requests (including retries) sent to each server so far."""
+        with self._lock:
+            return dict(self._n_requests)
+
+    def log_summary(self) -> None:
+        """
+        Log how requests were spread over the servers and how often each restarted.
+        """
+        for server, n_requests in self.n_requests.items():
+            manager = self.restart_managers.get(server)
+            if manager is None:
+                logger.info("Sent %d requests to %s", n_requests, server)
+            else:
+                logger.info(
+                    "Sent %d requests to %s, restarting it %d times (%d failed) and waiting %.0f seconds in total",
+                    n_requests,
+                    server,
+                    manager.n_restarts,
+                    manager.n_failed_restarts,
+                    manager.restart_wait_seconds,
+                )
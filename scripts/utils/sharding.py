@@ -0,0 +1,112 @@
+"""
+Splitting row-wise jobs into shards that can run independently, and merging their outputs.
+
+A shard is written `i/N` on the command line, for shard `i` (counting from 0) of `N`. Shard `i` writes to a sibling of
+the final output path named like `sentences.shard2-of-8.jsonl`, and merging concatenates the shard files in order.
+
+Shards may also name the settings they must share to be merged, like `sentences.shard2-of-8.batch8-window64.jsonl`.
+Merging refuses shards with different settings.
+"""
+from dataclasses import dataclass
+import logging
+from pathlib import Path
+import re
+
+
+logger = logging.getLogger(__name__)
+
+
+COPY_BLOCK_BYTES = 1024 ** 2
+
+
+@dataclass(frozen=True)
+class Shard:
+    """
+    Shard `index` of `count`, counting from 0.
+    """
+
+    index: int
+    count: int
+
+    def __post_init__(self):
+        if self.count <= 0 or not 0 <= self.index < self.count:
+            raise ValueError(f"Shard {self.index}/{self.count} must have 0 <= index < count")
+
+    @classmethod
+    def parse(cls, spec: str) -> "Shard":
+        """
+        Parse a shard written `i/N`.
+        """
+        index, sep, count = spec.partition("/")
+        if not sep:
+            raise ValueError(f"Shard must be written `i/N`, got: {spec}")
+        return cls(index=int(index), count=int(count))
+
+    def row_range(self, n_rows: int, *, align_to: int = 1) -> range:
+        """
+        Get this shard's contiguous range of row numbers out of `n_rows`.
+
+        Shard boundaries fall on multiples of `align_to`, so that when rows are processed in batches of that size,
+        every shard sees the same batches as an unsharded run would.
+        """
+        assert align_to > 0
+        n_blocks = -(-n_rows // align_to)
+        start = self.index * n_blocks // self.count * align_to
+        end = (self.index + 1) * n_blocks // self.count * align_to
+        return range(min(start, n_rows), min(end, n_rows))
+
+    def output_path(self, path: Path, *, settings: str = "") -> Path:
+        """
+        Get the path this shard writes its part of `path` to.
+
+        `settings` names the settings that all shards must share to be merged, and must not contain dots.
+        """
+        if "." in settings:
+            raise ValueError(f"Shard settings must not contain dots, got: {settings}")
+        settings_part = f".{settings}" if settings else ""
+        return path.with_name(f"{path.stem}.shard{self.index}-of-{self.count}{settings_part}{path.suffix}")
+
+
+def find_shard_outputs(path: Path, n_shards: int) -> dict[str, dict[int, Path]]:
+    """
+    Find the existing outputs of shards of `path` out of `n_shards`, by their settings and then by shard index.
+    """
+    pattern = re.compile(rf"{re.escape(path.stem)}\.shard(\d+)-of-{n_shards}(?:\.([^.]+))?{re.escape(path.suffix)}")
+    result: dict[str, dict[int, Path]] = {}
+    for sibling in path.parent.iterdir():
+        match = pattern.fullmatch(sibling.name)
+        if match is not None and sibling.is_file():
+            result.setdefault(match.group(2) or "", {})[int(match.group(1))] = sibling
+    return result
+
+
+def merge_shards(path: Path, n_shards: int) -> int:
+    """
+    Concatenate the outputs of all `n_shards` shards of `path` into `path`, in shard order, returning the number of
+    lines written.
+
+    Raises ValueError if the shard outputs name different settings, and FileNotFoundError if any shard's output is
+    missing.
+    """
+    by_settings = find_shard_outputs(path, n_shards)
+    if len(by_settings) > 1:
+        settings_names = ", ".join(sorted(settings or "none" for settings in by_settings))
+        raise ValueError(
+            f"Shard outputs of `{path}` were generated with different settings ({settings_names}), "
+            "so they can't be merged. Remove or regenerate the stale shards."
+        )
+    settings, found = next(iter(by_settings.items()), ("", {}))
+    shard_paths = [Shard(index=i, count=n_shards).output_path(path, settings=settings) for i in range(n_shards)]
+    missing = [str(shard_path) for i, shard_path in enumerate(shard_paths) if i not in found]
+    if missing:
+        raise FileNotFoundError(f"Missing {len(missing)} of {n_shards} shard outputs: {', '.join(missing)}")
+
+    result = 0
+    with path.open(mode="wb") as merged_out:
+        for shard_path in shard_paths:
+            with shard_path.open(mode="rb") as shard_in:
+                for block in iter(lambda: shard_in.read(COPY_BLOCK_BYTES), b""):
+                    merged_out.write(block)
+                    result += block.count(b"\n")
+            logger.debug("Merged `%s`", shard_path)
+    return result
@@ -0,0 +1,17 @@
+"""
+Timing helpers for the benchmark scripts.
+"""
+import time
+from typing import Any, Callable
+
+
+def time_best_of(fn: Callable[[], Any], n_trials: int) -> float:
+    """
+    Run `fn` `n_trials` times, returning the fastest time in seconds.
+    """
+    result = float("inf")
+    for _ in range(n_trials):
+        start = time.perf_counter()
+        fn()
+        result = min(result, time.perf_counter() - start)
+    return result